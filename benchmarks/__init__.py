@@ -0,0 +1,18 @@
+"""
+Benchmarks for simpleredcapbuilder.
+
+These generate synthetic compact data dictionaries of a given size and time
+each stage of the expansion, reporting the results as JSON so that they can be
+compared across releases. Run them with::
+
+	% python -m benchmarks.run --help
+
+``benchmarks.startup`` checks that importing the package and starting the
+script stay within a time budget, without importing Jinja and the like.
+``benchmarks.server_check`` checks the responses of the server. Both are run,
+failing if either does, by ``python -m benchmarks.check``, which should pass
+before a change is merged.
+
+"""
+
+### END ###
@@ -0,0 +1,52 @@
+"""
+Run every check that a change must pass, failing if any of them do.
+
+The checks are those of starting up quickly without importing what isn't
+needed (``benchmarks.startup``) and of the server's responses
+(``benchmarks.server_check``), each run in its own interpreter. Run them
+before merging a change, e.g.::
+
+	% python -m benchmarks.check
+
+The exit status is 1 if any check fails. Options are passed to the startup
+check, e.g. ``--scale 2`` to allow for a slow machine.
+
+"""
+
+### IMPORTS
+
+import subprocess
+import sys
+
+
+### CONSTANTS & DEFINES
+
+# each check is the module to run and whether it takes the options given
+CHECKS = (
+	('benchmarks.startup', True),
+	('benchmarks.server_check', False),
+)
+
+
+### CODE ###
+
+def main ():
+	opts = sys.argv[1:]
+	failed = []
+	for mod, takes_opts in CHECKS:
+		cmd = [sys.executable, '-m', mod] + (opts if takes_opts else [])
+		if subprocess.run (cmd).returncode != 0:
+			failed.append (mod)
+
+	if failed:
+		sys.stderr.write ("failed: %s\n" % ', '.join (failed))
+
+	## Return:
+	return not failed
+
+
+if __name__ == '__main__':
+	sys.exit (0 if main() else 1)
+
+
+### END ###
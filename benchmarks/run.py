@@ -0,0 +1,220 @@
+"""
+Time each stage of expanding a synthetic compact data dictionary.
+
+Each stage of the command-line expansion is run separately and timed, the
+best of several runs being reported as JSON, e.g.::
+
+	% python -m benchmarks.run --forms 20 --section-repeat 10 -o bench.json
+
+"""
+
+### IMPORTS
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import simpleredcapbuilder
+from simpleredcapbuilder import ExpDataDictReader, ExpandDbSchema, \
+	DirectExpander, PreValidator, PostValidator, render_template, write_json, \
+	write_rows
+
+from .synth import make_compact_dd, make_vars, write_compact_dd
+
+
+### CONSTANTS & DEFINES
+
+MODES = ('template', 'direct')
+
+
+### CODE ###
+
+class StageTimer (object):
+	"""
+	Collect the best time for each named stage over several runs.
+	"""
+	def __init__ (self):
+		self.best = {}
+		self.order = []
+
+	@contextlib.contextmanager
+	def stage (self, name):
+		start = time.perf_counter()
+		yield
+		elapsed = time.perf_counter() - start
+		if name not in self.best:
+			self.order.append (name)
+			self.best[name] = elapsed
+		else:
+			self.best[name] = min (self.best[name], elapsed)
+
+	def as_dict (self):
+		return dict ((n, self.best[n]) for n in self.order)
+
+
+def run_once (dd_pth, work_dir, render_vals, modes, timer,
+		prevalidate_jobs=1):
+	"""
+	Run and time each stage of the expansion, returning the counts of rows.
+	"""
+	rdr = ExpDataDictReader()
+
+	with timer.stage ('read'):
+		fieldnames, recs = rdr.read_file (dd_pth)
+
+	with timer.stage ('pre_process'):
+		proc_recs = [rdr.pre_process (r) for r in recs]
+
+	with timer.stage ('prevalidate'):
+		PreValidator().check (proc_recs)
+
+	if 1 < prevalidate_jobs:
+		with timer.stage ('prevalidate_parallel'):
+			PreValidator().check (proc_recs, jobs=prevalidate_jobs)
+
+	with timer.stage ('parse'):
+		db_schema = rdr.parse_all_recs (proc_recs)
+
+	# the same, as the pipeline that the scripts use
+	with timer.stage ('read_parse'):
+		db_schema = rdr.parse (dd_pth)
+
+	with timer.stage ('json_dump'):
+		with open (os.path.join (work_dir, 'bench.json'), 'w') as out_hndl:
+			write_json (db_schema, out_hndl)
+
+	rows_out = {}
+	out_pth = os.path.join (work_dir, 'bench.expanded.csv')
+
+	if 'template' in modes:
+		tmpl_pth = os.path.join (work_dir, 'bench.jinja')
+		with timer.stage ('template.expand'):
+			tmpl_data = ExpandDbSchema().expand (db_schema, out_pth=tmpl_pth)
+
+		with timer.stage ('template.render'):
+			exp_tmpl = render_template (tmpl_data, dict (render_vals))
+
+		with timer.stage ('template.write'):
+			with open (out_pth, 'w') as out_hndl:
+				out_hndl.write (exp_tmpl)
+
+		with timer.stage ('template.postvalidate'):
+			with open (out_pth, 'r') as in_hndl:
+				out_recs = list (csv.DictReader (in_hndl))
+			PostValidator().check (out_recs)
+		rows_out['template'] = len (out_recs)
+
+	if 'direct' in modes:
+		with timer.stage ('direct.expand'):
+			xpndr = DirectExpander (render_vals)
+			out_recs = list (xpndr.expand (db_schema))
+
+		with timer.stage ('direct.write'):
+			with open (out_pth, 'w') as out_hndl:
+				write_rows (out_recs, out_hndl)
+
+		with timer.stage ('direct.postvalidate'):
+			PostValidator (db_schema).check (out_recs)
+		rows_out['direct'] = len (out_recs)
+
+	## Return:
+	return len (recs), rows_out
+
+
+def parse_clargs ():
+	aparser = argparse.ArgumentParser (description=__doc__.strip().split ('\n')[0])
+
+	aparser.add_argument ('--forms', type=int, default=10,
+		help='number of forms')
+	aparser.add_argument ('--sections', type=int, default=5,
+		help='number of sections per form')
+	aparser.add_argument ('--rows', type=int, default=10,
+		help='number of rows per section')
+	aparser.add_argument ('--form-repeat', type=int, default=0,
+		help='repeat each form this many times')
+	aparser.add_argument ('--section-repeat', type=int, default=3,
+		help='repeat each section this many times')
+	aparser.add_argument ('--row-repeat', type=int, default=0,
+		help='repeat every other row this many times')
+	aparser.add_argument ('--tags', type=int, default=0,
+		help='tag rows with this many different tags')
+	aparser.add_argument ('--use-filters', action='store_true', default=False,
+		help='build some choices with the choice filters')
+
+	aparser.add_argument ('--mode', choices=MODES + ('both',), default='both',
+		help='which expansion path to time')
+	aparser.add_argument ('--prevalidate-jobs', type=int, default=1,
+		help='also time pre-validation in this many processes')
+	aparser.add_argument ('--runs', type=int, default=3,
+		help='report the best of this many runs')
+	aparser.add_argument ('-o', '--outfile', default=None,
+		help='write the results here rather than to the screen')
+
+	return aparser.parse_args()
+
+
+def main ():
+	args = parse_clargs()
+	modes = MODES if args.mode == 'both' else (args.mode,)
+	params = {
+		'forms': args.forms,
+		'sections': args.sections,
+		'rows': args.rows,
+		'form_repeat': args.form_repeat,
+		'section_repeat': args.section_repeat,
+		'row_repeat': args.row_repeat,
+		'tags': args.tags,
+		'use_filters': args.use_filters,
+		'prevalidate_jobs': args.prevalidate_jobs,
+	}
+
+	work_dir = tempfile.mkdtemp (prefix='srb-bench-')
+	try:
+		dd_pth = os.path.join (work_dir, 'bench.csv')
+		recs = make_compact_dd (n_forms=args.forms, n_sections=args.sections,
+			n_rows=args.rows, form_repeat=args.form_repeat,
+			section_repeat=args.section_repeat, row_repeat=args.row_repeat,
+			n_tags=args.tags, use_filters=args.use_filters)
+		write_compact_dd (recs, dd_pth)
+
+		timer = StageTimer()
+		for i in range (args.runs):
+			# the validators are chatty, so keep them quiet
+			with contextlib.redirect_stdout (io.StringIO()):
+				rows_in, rows_out = run_once (dd_pth, work_dir, make_vars(),
+					modes, timer, prevalidate_jobs=args.prevalidate_jobs)
+	finally:
+		shutil.rmtree (work_dir)
+
+	results = {
+		'version': simpleredcapbuilder.__version__,
+		'python': platform.python_version(),
+		'params': params,
+		'runs': args.runs,
+		'rows_in': rows_in,
+		'rows_out': rows_out,
+		'stages': timer.as_dict(),
+	}
+	results_str = json.dumps (results, indent=3)
+
+	if args.outfile:
+		with open (args.outfile, 'w') as out_hndl:
+			out_hndl.write (results_str + '\n')
+	else:
+		print (results_str)
+
+
+if __name__ == '__main__':
+	main()
+	sys.exit (0)
+
+
+### END ###
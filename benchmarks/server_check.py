@@ -0,0 +1,133 @@
+"""
+Check that the expansion server answers as it should, on a local port.
+
+A server is started in this process on a free port and sent a few requests:
+a good expansion, requests that should be refused (400), dictionaries that
+can't be read or rendered (422) and a request when the server is full (503).
+Each response is checked for its status and that no error gives away where an
+upload was saved. The results are reported as JSON, and the exit status is 1
+if any check fails, e.g.::
+
+	% python -m benchmarks.server_check
+
+"""
+
+### IMPORTS
+
+import base64
+import json
+import sys
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+
+from simpleredcapbuilder.server import make_server
+
+
+### CONSTANTS & DEFINES
+
+_SMALL_DD = '''tags,repeat,Variable / Field Name,Form Name,Section Header,Field Type,Field Label
+,,subject_id,first_form,,text,Subject ID
+,form: 1-2,visit_date,visit_{{ f_iter }},,text,Date of visit
+'''
+
+# with a row whose field label holds template code (broken in some way)
+_BROKEN_DD = _SMALL_DD + ''',,broken,first_form,,text,%s
+'''
+
+_NO_FORM_DD = '''Variable / Field Name,Field Type,Field Label
+subject_id,text,Subject ID
+'''
+
+# each check is a name, the request body (or raw bytes) and the status expected
+CHECKS = (
+	('expand', {'dictionary': _SMALL_DD}, 200),
+	('expand, filename in capitals', {'dictionary': _SMALL_DD,
+		'filename': 'Study.CSV'}, 200),
+	('no dictionary', {'vars': {}}, 400),
+	('not json', b'{"dictionary": ', 400),
+	('not an object', [], 400),
+	('directory as filename', {'dictionary': _SMALL_DD, 'filename': 'x/'}, 400),
+	('unknown filename type', {'dictionary': _SMALL_DD,
+		'filename': 'study.txt'}, 400),
+	('bad variables', {'dictionary': _SMALL_DD, 'vars': [1]}, 400),
+	('missing columns', {'dictionary': _NO_FORM_DD}, 422),
+	('unreadable excel', {'dictionary_base64':
+		base64.b64encode (b'not really a spreadsheet').decode ('ascii'),
+		'filename': 'study.xlsx'}, 422),
+	('unclosed template code', {'dictionary': _BROKEN_DD % 'Age {{ x'}, 422),
+	('unknown filter', {'dictionary': _BROKEN_DD % '{{ x | nofilter }}'},
+		422),
+	('quoted string in template', {'dictionary':
+		_BROKEN_DD % '"{{ ""q"" }}"'}, 422),
+)
+
+
+### CODE ###
+
+def post (url, body):
+	"""
+	Post a request, returning the status and decoded response.
+	"""
+	if not isinstance (body, bytes):
+		body = json.dumps (body).encode ('utf-8')
+	req = urllib.request.Request (url, data=body,
+		headers={'Content-Type': 'application/json'})
+	try:
+		with urllib.request.urlopen (req) as resp:
+			return resp.status, json.loads (resp.read().decode ('utf-8'))
+	except urllib.error.HTTPError as err:
+		return err.code, json.loads (err.read().decode ('utf-8'))
+
+
+def main ():
+	server = make_server (port=0, workers=2)
+	thread = threading.Thread (target=server.serve_forever, daemon=True)
+	thread.start()
+	url = 'http://%s:%s/expand' % server.server_address[:2]
+	tmp_dir = tempfile.gettempdir()
+
+	results = []
+	def check (name, body, expected):
+		status, resp = post (url, body)
+		error = resp.get ('error', None)
+		leaked = (error is not None) and (tmp_dir in error)
+		results.append ({
+			'check': name,
+			'status': status,
+			'expected': expected,
+			'error': error,
+			'ok': (status == expected) and not leaked and
+				((status != 200) or (0 < resp.get ('rows', 0))),
+		})
+
+	try:
+		for name, body, expected in CHECKS:
+			check (name, body, expected)
+
+		# take every place for a request, so the next is refused
+		held = 0
+		while server.admit():
+			held += 1
+		try:
+			check ('server full', {'dictionary': _SMALL_DD}, 503)
+		finally:
+			for i in range (held):
+				server.release()
+		check ('server free again', {'dictionary': _SMALL_DD}, 200)
+	finally:
+		server.shutdown()
+		server.server_close()
+
+	print (json.dumps ({'checks': results}, indent=3))
+
+	## Return:
+	return all (r['ok'] for r in results)
+
+
+if __name__ == '__main__':
+	sys.exit (0 if main() else 1)
+
+
+### END ###
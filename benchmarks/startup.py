@@ -0,0 +1,132 @@
+"""
+Check that importing the package and starting the scripts stays quick.
+
+Each check is run in a fresh interpreter several times, the best time less that
+of starting a bare interpreter being compared with its budget. The libraries
+only needed for rendering and reading other formats shouldn't be imported at
+all. The results are reported as JSON, and the exit status is 1 if any check
+is over budget or imports what it shouldn't. On a slow machine, the budgets
+can be scaled up, e.g.::
+
+	% python -m benchmarks.startup --scale 2
+
+"""
+
+### IMPORTS
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+### CONSTANTS & DEFINES
+
+# libraries that aren't needed to start up
+LAZY_MODULES = ('jinja2', 'markupsafe', 'json', 'yaml', 'xlrd', 'openpyxl')
+
+# each check is a name, its budget (in milliseconds over a bare interpreter)
+# and the code to run
+CHECKS = (
+	('import', 40, "import simpleredcapbuilder"),
+	('expand --help', 75, "import sys; sys.argv = ['expand-redcap-schema', "
+		"'--help']\n"
+		"from simpleredcapbuilder.scripts import expand\n"
+		"try:\n"
+		"	expand.main()\n"
+		"except SystemExit:\n"
+		"	pass"),
+	('expand --validate-only', 150,
+		"import sys; sys.argv = ['expand-redcap-schema', "
+		"'--validate-only', %(dd_pth)r]\n"
+		"from simpleredcapbuilder.scripts import expand\n"
+		"expand.main()"),
+)
+
+# reports which of the lazy modules were imported
+_REPORT_MODULES = ("\nimport sys\n"
+	"sys.stderr.write (' '.join (m for m in %r if m in sys.modules))" %
+	(LAZY_MODULES,))
+
+_SMALL_DD = '''tags,repeat,Variable / Field Name,Form Name,Section Header,Field Type,Field Label
+,,subject_id,first_form,,text,Subject ID
+,form: 1-2,visit_date,visit_{{ f_iter }},,text,Date of visit
+'''
+
+
+### CODE ###
+
+def time_code (code, runs):
+	"""
+	Run code in a fresh interpreter, returning the best time and the lazy
+	modules it imported.
+	"""
+	best, imported = None, []
+	for i in range (runs):
+		start = time.perf_counter()
+		proc = subprocess.run ([sys.executable, '-c', code + _REPORT_MODULES],
+			stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+			universal_newlines=True, check=True)
+		took = time.perf_counter() - start
+		if (best is None) or (took < best):
+			best = took
+		imported = proc.stderr.strip().split ('\n')[-1].split()
+	return best, imported
+
+
+def parse_clargs ():
+	aparser = argparse.ArgumentParser (description=__doc__.strip().split ('\n')[0])
+
+	aparser.add_argument ('--scale', type=float, default=1.0,
+		help='multiply the budget of each check by this')
+	aparser.add_argument ('--runs', type=int, default=5,
+		help='take the best of this many runs')
+
+	return aparser.parse_args()
+
+
+def main ():
+	args = parse_clargs()
+
+	work_dir = tempfile.mkdtemp (prefix='srb-startup-')
+	try:
+		dd_pth = os.path.join (work_dir, 'small.csv')
+		with open (dd_pth, 'w') as out_hndl:
+			out_hndl.write (_SMALL_DD)
+
+		base_time, _ = time_code ("pass", args.runs)
+		results = []
+		for name, budget, code in CHECKS:
+			took, imported = time_code (code % {'dd_pth': dd_pth}, args.runs)
+			over_ms = (took - base_time) * 1000
+			budget *= args.scale
+			results.append ({
+				'check': name,
+				'milliseconds': round (over_ms, 1),
+				'budget': budget,
+				'imported': imported,
+				'ok': (over_ms <= budget) and not imported,
+			})
+	finally:
+		for f in os.listdir (work_dir):
+			os.remove (os.path.join (work_dir, f))
+		os.rmdir (work_dir)
+
+	print (json.dumps ({
+		'python': sys.version.split()[0],
+		'interpreter_ms': round (base_time * 1000, 1),
+		'checks': results,
+	}, indent=3))
+
+	## Return:
+	return all (r['ok'] for r in results)
+
+
+if __name__ == '__main__':
+	sys.exit (0 if main() else 1)
+
+
+### END ###
@@ -0,0 +1,138 @@
+"""
+Generate synthetic compact data dictionaries for benchmarking.
+
+The dictionaries have a regular structure - a number of forms, each with a
+number of sections, each with a number of rows - that can be repeated at every
+level and use tags, external variables and branching logic, so that every
+part of the expansion gets exercised.
+
+"""
+
+### IMPORTS
+
+import csv
+import json
+
+from simpleredcapbuilder.consts import Column, ALL_NAMES
+
+__all__ = [
+	'make_compact_dd',
+	'make_vars',
+	'write_compact_dd',
+]
+
+
+### CONSTANTS & DEFINES
+
+FIELD_TYPES = ('text', 'radio', 'notes', 'dropdown', 'yesno')
+
+
+### CODE ###
+
+def make_vars ():
+	"""
+	Return the external variables used by the synthetic dictionaries.
+	"""
+	return {
+		'choices': {
+			'yes_no_unknown': '1, Yes | 0, No | 9, Unknown',
+			'severity': 'mild, Mild | moderate, Moderate | severe, Severe',
+		},
+		'label_prefix': 'Synthetic',
+	}
+
+
+def make_compact_dd (n_forms=10, n_sections=5, n_rows=10, form_repeat=0,
+		section_repeat=3, row_repeat=0, n_tags=0, use_filters=False):
+	"""
+	Make the rows of a synthetic compact data dictionary.
+
+	Params:
+		n_forms (int): number of forms
+		n_sections (int): number of sections in each form
+		n_rows (int): number of rows in each section
+		form_repeat (int): repeat each form this many times
+		section_repeat (int): repeat each section this many times
+		row_repeat (int): repeat every other row this many times
+		n_tags (int): tag rows with this many different tags
+		use_filters (bool): build some choices with the choice filters
+
+	Returns:
+		a list of records, dicts keyed by column header
+
+	"""
+	recs = []
+	tag_cnt = 0
+	for i in range (n_forms):
+		form_sfx = '_{{ f_iter }}' if form_repeat else ''
+		form_name = 'form_%s%s' % (i, form_sfx)
+		for j in range (n_sections):
+			sect_sfx = form_sfx + ('_{{ s_iter }}' if section_repeat else '')
+			for k in range (n_rows):
+				rpt_row = row_repeat and (k % 2)
+				var_sfx = sect_sfx + ('_{{ r_iter }}' if rpt_row else '')
+				rec = dict ((n, '') for n in ALL_NAMES)
+				rec[Column.variable.value] = 'f%ss%sr%s%s' % (i, j, k, var_sfx)
+				rec[Column.form_name.value] = form_name
+				rec[Column.field_label.value] = \
+					'{{ label_prefix }} question %s of section %s' % (k, j)
+
+				# repeats are given on the first row of each form & section
+				rpts = []
+				if (j == 0) and (k == 0) and form_repeat:
+					rpts.append ('form: 1-%s' % form_repeat)
+				if k == 0:
+					rec[Column.section_header.value] = 'Section %s%s' % (j,
+						' {{ s_iter }}' if section_repeat else '')
+					if section_repeat:
+						rpts.append ('section: 1-%s' % section_repeat)
+				if rpt_row:
+					rpts.append ('row: 1-%s' % row_repeat)
+				rec[Column.repeat.value] = '; '.join (rpts)
+
+				# vary the type of field
+				ftype = FIELD_TYPES[k % len (FIELD_TYPES)]
+				rec[Column.field_type.value] = ftype
+				if ftype == 'radio':
+					rec[Column.choices_calculations.value] = \
+						'{{ choices.yes_no_unknown }}'
+				elif ftype == 'dropdown':
+					if use_filters:
+						rec[Column.choices_calculations.value] = \
+							"{{ 'mild, moderate, severe' | delim_str_to_choices }}"
+					else:
+						rec[Column.choices_calculations.value] = \
+							'{{ choices.severity }}'
+
+				# show later rows only if the first in the section is filled
+				if 0 < k:
+					rec[Column.branching_logic.value] = "[f%ss%sr0%s] <> ''" % (
+						i, j, sect_sfx)
+
+				# spread tags over the rows
+				if n_tags and (k % 3 == 2):
+					rec[Column.tags.value] = 'tag%s' % (tag_cnt % n_tags)
+					tag_cnt += 1
+
+				recs.append (rec)
+
+	## Return:
+	return recs
+
+
+def write_compact_dd (recs, dd_pth, vars_pth=None):
+	"""
+	Write a synthetic compact dictionary (and its variables) to files.
+	"""
+	with open (dd_pth, 'w') as out_hndl:
+		wrtr = csv.DictWriter (out_hndl, fieldnames=ALL_NAMES)
+		wrtr.writeheader()
+		for r in recs:
+			wrtr.writerow (r)
+
+	if vars_pth:
+		with open (vars_pth, 'w') as out_hndl:
+			json.dump (make_vars(), out_hndl, indent=3)
+
+
+### END ###
@@ -15,15 +15,21 @@ setup(
    author_email='paul@agapow.net',
    url='http://www.agapow.net/software/simpleredcapbuilder',
    license='MIT',
-   packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
+   packages=find_packages(exclude=['ez_setup', 'examples', 'tests',
+      'benchmarks', 'benchmarks.*']),
    include_package_data=True,
    zip_safe=False,
+   python_requires='>=3.7',
    install_requires=[
       'jinja2',
    ],
+   extras_require={
+      'excel': ['openpyxl', 'xlrd'],
+   },
    entry_points={
       'console_scripts': [
          'expand-redcap-schema = simpleredcapbuilder.scripts.expand:main',
+         'serve-redcap-schema = simpleredcapbuilder.scripts.serve:main',
       ],
    },
 )
@@ -1,17 +1,58 @@
-#
+"""
+Expand compact REDCap data dictionaries.
 
-from __future__ import unicode_literals
-from __future__ import print_function
-from __future__ import division
-from __future__ import absolute_import
-from future import standard_library
-standard_library.install_aliases()
+The public names of the submodules can all be imported from here, but each
+submodule is only imported when one of its names is first used. So importing
+the package (e.g. to run the command-line scripts) doesn't pull in Jinja and
+the other libraries needed for rendering until they are actually needed.
+
+"""
 
 __version__ = '0.5.3'
 
 
 from . import consts
-from .expddreader import *
-from .render import *
-from .validation import *
-from .extvars import *
+
+# the submodule that each public name comes from
+_EXPORTS = {
+	'record': ['Record', 'has_template_code'],
+	'expddreader': ['ExpDataDictReader'],
+	'render': ['ExpandDbSchema', 'AlertUndefined', 'Renderer', 'repeat_expr',
+		'compile_template', 'template_name', 'render_template',
+		'render_template_to_file', 'render_template_job'],
+	'direct': ['DirectExpander', 'ExpandedRow', 'RowWriter', 'StaticRow',
+		'iter_expanded_rows', 'make_row_writer', 'write_rows'],
+	'validation': ['PreValidator', 'PostValidator'],
+	'rules': ['Rule', 'RuleSet', 'rule', 'select_rules', 'RULES'],
+	'extvars': ['ext_from_path', 'ext_to_format', 'parse_ext_vars'],
+	'cache': ['ExpansionCache', 'SingleFileBytecodeCache',
+		'take_new_bytecode'],
+	'structure': ['iter_source_rows', 'json_default', 'write_json',
+		'dump_structure', 'load_structure'],
+	'variants': ['Variant', 'read_variants'],
+	'incremental': ['FormStore', 'DiskFormStore', 'IncrementalExpander'],
+	'watch': ['FileWatcher'],
+	'diagnostics': ['Diagnostic', 'Diagnostics', 'collecting',
+		'get_diagnostics', 'report', 'REPORT_FORMATS'],
+	'profiling': ['Profiler', 'NULL_PROFILER'],
+}
+
+_NAME_TO_MODULE = dict ((n, m) for m, names in _EXPORTS.items() for n in names)
+
+__all__ = ['consts'] + [n for names in _EXPORTS.values() for n in names]
+
+
+def __getattr__ (name):
+	mod_name = _NAME_TO_MODULE.get (name, None)
+	if mod_name is None:
+		raise AttributeError ("module '%s' has no attribute '%s'" % (__name__,
+			name))
+	import importlib
+	val = getattr (importlib.import_module ('.' + mod_name, __name__), name)
+	# keep it, so this is only called once for each name
+	globals()[name] = val
+	return val
+
+
+def __dir__ ():
+	return sorted (set (globals()) | set (__all__))
@@ -0,0 +1,252 @@
+"""
+Cache parsed structures and compiled templates between runs.
+
+The same compact data dictionary is often expanded many times with different
+tags or included variables. Parsing, pre-validating and compiling the result
+is the same each time, so this allows it to be done once and reused. Entries
+are keyed on the content of the input file, the options it was read with and
+the version of this package, so any change in these gives a fresh entry.
+
+A structure is kept with the problems found in reading it, so that they are
+reported again when it is reused. As each edit of the input makes new
+entries, only the most recently used are kept, older ones being pruned as new
+ones are saved.
+
+"""
+
+### IMPORTS
+
+import hashlib
+import os
+import pickle
+import sys
+
+from jinja2 import BytecodeCache
+
+from . import __version__
+
+__all__ = [
+	'ExpansionCache',
+	'SingleFileBytecodeCache',
+	'take_new_bytecode',
+]
+
+
+### CONSTANTS & DEFINES
+
+_STRUCT_EXT = '.struct.pickle'
+_BYTECODE_EXT = '.bytecode.pickle'
+_FORMS_DIR = 'forms'
+
+# how many structures (and files of templates) are kept
+DEFAULT_MAX_ENTRIES = 20
+
+
+### CODE ###
+
+class SingleFileBytecodeCache (BytecodeCache):
+	"""
+	A Jinja bytecode cache that keeps all its templates in a single file.
+
+	Direct expansion compiles every distinct cell as its own template, which
+	would mean a great many tiny files with Jinja's own filesystem cache. This
+	holds them all in one dictionary, read lazily and written by `flush`.
+
+	"""
+	def __init__ (self, pth):
+		self.pth = pth
+		self.buckets = None
+		self.dirty = False
+		# templates compiled here since last taken, to pass back from a worker
+		self.new = {}
+
+	def __getstate__ (self):
+		# sent to a worker process, which reads the file itself if need be
+		return {'pth': self.pth, 'buckets': None, 'dirty': False, 'new': {}}
+
+	def _load (self):
+		if self.buckets is None:
+			try:
+				with open (self.pth, 'rb') as in_hndl:
+					self.buckets = pickle.load (in_hndl)
+				_touch (self.pth)
+			except Exception:
+				# missing or unreadable, so start afresh
+				self.buckets = {}
+
+	def load_bytecode (self, bucket):
+		self._load()
+		code = self.buckets.get (bucket.key, None)
+		if code is not None:
+			bucket.bytecode_from_string (code)
+
+	def dump_bytecode (self, bucket):
+		self._load()
+		code = bucket.bytecode_to_string()
+		self.buckets[bucket.key] = code
+		self.new[bucket.key] = code
+		self.dirty = True
+
+	def take_new (self):
+		"""
+		Return the templates compiled since last asked, and forget them.
+
+		Templates compiled in a worker process are written by the parent, so
+		are taken from the worker's cache and given to the parent's to `merge`.
+		"""
+		new, self.new = self.new, {}
+		return new
+
+	def merge (self, buckets):
+		"""
+		Add templates compiled elsewhere, as returned by `take_new`.
+		"""
+		if buckets:
+			self._load()
+			self.buckets.update (buckets)
+			self.dirty = True
+
+	def clear (self):
+		self.buckets = {}
+		self.dirty = True
+
+	def flush (self):
+		"""
+		Write any newly compiled templates to disk.
+		"""
+		if self.dirty:
+			_atomic_pickle (self.buckets, self.pth)
+			self.dirty = False
+
+
+class ExpansionCache (object):
+	"""
+	An on-disk store of parsed structures and compiled templates.
+
+	Params:
+		cache_dir (str): where the entries are kept
+		max_entries (int): how many of each kind of entry to keep
+
+	"""
+	def __init__ (self, cache_dir, max_entries=DEFAULT_MAX_ENTRIES):
+		self.cache_dir = cache_dir
+		self.max_entries = max_entries
+		if not os.path.isdir (cache_dir):
+			os.makedirs (cache_dir)
+
+	def key (self, in_pth, **opts):
+		"""
+		Make the cache key for an input file read with the given options.
+		"""
+		hasher = hashlib.sha1()
+		hdr = "%s|%s|%s" % (__version__, sys.version_info[:2],
+			sorted (opts.items()))
+		hasher.update (hdr.encode ('utf-8'))
+		with open (in_pth, 'rb') as in_hndl:
+			for blk in iter (lambda: in_hndl.read (1 << 16), b''):
+				hasher.update (blk)
+		return hasher.hexdigest()
+
+	def path_for (self, key, ext):
+		return os.path.join (self.cache_dir, key + ext)
+
+	def load_structure (self, key):
+		"""
+		Return the cached structure for this key and the problems found in it.
+
+		Returns:
+			the structure and a list of `Diagnostic`, or None if there isn't one
+
+		"""
+		pth = self.path_for (key, _STRUCT_EXT)
+		try:
+			with open (pth, 'rb') as in_hndl:
+				db_schema, diags = pickle.load (in_hndl)
+		except Exception:
+			return None
+		_touch (pth)
+		return db_schema, diags
+
+	def save_structure (self, key, db_schema, diags=()):
+		"""
+		Keep a structure and the problems found in reading it, pruning old ones.
+		"""
+		_atomic_pickle ((db_schema, list (diags)),
+			self.path_for (key, _STRUCT_EXT))
+		self.prune()
+
+	def prune (self):
+		"""
+		Remove all but the most recently used structures and templates.
+
+		Entries are used when they are read or written, so those of inputs
+		that have since been edited are removed first.
+		"""
+		by_ext = dict ((e, []) for e in (_STRUCT_EXT, _BYTECODE_EXT))
+		for fname in os.listdir (self.cache_dir):
+			for ext, entries in by_ext.items():
+				if fname.endswith (ext):
+					pth = os.path.join (self.cache_dir, fname)
+					try:
+						entries.append ((os.path.getmtime (pth), pth))
+					except OSError:
+						# removed by another run
+						pass
+		for entries in by_ext.values():
+			entries.sort (reverse=True)
+			for mtime, pth in entries[self.max_entries:]:
+				try:
+					os.remove (pth)
+				except OSError:
+					pass
+
+	def bytecode_cache (self, key):
+		"""
+		Return a Jinja bytecode cache for the templates made from this input.
+		"""
+		return SingleFileBytecodeCache (self.path_for (key, _BYTECODE_EXT))
+
+	def form_store (self, in_pth):
+		"""
+		Return the store of expanded forms for an input file.
+
+		Unlike the other entries, this is keyed on where the input is rather
+		than what is in it, so that it survives the input being edited.
+		"""
+		# imported here, as the store itself uses this module
+		from .incremental import DiskFormStore
+		loc = os.path.abspath (in_pth).encode ('utf-8')
+		return DiskFormStore (os.path.join (self.cache_dir, _FORMS_DIR,
+			hashlib.sha1 (loc).hexdigest()))
+
+
+def take_new_bytecode (bytecode_cache):
+	"""
+	Return the templates newly compiled into a bytecode cache, if it keeps them.
+
+	This is for passing templates compiled in a worker process back to be
+	saved by the parent, so gives nothing for other kinds of cache.
+	"""
+	if isinstance (bytecode_cache, SingleFileBytecodeCache):
+		return bytecode_cache.take_new()
+	return {}
+
+
+def _atomic_pickle (obj, pth):
+	# write to the side and then move over the old file in one step, so
+	# neither a crash nor a reader sees half a file or none
+	tmp_pth = '%s.%s.tmp' % (pth, os.getpid())
+	with open (tmp_pth, 'wb') as out_hndl:
+		pickle.dump (obj, out_hndl, pickle.HIGHEST_PROTOCOL)
+	os.replace (tmp_pth, pth)
+
+
+def _touch (pth):
+	# mark an entry as used, so it's kept in pruning
+	try:
+		os.utime (pth, None)
+	except OSError:
+		pass
+
+
+### END ###
@@ -4,13 +4,6 @@ Module-wide constants.
 
 ### IMPORTS
 
-from __future__ import unicode_literals
-from __future__ import print_function
-from __future__ import division
-from __future__ import absolute_import
-from future import standard_library
-standard_library.install_aliases()
-
 from enum import Enum
 
 
@@ -68,8 +61,11 @@ ALL_NAMES = [x.value for x in ALL_COLS]
 META_COLS = ALL_COLS[:2]
 OUTPUT_COLS = ALL_COLS[3:]
 
-MANDATORY_COLS = (getattr (Column, x) for x in ['variable', 'form_name',
-	'field_type', 'field_label'])
+MANDATORY_COLS = [getattr (Column, x) for x in ['variable', 'form_name',
+	'field_type', 'field_label']]
+
+# what marks the start of template code in a cell
+TEMPLATE_DELIMS = ('{{', '{%', '{#')
 
 
 # types of items in the produced schema
@@ -0,0 +1,328 @@
+"""
+Collect the warnings and errors found in reading, expanding and validating.
+
+Rather than each problem being printed as it is found, it is reported to a
+`Diagnostics` collector as a structured record: a code for the kind of
+problem, its severity, the variable, column and row it was found in (and
+whether that is a row of the input or of the expanded output), and a
+message. The same problem reported again (as happens when rows are repeated)
+is counted rather than stored twice. A collector can echo the problems as
+text, written in batches, and save them all as text, JSON or JUnit XML.
+
+Problems go to the collector in use by the current thread, which is set with
+`collecting`. Otherwise they go to a default collector that echoes to the
+console.
+
+"""
+
+### IMPORTS
+
+import atexit
+import contextlib
+import sys
+import threading
+
+__all__ = [
+	'Diagnostic',
+	'Diagnostics',
+	'collecting',
+	'get_diagnostics',
+	'report',
+	'REPORT_FORMATS',
+]
+
+
+### CONSTANTS & DEFINES
+
+ERROR = 'error'
+WARNING = 'warning'
+
+REPORT_FORMATS = ['text', 'json', 'junit']
+
+# the kinds of row a problem can be found in: a row of the compact input, or
+# of the expanded output
+INPUT_ROW = 'input'
+OUTPUT_ROW = 'output'
+
+DEFAULT_BATCH_SIZE = 100
+
+# the collectors in use by each thread
+_LOCAL = threading.local()
+
+
+### CODE ###
+
+class Diagnostic (object):
+	"""
+	A problem found in a data dictionary.
+
+	Attributes:
+		code (str): the kind of problem, e.g. 'duplicate-id'
+		severity (str): 'error' or 'warning'
+		message (str): a description of the problem
+		variable (str): the variable of the record it was found in, if any
+		column (str): the column it was found in, if any
+		row (int): the row of the file it was found in, if known
+		row_kind (str): whether the row is of the input (`INPUT_ROW`) or the
+			expanded output (`OUTPUT_ROW`), if known
+		count (int): how many times it has been reported
+
+	"""
+	__slots__ = ('code', 'severity', 'message', 'variable', 'column', 'row',
+		'row_kind', 'count')
+
+	def __init__ (self, severity, message, code=None, variable=None,
+			column=None, row=None, row_kind=None):
+		self.severity = severity
+		self.message = message
+		self.code = code
+		self.variable = variable
+		self.column = column
+		self.row = row
+		self.row_kind = row_kind
+		self.count = 1
+
+	def __repr__ (self):
+		return 'Diagnostic (%r)' % self.as_dict()
+
+	@property
+	def key (self):
+		"""
+		What makes a problem the same as another.
+		"""
+		return (self.severity, self.code, self.variable, self.column,
+			self.message)
+
+	def as_dict (self):
+		return dict ((k, getattr (self, k)) for k in self.__slots__)
+
+	def as_text (self):
+		"""
+		Describe the problem as a line of text, as it was printed before.
+		"""
+		if self.variable is not None:
+			if self.severity == ERROR:
+				msg = "Record %s is invalid: %s" % (self.variable, self.message)
+			else:
+				msg = "Record %s is possibly invalid: %s" % (self.variable,
+					self.message)
+		else:
+			msg = self.message
+		return "%s: %s" % (self.severity.upper(), msg)
+
+	def row_text (self):
+		"""
+		Describe the row the problem was found in, e.g. 'input row 3'.
+		"""
+		if self.row is None:
+			return 'row ?'
+		if self.row_kind is None:
+			return 'row %s' % self.row
+		return '%s row %s' % (self.row_kind, self.row)
+
+
+class Diagnostics (object):
+	"""
+	A collector of problems.
+
+	Params:
+		echo (bool): write each new problem as text
+		out_hndl (file): where to echo problems, by default the console
+		batch_size (int): how many problems to hold before echoing them
+
+	Problems that are echoed are buffered and written in batches. Call `flush`
+	to write any still held, e.g. before printing anything else.
+
+	"""
+	def __init__ (self, echo=False, out_hndl=None, batch_size=DEFAULT_BATCH_SIZE):
+		self.echo = echo
+		self.out_hndl = out_hndl
+		self.batch_size = batch_size
+		self.diags = []
+		self._index = {}
+		self._pending = []
+		self._lock = threading.Lock()
+
+	def __len__ (self):
+		return len (self.diags)
+
+	def __iter__ (self):
+		return iter (self.diags)
+
+	def report (self, severity, message, code=None, variable=None,
+			column=None, row=None, row_kind=None):
+		"""
+		Record a problem, counting it if it has been reported before.
+		"""
+		diag = Diagnostic (severity, message, code=code, variable=variable,
+			column=column, row=row, row_kind=row_kind)
+		with self._lock:
+			prev = self._index.get (diag.key, None)
+			if prev is not None:
+				prev.count += 1
+				return prev
+			self._index[diag.key] = diag
+			self.diags.append (diag)
+			if self.echo:
+				self._pending.append (diag.as_text())
+				if self.batch_size <= len (self._pending):
+					self._flush()
+		return diag
+
+	def extend (self, diags):
+		"""
+		Add problems collected elsewhere (e.g. in another process).
+
+		Returns the problems as held here, which are those already collected
+		where they are the same.
+		"""
+		held = []
+		with self._lock:
+			for d in diags:
+				prev = self._index.get (d.key, None)
+				if prev is not None:
+					prev.count += d.count
+					held.append (prev)
+					continue
+				self._index[d.key] = d
+				self.diags.append (d)
+				held.append (d)
+				if self.echo:
+					self._pending.append (d.as_text())
+			if self.batch_size <= len (self._pending):
+				self._flush()
+		return held
+
+	def recount (self, diags):
+		"""
+		Count problems already held here as being reported once more.
+		"""
+		with self._lock:
+			for d in diags:
+				d.count += 1
+
+	def warn (self, message, **kwargs):
+		return self.report (WARNING, message, **kwargs)
+
+	def error (self, message, **kwargs):
+		return self.report (ERROR, message, **kwargs)
+
+	@property
+	def errors (self):
+		return [d for d in self.diags if d.severity == ERROR]
+
+	@property
+	def warnings (self):
+		return [d for d in self.diags if d.severity == WARNING]
+
+	def flush (self):
+		"""
+		Write any problems waiting to be echoed.
+		"""
+		with self._lock:
+			self._flush()
+
+	def _flush (self):
+		if self._pending:
+			out_hndl = self.out_hndl or sys.stdout
+			out_hndl.write ('\n'.join (self._pending) + '\n')
+			out_hndl.flush()
+			self._pending = []
+
+	def as_dict (self):
+		return {
+			'errors': len (self.errors),
+			'warnings': len (self.warnings),
+			'diagnostics': [d.as_dict() for d in self.diags],
+		}
+
+	def write (self, out_pth, fmt='text'):
+		"""
+		Save all the problems found, as text, JSON or JUnit XML.
+		"""
+		assert fmt in REPORT_FORMATS, "unrecognised report format '%s'" % fmt
+		if fmt == 'junit':
+			from xml.etree import ElementTree
+			tree = ElementTree.ElementTree (self.as_junit())
+			tree.write (out_pth, encoding='utf-8', xml_declaration=True)
+		else:
+			with open (out_pth, 'w') as out_hndl:
+				if fmt == 'json':
+					import json
+					json.dump (self.as_dict(), out_hndl, indent=3,
+						ensure_ascii=False)
+				else:
+					for d in self.diags:
+						out_hndl.write (d.as_text() + '\n')
+
+	def as_junit (self):
+		"""
+		Return the problems as a JUnit test suite, for CI tools to display.
+
+		Each problem is a test case, those of errors failing.
+		"""
+		from xml.etree import ElementTree
+		suite = ElementTree.Element ('testsuite', {
+			'name': 'simpleredcapbuilder',
+			'tests': str (len (self.diags)),
+			'failures': str (len (self.errors)),
+			'errors': '0',
+		})
+		for d in self.diags:
+			case = ElementTree.SubElement (suite, 'testcase', {
+				'classname': d.code or d.severity,
+				'name': '%s (%s)' % (d.variable or '', d.row_text()),
+			})
+			if d.severity == ERROR:
+				fail = ElementTree.SubElement (case, 'failure', {
+					'type': d.code or d.severity,
+					'message': d.message,
+				})
+				fail.text = d.as_text()
+			else:
+				out = ElementTree.SubElement (case, 'system-out')
+				out.text = d.as_text()
+		return suite
+
+
+# problems go here if nothing else is collecting them
+_DEFAULT = Diagnostics (echo=True)
+atexit.register (_DEFAULT.flush)
+
+
+def get_diagnostics ():
+	"""
+	Return the collector in use by this thread.
+	"""
+	stack = getattr (_LOCAL, 'stack', None)
+	return stack[-1] if stack else _DEFAULT
+
+
+@contextlib.contextmanager
+def collecting (diags=None):
+	"""
+	Send the problems found in this thread to a collector, yielding it.
+
+	If a collector isn't given, a new one is made that collects silently.
+	"""
+	if diags is None:
+		diags = Diagnostics()
+	stack = getattr (_LOCAL, 'stack', None)
+	if stack is None:
+		stack = _LOCAL.stack = []
+	stack.append (diags)
+	try:
+		yield diags
+	finally:
+		stack.pop()
+		diags.flush()
+
+
+def report (severity, message, **kwargs):
+	"""
+	Report a problem to the collector in use.
+	"""
+	return get_diagnostics().report (severity, message, **kwargs)
+
+
+### END ###
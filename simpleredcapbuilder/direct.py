@@ -0,0 +1,544 @@
+"""
+Expand the structure of a compact data dictionary directly into rows.
+
+Rather than writing the structure out as a Jinja template, reading it back in
+and rendering it in one piece, this walks the forms / sections / rows of the
+parsed structure, deciding repeats and tag selection in Python and rendering
+only the templated cells of each row. The result is a stream of output records
+that can go straight to a CSV writer and the post-validator.
+
+Most templated cells only substitute values (e.g. ``q_{{ r_iter }}``), and
+these are rendered by looking the values up, without compiling a template
+(see `render.Substitution`). The cells of any other row are compiled together
+into one template, which loops over the repeats of the row, so the row is
+rendered in a single call however many cells and repeats it has. The cells
+are separated in the output by control characters and split apart again.
+
+Note that because rows are rendered separately, template code can't span
+several rows or cells and the only loop variables available are ``f_iter``,
+``s_iter`` and ``r_iter``.
+
+Rows are classified when read as static (no template code in any output
+column) or templated. Only the templated cells of a row are rendered. A static
+row is made once, with its line of CSV, and that is given for every repeat of
+it, so it never goes near Jinja and can be written out as it is.
+
+"""
+
+### IMPORTS
+
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import csv
+import io
+import re
+
+from . import consts
+from . import jext
+from .expddreader import ExpDataDictReader
+from .diagnostics import collecting, get_diagnostics
+from .cache import take_new_bytecode
+from .render import Renderer, Substitution
+
+__all__ = [
+	'DirectExpander',
+	'ExpandedRow',
+	'RowWriter',
+	'StaticRow',
+	'iter_expanded_rows',
+	'make_row_writer',
+	'write_rows',
+]
+
+
+### CONSTANTS & DEFINES
+
+OUTPUT_NAMES = [x.value for x in consts.OUTPUT_COLS]
+VARIABLE_NAME = consts.Column.variable.value
+
+# what separates the cells and repeats of a rendered row
+CELL_SEP = '\x1f'
+REPEAT_SEP = '\x1e'
+
+# the name the repeats of a row are passed to its template as
+_REPEATS_NAME = '_row_repeats'
+
+# a single trailing newline, which Jinja drops from a template
+_TRAILING_NEWLINE_RE = re.compile (r'(\r\n|\r|\n)\Z')
+
+
+### CODE ###
+
+class ExpandedRow (dict):
+	"""
+	An expanded record, keyed by the output column names.
+
+	The row of the input it was expanded from is given as ``source_row``
+	rather than in the record, so the record holds only what is written out.
+	"""
+	__slots__ = ('source_row',)
+
+	def __init__ (self, vals=(), source_row=None):
+		dict.__init__ (self, vals)
+		self.source_row = source_row
+
+
+class StaticRow (ExpandedRow):
+	"""
+	An expanded record that needs no rendering, with its line of CSV.
+
+	The same object is given by the expander for every repeat of the row it
+	came from, so shouldn't be altered. Rows given to callers by
+	`iter_expanded_rows` are copies, which may be.
+	"""
+	__slots__ = ('line',)
+
+
+class DirectExpander (object):
+	"""
+	Expand a parsed compact data dictionary straight into output records.
+
+	Records are yielded as dicts keyed by the output column names, in the
+	same order as they would appear in the rendered template. Each is an
+	`ExpandedRow`, giving the row of the input it was expanded from as its
+	``source_row``, which lets problems be traced to that row. If asked to,
+	the expander tallies the rows emitted by each form (by its unexpanded
+	name) and within each repeat loop (by the qualifiers and unexpanded names
+	of the form and repeated item).
+
+	The repeats of a static row are all the same `StaticRow`, which is to be
+	written out or read but not altered.
+
+	"""
+	def __init__ (self, render_vals={}, inc_tags=False, exc_tags=False,
+			bytecode_cache=None, count_rows=False, renderer=None):
+		assert not (inc_tags and exc_tags), "cannot have included and excluded tags"
+		self.inc_tags, self.exc_tags = inc_tags, exc_tags
+		self.bytecode_cache = bytecode_cache
+
+		# cells are compiled by the renderer, which may be shared
+		self.renderer = renderer or Renderer (bytecode_cache=bytecode_cache)
+		self.env = self.renderer.env
+
+		# copy so as not to disturb the caller's values
+		self.render_vals = dict (render_vals)
+
+		if count_rows:
+			self.form_counts, self.loop_counts = Counter(), Counter()
+		else:
+			self.form_counts = self.loop_counts = None
+
+		self._static_rows = {}
+		self._row_tmpls = {}
+
+	def for_tags (self, inc_tags=False, exc_tags=False):
+		"""
+		Return an expander for another tag selection.
+
+		The new expander shares this one's environment and compiled cells, so
+		several selections can be expanded without compiling anything twice.
+		"""
+		assert not (inc_tags and exc_tags), "cannot have included and excluded tags"
+		xpndr = copy.copy (self)
+		xpndr.inc_tags, xpndr.exc_tags = inc_tags, exc_tags
+		if self.form_counts is not None:
+			xpndr.form_counts, xpndr.loop_counts = Counter(), Counter()
+		return xpndr
+
+	def expand (self, db_schema, jobs=1):
+		"""
+		Yield the expanded records for every form in the structure.
+
+		Params:
+			db_schema (list): the parsed structure, a list of forms
+			jobs (int): if more than one, expand forms in this many processes
+
+		Forms are independent of each other, so can be expanded in parallel.
+		The results are yielded in the original form order, giving the same
+		records as expanding them one after another.
+
+		"""
+		if 1 < jobs:
+			for rows in self.expand_by_form (db_schema, jobs=jobs):
+				for r in rows:
+					yield r
+		else:
+			for f in db_schema:
+				for r in self.expand_form (f):
+					yield r
+
+	def expand_by_form (self, db_schema, jobs=1):
+		"""
+		Yield the list of expanded records for each form in turn.
+
+		With more than one job, forms are expanded in a pool of processes.
+		"""
+		if 1 < jobs:
+			pending = deque()
+			with ProcessPoolExecutor (max_workers=jobs,
+					initializer=_init_worker,
+					initargs=(self.render_vals, self.bytecode_cache,
+						self.form_counts is not None)) as executor:
+				# only a few forms are waited on at once, so they can be read
+				# as they are expanded
+				for f in db_schema:
+					pending.append (executor.submit (_expand_form_job,
+						(f, self.inc_tags, self.exc_tags)))
+					while (2 * jobs) < len (pending):
+						yield self.merge_form_job (pending.popleft())
+				while pending:
+					yield self.merge_form_job (pending.popleft())
+		else:
+			for f in db_schema:
+				yield list (self.expand_form (f))
+
+	def merge_form_job (self, future):
+		"""
+		Return the records of a form expanded in a worker, taking in the rest.
+
+		The problems, counts and compiled templates of the worker are added to
+		this expander's.
+		"""
+		rows, form_counts, loop_counts, diags, bytecode = future.result()
+		get_diagnostics().extend (diags)
+		if self.form_counts is not None:
+			self.form_counts.update (form_counts)
+			self.loop_counts.update (loop_counts)
+		if bytecode:
+			self.bytecode_cache.merge (bytecode)
+		return rows
+
+	def expand_form (self, f):
+		assert f['type'] == 'form', "expected form but got '%s'" % f['type']
+		if not self.is_selected (f):
+			return
+		self.curr_form_name = f['name']
+		loops = ('form:%s' % f['name'],) if f['repeat'] else ()
+		# static rows and row templates made in this form, by the identity of
+		# their source
+		self._static_rows = {}
+		self._row_tmpls = {}
+
+		base_ctx = {'tags': self.inc_tags or self.exc_tags}
+		for ctx in self.iter_repeat (f, 'f_iter', base_ctx):
+			for x in f['contents']:
+				dtype = x.get ('type', None)
+				if dtype == 'row':
+					rows = self.expand_item (x, ctx, loops)
+				elif dtype == 'section':
+					rows = self.expand_section (x, ctx, loops)
+				else:
+					assert False, "unrecognised type '%s'" % dtype
+				for r in rows:
+					yield r
+
+	def expand_section (self, s, ctx, loops=()):
+		assert s['type'] == 'section', "expected section but got '%s'" % s['type']
+		if not self.is_selected (s):
+			return
+		if s['repeat']:
+			loops = loops + ('form:%s / section:%s' % (self.curr_form_name,
+				s['name']),)
+
+		for s_ctx in self.iter_repeat (s, 's_iter', ctx):
+			for x in s['contents']:
+				assert x['type'] == 'row', "expected row but got '%s'" % x['type']
+				for r in self.expand_item (x, s_ctx, loops):
+					yield r
+
+	def expand_item (self, itm, ctx, loops=()):
+		assert itm['type'] == 'row', "expected row but got '%s'" % itm['type']
+		if not self.is_selected (itm):
+			return
+
+		for r in self.render_repeats (itm, ctx):
+			yield r
+
+		if self.form_counts is not None:
+			self.count_item (itm, loops)
+
+	def count_item (self, itm, loops=(), times=1):
+		"""
+		Add the rows a row gives (each time it is reached) to the tallies.
+		"""
+		cnt = (len (itm['repeat']) if itm['repeat'] else 1) * times
+		self.form_counts[self.curr_form_name] += cnt
+		if itm['repeat']:
+			loops = loops + ('form:%s / row:%s' % (self.curr_form_name,
+				itm[VARIABLE_NAME]),)
+		for l in loops:
+			self.loop_counts[l] += cnt
+
+	def count_form (self, f):
+		"""
+		Add the rows a form gives to the tallies, without expanding it.
+
+		This gives the same counts as expanding the form, so forms that
+		aren't expanded here (e.g. when rendering a template) can be counted.
+		"""
+		if (self.form_counts is None) or not self.is_selected (f):
+			return
+		self.curr_form_name = f['name']
+		loops = ('form:%s' % f['name'],) if f['repeat'] else ()
+		f_times = len (f['repeat']) if f['repeat'] else 1
+		for x in f['contents']:
+			if not self.is_selected (x):
+				continue
+			if x['type'] == 'row':
+				self.count_item (x, loops, f_times)
+				continue
+			s_loops = loops
+			if x['repeat']:
+				s_loops = loops + ('form:%s / section:%s' % (f['name'],
+					x['name']),)
+			s_times = f_times * (len (x['repeat']) if x['repeat'] else 1)
+			for itm in x['contents']:
+				if self.is_selected (itm):
+					self.count_item (itm, s_loops, s_times)
+
+	def iter_repeat (self, item, iter_name, ctx):
+		"""
+		Yield the template context for each repeat of an item.
+
+		An item without repeats is visited once, with the context unchanged.
+		"""
+		if item['repeat']:
+			for x in item['repeat']:
+				new_ctx = dict (ctx)
+				new_ctx[iter_name] = x
+				yield new_ctx
+		else:
+			yield ctx
+
+	def is_selected (self, item):
+		"""
+		Should this item be included, given the selected tags?
+		"""
+		if item['tags']:
+			if self.inc_tags:
+				return jext.are_any_tags_selected (item['tags'], self.inc_tags)
+			elif self.exc_tags:
+				return not jext.are_any_tags_selected (item['tags'],
+					self.exc_tags)
+		return True
+
+	def render_repeats (self, itm, ctx):
+		"""
+		Return the records for every repeat of a row.
+
+		Rows whose cells only substitute values have each cell rendered
+		directly, and any others are rendered in one call of a row template.
+		"""
+		tmpl_cols = getattr (itm, 'templated', None)
+		if tmpl_cols is None:
+			tmpl_cols = itm.classify()
+		cnt = len (itm['repeat']) if itm['repeat'] else 1
+		if not tmpl_cols:
+			return [self.static_row (itm)] * cnt
+
+		base, subs, tmpl = self.row_template (itm, tmpl_cols)
+		src_row = getattr (itm, 'row_num', None)
+		render_vals = self.render_vals
+		if subs is not None:
+			recs = []
+			for r_ctx in self.iter_repeat (itm, 'r_iter', ctx):
+				rec = ExpandedRow (base, src_row)
+				for n, c in subs:
+					rec[n] = c.render (render_vals, **r_ctx)
+				recs.append (rec)
+			return recs
+
+		out = tmpl.render (render_vals, **dict (ctx,
+			**{_REPEATS_NAME: itm['repeat']}))
+		rendered = out.split (REPEAT_SEP)
+		recs = []
+		# the last is empty, as each repeat is terminated
+		if len (rendered) == cnt + 1:
+			for r in rendered[:-1]:
+				cells = r.split (CELL_SEP)
+				if len (cells) != len (tmpl_cols):
+					break
+				rec = ExpandedRow (base, src_row)
+				rec.update (zip (tmpl_cols, cells))
+				recs.append (rec)
+		if len (recs) != cnt:
+			# a value holds a separator, so render the cells one at a time
+			recs = [self.render_row (itm, r_ctx) for r_ctx in
+				self.iter_repeat (itm, 'r_iter', ctx)]
+		return recs
+
+	def row_template (self, itm, tmpl_cols):
+		"""
+		Return how the templated cells of a row are rendered, made only once.
+
+		Returns:
+			the untemplated values of the row, the templated cells as
+			substitutions if they all are (or None), and otherwise a template
+			rendering every repeat of the row, each as its cells joined by
+			`CELL_SEP` and followed by `REPEAT_SEP`
+
+		"""
+		entry = self._row_tmpls.get (id (itm), None)
+		if entry is None:
+			base = dict ((n, itm[n]) for n in OUTPUT_NAMES)
+			subs = [(n, self.renderer.compile_cell (itm[n])) for n in tmpl_cols]
+			tmpl = None
+			if not all (isinstance (c, Substitution) for n, c in subs):
+				subs = None
+				# as when compiled alone, each cell loses a trailing newline
+				cells = [_TRAILING_NEWLINE_RE.sub ('', itm[n]) for n in tmpl_cols]
+				src = CELL_SEP.join (cells) + REPEAT_SEP
+				if itm['repeat']:
+					src = '{%% for r_iter in %s %%}%s{%% endfor %%}' % (
+						_REPEATS_NAME, src)
+				tmpl = self.renderer.compile (src)
+			# the row is kept, so that its identity isn't reused
+			entry = (itm, base, subs, tmpl)
+			self._row_tmpls[id (itm)] = entry
+		return entry[1:]
+
+	def render_row (self, itm, ctx):
+		"""
+		Return the record for one repeat of a row, rendering each cell alone.
+		"""
+		tmpl_cols = getattr (itm, 'templated', None)
+		if tmpl_cols is None:
+			tmpl_cols = itm.classify()
+		if not tmpl_cols:
+			return self.static_row (itm)
+		rec = ExpandedRow (((n, itm[n]) for n in OUTPUT_NAMES),
+			getattr (itm, 'row_num', None))
+		for n in tmpl_cols:
+			rec[n] = self.render_cell (itm[n], ctx)
+		return rec
+
+	def static_row (self, itm):
+		"""
+		Return the record for a row without template code, made only once.
+		"""
+		rec = self._static_rows.get (id (itm), None)
+		if rec is None:
+			rec = StaticRow (((n, itm[n]) for n in OUTPUT_NAMES),
+				getattr (itm, 'row_num', None))
+			rec.line = format_row ([itm[n] for n in OUTPUT_NAMES])
+			self._static_rows[id (itm)] = rec
+		return rec
+
+	def render_cell (self, val, ctx):
+		if not val:
+			return val
+		return self.renderer.compile_cell (val).render (self.render_vals,
+			**ctx)
+
+
+def iter_expanded_rows (in_pth, inc_tags=None, exc_tags=None, render_vals={},
+		extra_cols=True, jobs=1):
+	"""
+	Read a compact data dictionary and yield each expanded record in turn.
+
+	Params:
+		in_pth (str): path to the compact data dictionary, CSV or Excel
+		inc_tags (seq): only include untagged items or those with these tags
+		exc_tags (seq): exclude items with these tags
+		render_vals (dict): external variables for use in the templates
+		extra_cols (bool): allow extra columns in the input
+		jobs (int): if more than one, expand forms in this many processes
+
+	Returns:
+		a generator of final REDCap records, dicts keyed by column name (as
+		an `ExpandedRow`, giving the input row each came from)
+
+	Records are produced one at a time as the input is read and expanded: each
+	form is expanded as soon as it has been read, so memory use doesn't grow
+	with the size of the input or the repeats, and consumers can start work
+	before the expansion is finished. Each record is a dict of its own, which
+	the caller is free to alter.
+
+	"""
+	rdr = ExpDataDictReader()
+	forms = rdr.iter_forms (in_pth, extra_cols=extra_cols)
+	xpndr = DirectExpander (render_vals, inc_tags=inc_tags, exc_tags=exc_tags)
+	for r in xpndr.expand (forms, jobs=jobs):
+		# the repeats of a static row are shared, so are given as copies
+		if r.__class__ is StaticRow:
+			r = ExpandedRow (r, r.source_row)
+		yield r
+
+
+# the expander used by each process when expanding in parallel
+_worker_xpndr = None
+
+def _init_worker (render_vals, bytecode_cache, count_rows):
+	global _worker_xpndr
+	_worker_xpndr = DirectExpander (render_vals, bytecode_cache=bytecode_cache,
+		count_rows=count_rows)
+
+
+def _expand_form_job (task):
+	form, inc_tags, exc_tags = task
+	xpndr = _worker_xpndr.for_tags (inc_tags=inc_tags, exc_tags=exc_tags)
+	# problems found in the worker are passed back, to be reported there
+	with collecting() as diags:
+		rows = list (xpndr.expand_form (form))
+	# as are newly compiled templates, to be saved there
+	return (rows, xpndr.form_counts, xpndr.loop_counts, list (diags),
+		take_new_bytecode (xpndr.bytecode_cache))
+
+
+class RowWriter (object):
+	"""
+	Write expanded records as CSV, static rows as their ready-made lines.
+
+	This follows the formatting of a rendered template: every field is quoted
+	and lines are terminated with a bare newline.
+	"""
+	def __init__ (self, out_hndl):
+		self.out_hndl = out_hndl
+		self.dict_wrtr = csv.DictWriter (out_hndl,
+			fieldnames=OUTPUT_NAMES,
+			extrasaction='ignore',
+			quoting=csv.QUOTE_ALL,
+			lineterminator='\n',
+		)
+
+	def writeheader (self):
+		self.dict_wrtr.writeheader()
+
+	def writerow (self, rec):
+		line = getattr (rec, 'line', None)
+		if line is None:
+			self.dict_wrtr.writerow (rec)
+		else:
+			self.out_hndl.write (line)
+
+
+def format_row (vals, lineterminator='\n'):
+	"""
+	Return a list of values as a line of CSV, as written for expanded records.
+	"""
+	buf = io.StringIO()
+	csv.writer (buf, quoting=csv.QUOTE_ALL,
+		lineterminator=lineterminator).writerow (vals)
+	return buf.getvalue()
+
+
+def make_row_writer (out_hndl):
+	"""
+	Return a CSV writer for expanded records, with the header already written.
+	"""
+	wrtr = RowWriter (out_hndl)
+	wrtr.writeheader()
+	return wrtr
+
+
+def write_rows (recs, out_hndl):
+	"""
+	Write expanded records as a REDCap data dictionary.
+	"""
+	wrtr = make_row_writer (out_hndl)
+	for r in recs:
+		wrtr.writerow (r)
+
+
+### END ###
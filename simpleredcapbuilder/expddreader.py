@@ -15,27 +15,18 @@ Thinking this problem out loud:
 
 ### IMPORTS
 
-from __future__ import unicode_literals
-from __future__ import print_function
-from __future__ import division
-from __future__ import absolute_import
-from builtins import range
-from builtins import int
-from builtins import open
-from future import standard_library
-standard_library.install_aliases()
-from builtins import object
-
 import csv
 import os
 from ast import literal_eval as leval
 
 from . import consts
 from .consts import Column, ALL_NAMES, MANDATORY_COLS
+from .profiling import NULL_PROFILER
+from .record import Record
 from .validation import PreValidator
 from . import utils
 
-__ALL__ = [
+__all__ = [
 	'ExpDataDictReader',
 ]
 
@@ -44,17 +35,60 @@ __ALL__ = [
 
 ### CODE ###
 
-import pprint
-pp = pprint.PrettyPrinter (indent=2)
+class ExpDataDictReader (object):
+	"""
+	Read a compact data dictionary and parse out its structure.
+
+	Reading is a pipeline: rows are read from the file one at a time,
+	pre-processed and pre-validated as they come, and gathered into forms. Each
+	form is parsed as soon as its last row is read, so `iter_forms` only holds
+	one form at a time. `parse` gathers all the forms into the structure.
+
+	Params:
+		enable_rules (list): names of validation rules to run that otherwise
+			aren't
+		disable_rules (list): names of validation rules not to run
+		prevalidate_jobs (int): if more than one, check rows in this many
+			processes, a chunk at a time
+
+	"""
+	def __init__ (self, enable_rules=(), disable_rules=(), prevalidate_jobs=1):
+		self.enable_rules = enable_rules
+		self.disable_rules = disable_rules
+		self.prevalidate_jobs = prevalidate_jobs
+		self.pvalidator = None
+		self.rows_read = 0
+
+	def parse (self, in_pth, extra_cols=True, profiler=NULL_PROFILER):
+		"""
+		Read a compact data dictionary, returning its structure as a list of forms.
+		"""
+		# the stages are interleaved, so are measured as one
+		with profiler.stage ('read_parse') as stats:
+			forms = list (self.iter_forms (in_pth, extra_cols=extra_cols,
+				time_rules=(profiler is not NULL_PROFILER)))
+			stats['rows_in'] = self.rows_read
+			stats['rows_out'] = len (forms)
+		profiler.add_rule_times (self.pvalidator.rule_times())
 
-def pprint (x):
-	pp.pprint (x)
+		## Return:
+		return forms
 
+	def iter_forms (self, in_pth, extra_cols=True, time_rules=False):
+		"""
+		Read a compact data dictionary, yielding each form once it has been read.
 
-class ExpDataDictReader (object):
+		Params:
+			in_pth (str): path to the compact data dictionary, CSV or Excel
+			extra_cols (bool): allow extra columns in the input
+			time_rules (bool): keep the time taken by each validation rule
 
-	def parse (self, in_pth, extra_cols=True):
-		fieldnames, recs = self.read_file (in_pth)
+		Rows are pre-validated as they are read, so problems are reported as
+		the forms are yielded. If pre-validated in several processes, the
+		problems in a chunk of rows are reported once it has been checked.
+
+		"""
+		fieldnames, rows = self.iter_file (in_pth)
 
 		# a bit of pre-pre-validation before pre-processing ...
 		# ... if extra columns not allowed, check they aren't there
@@ -66,62 +100,154 @@ class ExpDataDictReader (object):
 		for c in MANDATORY_COLS:
 			assert c.value in fieldnames, "missing required column '%s'" % c.value
 
-		# parse out structured fields
-		proc_recs = [self.pre_process (r) for r in recs]
-
-		# now prevalidate
-		pvalidator = PreValidator()
-		pvalidator.check (proc_recs)
+		self.pvalidator = PreValidator (enable=self.enable_rules,
+			disable=self.disable_rules, timed=time_rules)
+		if 1 < self.prevalidate_jobs:
+			recs = self.pvalidator.iter_checked (self.iter_records (rows),
+				jobs=self.prevalidate_jobs)
+		else:
+			recs = self.iter_records (rows, self.pvalidator)
+		for form_recs in self.iter_form_recs (recs):
+			yield self.parse_form_recs (form_recs)
 
-		## Return:
-		return self.parse_all_recs (proc_recs)
+	def iter_records (self, rows, pvalidator=None):
+		"""
+		Pre-process (and pre-validate, if given a validator) rows as they come.
+		"""
+		self.rows_read = 0
+		for i, raw_rec in enumerate (rows):
+			r = self.pre_process (raw_rec)
+			# note the row of the file (after the header) it came from, and
+			# which columns need rendering
+			r.row_num = i + 2
+			r.classify()
+			if pvalidator:
+				pvalidator.check_rec (r)
+			self.rows_read += 1
+			yield r
+
+	def iter_form_recs (self, recs):
+		"""
+		Gather records into runs of the same form, yielding each when complete.
+		"""
+		form_col = consts.Column.form_name.value
+		curr_form_recs = []
+		for r in recs:
+			if curr_form_recs and (r[form_col] != curr_form_recs[0][form_col]):
+				yield curr_form_recs
+				curr_form_recs = []
+			curr_form_recs.append (r)
+		if curr_form_recs:
+			yield curr_form_recs
 
 	def read_file (self, in_pth):
+		"""
+		Read all the rows of a file, returning the fieldnames and rows.
+		"""
+		fieldnames, rows = self.iter_file (in_pth)
+		return (fieldnames, list (rows))
+
+	def iter_file (self, in_pth):
+		"""
+		Open a file for reading, returning the fieldnames and an iterator of rows.
+		"""
 		filetype = consts.FileType.from_path (in_pth)
 
 		if filetype is consts.FileType.csv:
-			# read csv file
-			with open (in_pth, 'r') as in_hndl:
-				rdr = csv.DictReader (in_hndl)
-				recs = [r for r in rdr]
-				return (rdr.fieldnames, recs)
+			rows = self.iter_csv (in_pth)
+		elif filetype is consts.FileType.xlsx:
+			rows = self.iter_xlsx (in_pth)
 		else:
-			# otherwise read excel file
-			# grab the first sheet
-			import xlrd
-			wb = xlrd.open_workbook (in_pth)
-			sht = wb.sheet_by_index (0)
+			rows = self.iter_xls (in_pth)
+
+		# each starts by giving the fieldnames
+		fieldnames = next (rows)
+		return (fieldnames, rows)
 
-			# work out dimensions
-			# TODO: bulletproof against excess cols & rows
-			# TODO: allow not all rows to be defined
-			col_cnt = sht.ncols
-			row_cnt = sht.nrows
+	def iter_csv (self, in_pth):
+		with open (in_pth, 'r') as in_hndl:
+			rdr = csv.DictReader (in_hndl)
+			yield rdr.fieldnames or []
+			for r in rdr:
+				yield r
 
-			# get fieldnames
-			fieldnames = [sht.cell (0, i).value for i in range (col_cnt)]
+	def iter_xlsx (self, in_pth):
+		"""
+		Read the first sheet of a modern Excel file.
 
-			# get records
-			recs = []
-			for i in range (1, row_cnt):
-				new_rec = {}
-				for j in range (col_cnt):
-					new_rec[fieldnames[j]] = sht.cell (i, j).value
-				recs.append (new_rec)
+		The sheet is streamed in read-only mode, a row of values at a time.
+		"""
+		import openpyxl
+		wb = openpyxl.load_workbook (in_pth, read_only=True, data_only=True)
+		try:
+			sht = wb.worksheets[0]
+			for r in self.iter_sheet_recs (sht.iter_rows (values_only=True)):
+				yield r
+		finally:
+			wb.close()
 
-			# return
-			return (fieldnames, recs)
+	def iter_xls (self, in_pth):
+		"""
+		Read the first sheet of a legacy Excel file.
+		"""
+		import xlrd
+		wb = xlrd.open_workbook (in_pth, on_demand=True)
+		try:
+			sht = wb.sheet_by_index (0)
+			rows = (sht.row_values (i) for i in range (sht.nrows))
+			for r in self.iter_sheet_recs (rows):
+				yield r
+		finally:
+			wb.release_resources()
+
+	def iter_sheet_recs (self, rows):
+		"""
+		Make records from the rows of a spreadsheet, the first being the header.
+
+		The fieldnames are yielded first, then each record. Spreadsheets often
+		have stray formatting that leaves empty rows after the data or empty
+		columns to the right of it. These are trimmed, columns being bounded by
+		the header and empty rows being held back until there is data after
+		them.
+		"""
+		rows = iter (rows)
+
+		# get fieldnames, trimming trailing empty columns
+		hdr_row = next (rows, None) or ()
+		hdr = [('' if c is None else str (c).strip()) for c in hdr_row]
+		while hdr and not hdr[-1]:
+			hdr.pop()
+		col_cnt = len (hdr)
+		yield hdr
+
+		# get records, filling any short rows
+		blank = ('',) * col_cnt
+		empty_rows = []
+		for r in rows:
+			if not any (c not in (None, '') for c in r):
+				empty_rows.append (r)
+				continue
+			for e in empty_rows + [r]:
+				vals = [('' if c is None else c) for c in e[:col_cnt]]
+				vals.extend (blank[len (vals):])
+				yield dict (zip (hdr, vals))
+			empty_rows = []
 
 	def pre_process (self, rec):
 		"""
 		Clean flanking whitespace, ensure rec has all fields and parse out structured new fields.
+
+		The raw row is copied into a compact `Record`, dropping any extra
+		columns, which play no further part.
 		"""
+		raw_rec = rec
+		rec = Record()
+
 		# make sure that every field in the record & strip flanking wspace
 		for f in consts.ALL_NAMES:
-			if f in rec.keys():
-				rec[f] = str (rec[f]).strip()
-			else:
-				rec[f] = ''
+			v = raw_rec.get (f, None)
+			if v is not None:
+				rec[f] = str (v).strip()
 
 		# now parse out the structured / metadata fields
 		try:
@@ -202,7 +328,8 @@ class ExpDataDictReader (object):
 				else:
 					assert '-' in v, "can't interpret '%s' as range" % v
 					start, stop = [int (x) for x in v.split ('-', 1)]
-					rpt_list = list (range (start, stop+1))
+					# a span is held lazily, rather than spelt out
+					rpt_list = range (start, stop+1)
 
 				md_dict[k] = rpt_list
 
@@ -215,34 +342,7 @@ class ExpDataDictReader (object):
 		"""
 		Parse records to return a list of forms.
 		"""
-		all_forms = []
-
-		curr_form = None
-		curr_form_recs = []
-		for r in recs:
-			new_form = r[consts.Column.form_name.value]
-			if curr_form:
-				# if already processing a form
-
-				if curr_form == new_form:
-					# if continuing new form
-					curr_form_recs.append (r)
-
-				else:
-					# if starting new form
-					all_forms.append (self.parse_form_recs (curr_form_recs))
-					curr_form = new_form
-					curr_form_recs = [r]
-
-			else:
-				# if it's the first record
-				curr_form = new_form
-				curr_form_recs = [r]
-
-		all_forms.append (self.parse_form_recs (curr_form_recs))
-
-		## Return:
-		return all_forms
+		return [self.parse_form_recs (r) for r in self.iter_form_recs (recs)]
 
 	def parse_form_recs (self, recs):
 		## Preconditions:
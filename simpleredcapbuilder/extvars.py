@@ -50,20 +50,13 @@ def parse_ext_vars (data, fmt):
 			raise RuntimeError ('no library for handling JSON-formatted data')
 
 	elif fmt == 'INI':
-		try:
-			# Python 2
-			import ConfigParser
-			import StringIO as io
-		except ImportError:
-			# Python 3
-			import configparser as ConfigParser
-			import io
+		import configparser
 
 		try:
-			rdr = ConfigParser.ConfigParser()
-			rdr.readfp (io.StringIO (data))
+			rdr = configparser.ConfigParser()
+			rdr.read_string (data)
 			vars = rdr._sections
-		except ConfigParser.Error as err:
+		except configparser.Error as err:
 			raise ValueError ("malformed INI '%s' ..." % data[:40])
 		except ImportError:
 			raise RuntimeError ('no library for handling JSON-formatted data')
@@ -71,7 +64,7 @@ def parse_ext_vars (data, fmt):
 	elif fmt == 'YAML':
 		import yaml
 		try:
-			vars = yaml.load (data)
+			vars = yaml.safe_load (data)
 		except yaml.YAMLError as err:
 			raise ValueError ("malformed YAML '%s' ..." % data[:40])
 		except ImportError:
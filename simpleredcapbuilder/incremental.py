@@ -0,0 +1,305 @@
+"""
+Re-expand only the forms that have changed since the last expansion.
+
+Editing a single field in a large compact dictionary shouldn't mean rendering
+every form again. Each form is given a fingerprint, made from its records, the
+external variables its cells refer to and the tag selection. The rows of each
+rendered form are kept in a store under that fingerprint, so the next time
+round only forms with a new fingerprint are rendered, the stored rows of the
+others being spliced into the output in their place. The problems found in
+rendering a form are stored with its rows, and reported again when they are
+reused.
+
+Forms are looked up one at a time, as they are reached, so neither the
+structure nor the stored forms need be held all at once.
+
+"""
+
+### IMPORTS
+
+from collections import deque
+import copy
+import hashlib
+import json
+import os
+import pickle
+
+from jinja2 import meta
+
+from . import __version__
+from . import jext
+from .cache import _atomic_pickle
+from .diagnostics import collecting, get_diagnostics, INPUT_ROW
+from .direct import OUTPUT_NAMES, ExpandedRow
+from .structure import iter_source_rows, json_default
+
+__all__ = [
+	'FormStore',
+	'DiskFormStore',
+	'IncrementalExpander',
+]
+
+
+### CONSTANTS & DEFINES
+
+_FORM_EXT = '.form.pickle'
+
+
+### CODE ###
+
+class FormStore (object):
+	"""
+	Expanded forms held in memory, keyed by fingerprint.
+
+	Rows are held as tuples of values in output column order, which are much
+	smaller than a dict per row, followed by the source row of each. The
+	problems found in rendering the form are held with them.
+	"""
+	def __init__ (self):
+		self.forms = {}
+
+	def has (self, fprint):
+		"""
+		Is there a form stored for this fingerprint?
+		"""
+		return fprint in self.forms
+
+	def get (self, fprint):
+		"""
+		Return the stored rows and problems for this fingerprint.
+
+		Returns:
+			a list of records and a list of `Diagnostic`, or None if there is
+			no form stored
+
+		"""
+		stored = self.load (fprint)
+		if not isinstance (stored, dict):
+			return None
+		# the source row follows the values
+		return ([ExpandedRow (zip (OUTPUT_NAMES, v), v[-1]) for v in
+			stored['rows']], stored['diags'])
+
+	def put (self, fprint, rows, diags=()):
+		self.save (fprint, {
+			'rows': [tuple (r.get (n, None) for n in OUTPUT_NAMES) +
+				(getattr (r, 'source_row', None),) for r in rows],
+			'diags': list (diags),
+		})
+
+	def load (self, fprint):
+		return self.forms.get (fprint, None)
+
+	def save (self, fprint, stored):
+		self.forms[fprint] = stored
+
+	def prune (self, keep):
+		"""
+		Discard every form but those with the given fingerprints.
+		"""
+		for k in set (self.forms) - set (keep):
+			del self.forms[k]
+
+
+class DiskFormStore (FormStore):
+	"""
+	Expanded forms kept between runs, a file per fingerprint in a directory.
+	"""
+	def __init__ (self, store_dir):
+		self.store_dir = store_dir
+		if not os.path.isdir (store_dir):
+			os.makedirs (store_dir)
+
+	def path_for (self, fprint):
+		return os.path.join (self.store_dir, fprint + _FORM_EXT)
+
+	def has (self, fprint):
+		return os.path.exists (self.path_for (fprint))
+
+	def load (self, fprint):
+		try:
+			with open (self.path_for (fprint), 'rb') as in_hndl:
+				return pickle.load (in_hndl)
+		except Exception:
+			# missing or unreadable, so will be rendered afresh
+			return None
+
+	def save (self, fprint, stored):
+		_atomic_pickle (stored, self.path_for (fprint))
+
+	def prune (self, keep):
+		keep_files = set (fp + _FORM_EXT for fp in keep)
+		for f in os.listdir (self.store_dir):
+			if f.endswith (_FORM_EXT) and f not in keep_files:
+				os.remove (os.path.join (self.store_dir, f))
+
+
+class IncrementalExpander (object):
+	"""
+	Expand a structure, reusing the stored rows of any unchanged forms.
+
+	Params:
+		xpndr (DirectExpander): renders the forms that have changed
+		store (FormStore): where expanded forms are kept between expansions
+
+	After an expansion, ``rendered`` and ``reused`` give the number of forms
+	that were rendered or taken from the store, and ``fingerprints`` all those
+	seen, for pruning the store.
+
+	"""
+	def __init__ (self, xpndr, store):
+		self.xpndr = xpndr
+		self.store = store
+		self.rendered = self.reused = 0
+		self.fingerprints = set()
+
+		# names of the variables referred to by each cell, keyed by source
+		self._cell_names = {}
+
+	@property
+	def form_counts (self):
+		return self.xpndr.form_counts
+
+	@property
+	def loop_counts (self):
+		return self.xpndr.loop_counts
+
+	def for_tags (self, inc_tags=False, exc_tags=False):
+		"""
+		Return an incremental expander for another tag selection.
+
+		This shares the store, the fingerprints seen and the parsed cells with
+		this one.
+		"""
+		other = IncrementalExpander (self.xpndr.for_tags (inc_tags=inc_tags,
+			exc_tags=exc_tags), self.store)
+		other._cell_names = self._cell_names
+		other.fingerprints = self.fingerprints
+		return other
+
+	def expand (self, db_schema, jobs=1):
+		"""
+		Yield the expanded records for every form in the structure.
+
+		Changed forms are rendered (in parallel if there is more than one job)
+		and stored, the records of every form being yielded in the original
+		order. Forms are read and looked up as they are reached, only the
+		changed forms being read ahead, to be rendered while the forms before
+		them are yielded.
+		"""
+		forms = iter (db_schema)
+		# forms read but not yet yielded, and those of them still to be rendered
+		waiting = deque()
+		to_render = deque()
+
+		def read_form ():
+			f = next (forms, None)
+			if f is not None:
+				fp = self.fingerprint (f)
+				self.fingerprints.add (fp)
+				is_stored = self.store.has (fp)
+				waiting.append ((f, fp, is_stored))
+				if not is_stored:
+					to_render.append (f)
+			return f
+
+		def iter_changed ():
+			while True:
+				if to_render:
+					yield to_render.popleft()
+				elif read_form() is None:
+					return
+
+		rendered = self.xpndr.expand_by_form (iter_changed(), jobs=jobs)
+		while waiting or (read_form() is not None):
+			f, fp, is_stored = waiting.popleft()
+			# rows are stored with their place in the form, not the file, as
+			# the form may have moved, and so are the problems found in them
+			src_rows = [getattr (itm, 'row_num', None) for itm in
+				iter_source_rows (f)]
+			stored = self.store.get (fp) if is_stored else None
+			if stored is None:
+				with collecting() as diags:
+					if is_stored:
+						# gone or unreadable since it was looked up
+						rows = list (self.xpndr.expand_form (f))
+					else:
+						rows = next (rendered)
+				get_diagnostics().extend (diags)
+				to_place = dict ((n, i) for i, n in enumerate (src_rows) if n is
+					not None)
+				self.store.put (fp, _swap_source (rows, to_place),
+					_swap_diag_rows (diags, to_place))
+				self.rendered += 1
+			else:
+				rows, diags = stored
+				to_row = dict (enumerate (src_rows))
+				rows = _swap_source (rows, to_row)
+				get_diagnostics().extend (_swap_diag_rows (diags, to_row))
+				self.reused += 1
+				self.xpndr.count_form (f)
+			for r in rows:
+				yield r
+
+	def fingerprint (self, f):
+		"""
+		Return a digest of everything the expansion of a form depends on.
+		"""
+		hasher = hashlib.sha1()
+		hdr = "%s|%r|%r" % (__version__, self.xpndr.inc_tags,
+			self.xpndr.exc_tags)
+		hasher.update (hdr.encode ('utf-8'))
+		hasher.update (json.dumps (f, sort_keys=True,
+			default=json_default).encode ('utf-8'))
+
+		# only the variables used by the form matter
+		render_vals = self.xpndr.render_vals
+		for n in sorted (self.referenced_names (f)):
+			if n in render_vals and n not in jext.EXT_DICT:
+				val = json.dumps (render_vals[n], sort_keys=True, default=repr)
+				hasher.update (("|%s=%s" % (n, val)).encode ('utf-8'))
+
+		## Return:
+		return hasher.hexdigest()
+
+	def referenced_names (self, f):
+		"""
+		Return the names of the variables used in any cell of a form.
+		"""
+		names = set()
+		for itm in iter_source_rows (f):
+			for n in OUTPUT_NAMES:
+				val = itm[n]
+				if not val:
+					continue
+				cell_names = self._cell_names.get (val, None)
+				if cell_names is None:
+					ast = self.xpndr.env.parse (val)
+					cell_names = meta.find_undeclared_variables (ast)
+					self._cell_names[val] = cell_names
+				names.update (cell_names)
+		return names
+
+
+def _swap_source (rows, source_map):
+	"""
+	Return copies of rows with their source rows mapped to something else.
+	"""
+	return [ExpandedRow (r, source_map.get (getattr (r, 'source_row', None),
+		None)) for r in rows]
+
+
+def _swap_diag_rows (diags, row_map):
+	"""
+	Return copies of problems with the input rows they were found in mapped.
+	"""
+	new_diags = []
+	for d in diags:
+		if d.row_kind == INPUT_ROW:
+			d = copy.copy (d)
+			d.row = row_map.get (d.row, None)
+		new_diags.append (d)
+	return new_diags
+
+
+### END ###
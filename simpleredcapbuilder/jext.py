@@ -6,7 +6,11 @@ Jinja extensions.
 
 import re
 
-import jinja2
+try:
+	from markupsafe import Markup
+except ImportError:
+	# older Jinja carried its own
+	from jinja2 import Markup
 
 
 ### CONSTANTS & DEFINES
@@ -17,6 +21,11 @@ FILTER_DICT = {}
 SPACE_PATT = re.compile ('[]\s\.\-\:\/]+')
 BRACKETED_PATT = re.compile (r'\([^\)]+\)')
 
+# choices strings already made, keyed by source and flags, as the same choices
+# are made for every repeat of a row
+_CHOICES_CACHE = {}
+_CHOICES_CACHE_MAX = 1000
+
 
 ### CODE ###
 
@@ -49,10 +58,14 @@ def delim_str_to_choices (delim_str, del_bracketed=True, cap_label=True):
 	cannot contain commas.
 
 	"""
-	# split source string
-	str_list = [s.strip() for s in delim_str.split (',')]
-	vocab_str = str_list_to_choices (str_list, del_bracketed=del_bracketed,
-		cap_label=cap_label)
+	key = (delim_str, del_bracketed, cap_label)
+	vocab_str = _CHOICES_CACHE.get (key, None)
+	if vocab_str is None:
+		# split source string
+		str_list = [s.strip() for s in delim_str.split (',')]
+		vocab_str = str_list_to_choices (str_list, del_bracketed=del_bracketed,
+			cap_label=cap_label)
+		_cache_choices (key, vocab_str)
 
 	## Return:
 	return vocab_str
@@ -86,6 +99,9 @@ def str_list_to_choices (str_list, del_bracketed=True, cap_label=True):
 
 	Finally, you can explicitly provide a value-label pair (as a sequnec)
 
+	As the same choices are often used for many rows, or a row repeated many
+	times, the result is remembered for each list and set of flags.
+
 	"""
 	## Preconditions:
 	assert type (str_list) in (list, tuple), \
@@ -93,6 +109,20 @@ def str_list_to_choices (str_list, del_bracketed=True, cap_label=True):
 	assert 2 <= len (str_list), "need at least two choices"
 
 	## Main:
+	key = (tuple ((tuple (x) if type (x) in (list, tuple) else x) for x in
+		str_list), del_bracketed, cap_label)
+	vocab_str = _CHOICES_CACHE.get (key, None)
+	if vocab_str is None:
+		vocab_str = _make_choices (str_list, del_bracketed, cap_label)
+		_cache_choices (key, vocab_str)
+
+	## Return:
+	return vocab_str
+
+FILTER_DICT['str_list_to_choices'] = str_list_to_choices
+
+
+def _make_choices (str_list, del_bracketed, cap_label):
 	# derive value string and format label
 	choice_prs = []
 	for lbl in str_list:
@@ -123,12 +153,13 @@ def str_list_to_choices (str_list, del_bracketed=True, cap_label=True):
 
 	# make vocab str
 	vocab_list = ['%s, %s' % (c[0], c[1]) for c in choice_prs]
-	vocab_str = jinja2.Markup (' | '.join (vocab_list))
+	return Markup (' | '.join (vocab_list))
 
-	## Return:
-	return vocab_str
 
-FILTER_DICT['str_list_to_choices'] = str_list_to_choices
+def _cache_choices (key, vocab_str):
+	if _CHOICES_CACHE_MAX <= len (_CHOICES_CACHE):
+		_CHOICES_CACHE.clear()
+	_CHOICES_CACHE[key] = vocab_str
 
 
 ### END ###
@@ -0,0 +1,135 @@
+"""
+Measure the stages of an expansion: time, memory and the rows produced.
+
+On big studies it's useful to see which stage is the bottleneck and which forms
+blow up in expansion. A `Profiler` records, for each stage, the wall and CPU
+time taken, optionally the peak memory allocated (via `tracemalloc`) and the
+number of rows going in and out. It also tallies the rows emitted by each form
+and within each repeat loop, and the time taken by each validation rule.
+
+Tracing memory slows everything down (often several times over), so the
+times of a profile with memory traced are only good for comparing with each
+other. The report says whether memory was traced.
+
+"""
+
+### IMPORTS
+
+from collections import Counter
+import contextlib
+import time
+
+__all__ = [
+	'Profiler',
+	'NULL_PROFILER',
+]
+
+
+### CONSTANTS & DEFINES
+
+### CODE ###
+
+class Profiler (object):
+	"""
+	Record the costs of each stage of an expansion.
+
+	Params:
+		trace_memory (bool): record the peak memory of each stage, which
+			slows every stage
+
+	Stages should not be nested, as the memory peak is reset for each.
+	"""
+	def __init__ (self, trace_memory=False):
+		self.stages = []
+		self.form_counts = Counter()
+		self.loop_counts = Counter()
+		self.rule_times = {}
+		self.trace_memory = trace_memory
+		if trace_memory:
+			# only imported when used, as it pulls in a lot
+			import tracemalloc
+			if not tracemalloc.is_tracing():
+				tracemalloc.start()
+
+	@contextlib.contextmanager
+	def stage (self, name, rows_in=None, **details):
+		"""
+		Measure a stage, yielding a dict that ``rows_out`` can be set on.
+		"""
+		stats = {'name': name, 'rows_in': rows_in, 'rows_out': None}
+		stats.update (details)
+		if self.trace_memory:
+			import tracemalloc
+			tracemalloc.reset_peak()
+		wall_start = time.perf_counter()
+		cpu_start = time.process_time()
+		try:
+			yield stats
+		finally:
+			stats['wall_time'] = time.perf_counter() - wall_start
+			stats['cpu_time'] = time.process_time() - cpu_start
+			if self.trace_memory:
+				import tracemalloc
+				stats['peak_memory'] = tracemalloc.get_traced_memory()[1]
+			self.stages.append (stats)
+
+	def add_counts (self, form_counts=None, loop_counts=None):
+		"""
+		Add to the tallies of rows emitted per form and per repeat loop.
+		"""
+		if form_counts:
+			self.form_counts.update (form_counts)
+		if loop_counts:
+			self.loop_counts.update (loop_counts)
+
+	def add_rule_times (self, rule_times):
+		"""
+		Add to the time taken by each validation rule and the rows it checked.
+		"""
+		from .rules import merge_rule_times
+		self.rule_times = merge_rule_times (self.rule_times, rule_times)
+
+	def report (self):
+		return {
+			'stages': self.stages,
+			'total_wall_time': sum (s['wall_time'] for s in self.stages),
+			'total_cpu_time': sum (s['cpu_time'] for s in self.stages),
+			'rows_per_form': dict (self.form_counts),
+			'rows_per_loop': dict (self.loop_counts),
+			'rule_times': self.rule_times,
+			'memory_traced': self.trace_memory,
+		}
+
+	def write (self, out_pth):
+		"""
+		Save the report as JSON.
+		"""
+		import json
+		with open (out_pth, 'w') as out_hndl:
+			json.dump (self.report(), out_hndl, indent=3, ensure_ascii=False)
+
+	def stop (self):
+		if self.trace_memory:
+			import tracemalloc
+			tracemalloc.stop()
+
+
+class NullProfiler (object):
+	"""
+	A profiler that records nothing, for when no profiling is wanted.
+	"""
+	@contextlib.contextmanager
+	def stage (self, name, rows_in=None, **details):
+		yield {}
+
+	def add_counts (self, form_counts=None, loop_counts=None):
+		pass
+
+	def add_rule_times (self, rule_times):
+		pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+### END ###
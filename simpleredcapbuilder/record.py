@@ -0,0 +1,124 @@
+"""
+A compact representation of the rows read from a compact data dictionary.
+
+Records start out as dicts keyed by the (long) REDCap column headers, with
+every row carrying its own copy of every key. For large dictionaries that adds
+up, so once read, rows are held in a slotted object with one attribute per
+column. It still behaves as a mapping keyed by the column headers (or by the
+`Column` members), so templates, the CSV writer and validators can treat it
+as a dict.
+
+"""
+
+### IMPORTS
+
+from collections.abc import MutableMapping
+
+from .consts import ALL_COLS, ALL_NAMES, OUTPUT_COLS, TEMPLATE_DELIMS
+
+__all__ = [
+	'Record',
+	'has_template_code',
+]
+
+
+### CONSTANTS & DEFINES
+
+# the attributes of a record: one per column, plus the type of schema item
+_FIELDS = tuple (c.name for c in ALL_COLS) + ('type',)
+_KEYS = tuple (ALL_NAMES) + ('type',)
+
+_OUTPUT_FIELDS = tuple (c.name for c in OUTPUT_COLS)
+
+# map from any acceptable key (header or Column) to attribute
+_KEY_TO_FIELD = dict (zip (_KEYS, _FIELDS))
+_KEY_TO_FIELD.update (dict ((c, c.name) for c in ALL_COLS))
+
+
+### CODE ###
+
+class Record (MutableMapping):
+	"""
+	A row of a data dictionary, indexed by column.
+
+	Fields can be got or set by the column header (``rec['Field Type']``), the
+	column (``rec[Column.field_type]``) or as attributes (``rec.field_type``).
+	Only the recognised columns are held, so extra columns are dropped. The
+	row of the input file the record came from, if known, is kept as
+	``row_num``, and the output columns holding template code (once found by
+	`classify`) as ``templated``. Neither is one of the fields.
+
+	"""
+	__slots__ = _FIELDS + ('row_num', 'templated')
+
+	def __init__ (self, vals={}, row_num=None):
+		for f in _FIELDS:
+			setattr (self, f, '')
+		self.type = 'row'
+		self.row_num = row_num
+		self.templated = None
+		for k, v in vals.items():
+			self[k] = v
+
+	def __getitem__ (self, key):
+		try:
+			return getattr (self, _KEY_TO_FIELD[key])
+		except KeyError:
+			raise KeyError (key)
+
+	def __setitem__ (self, key, val):
+		try:
+			setattr (self, _KEY_TO_FIELD[key], val)
+		except KeyError:
+			raise KeyError ("unrecognised column '%s'" % key)
+
+	def __delitem__ (self, key):
+		raise TypeError ("can't delete fields from a record")
+
+	def __contains__ (self, key):
+		return key in _KEY_TO_FIELD
+
+	def __iter__ (self):
+		return iter (_KEYS)
+
+	def __len__ (self):
+		return len (_KEYS)
+
+	def __repr__ (self):
+		return 'Record (%r)' % self.as_dict()
+
+	def get (self, key, default=None):
+		field = _KEY_TO_FIELD.get (key, None)
+		if field is None:
+			return default
+		return getattr (self, field)
+
+	def as_dict (self):
+		"""
+		Return the record as a plain dict, keyed by column header.
+		"""
+		return dict ((k, getattr (self, f)) for k, f in zip (_KEYS, _FIELDS))
+
+	def classify (self):
+		"""
+		Find which output columns hold template code, returning their headers.
+
+		A record where none do is static, and every expansion of it is the
+		same as the record itself.
+		"""
+		self.templated = tuple (c.value for c, f in zip (OUTPUT_COLS,
+			_OUTPUT_FIELDS) if has_template_code (getattr (self, f)))
+		return self.templated
+
+
+def has_template_code (val):
+	"""
+	Does this string contain anything that Jinja would treat as code?
+	"""
+	for d in TEMPLATE_DELIMS:
+		if d in val:
+			return True
+	return False
+
+
+### END ###
@@ -4,29 +4,47 @@ Take the structure of an compact data dictionary and use it to render a dd.
 
 ### IMPORTS
 
-from __future__ import print_function
-from __future__ import unicode_literals
-from __future__ import division
-from __future__ import absolute_import
-from builtins import object
-from builtins import open
-from future import standard_library
-standard_library.install_aliases()
-
+from collections import OrderedDict
+from concurrent.futures import Future
 import csv
+import hashlib
+import io
+import os
+import threading
 
-from jinja2 import Template, Undefined, StrictUndefined, DebugUndefined, Environment
+from jinja2 import Template, Undefined, Environment
+from jinja2 import FunctionLoader
 from jinja2 import exceptions as jexcept
+from jinja2 import nodes as jnodes
 
 from . import consts
 from . import jext
 from . import utils
+from .diagnostics import collecting
+
+__all__ = [
+	'ExpandDbSchema',
+	'AlertUndefined',
+	'Substitution',
+	'Renderer',
+	'repeat_expr',
+	'compile_template',
+	'template_name',
+	'render_template',
+	'render_template_to_file',
+	'render_template_job',
+]
 
 
 ### CONSTANTS & DEFINES
 
 _TEMPLATE_PTH = 'schema.tmp'
 
+DEFAULT_MAX_WHOLE_TEMPLATES = 32
+
+# names that mean something else in a template, so can't simply be looked up
+_SPECIAL_NAMES = frozenset (['self', 'loop', 'caller', 'varargs', 'kwargs'])
+
 
 ### CODE ###
 
@@ -39,20 +57,56 @@ class ExpandDbSchema (object):
 
 	def expand (self, db_schema, inc_tags=False, exc_tags=False,
 			out_pth=_TEMPLATE_PTH):
+		"""
+		Write the structure out as a template, returning it as read back.
+
+		The template only depends on whether tags are included or excluded, the
+		actual tags being selected at rendering. So a template written for one
+		set of tags can be rendered for any other set with the same mode.
+
+		The template is returned as it would be read from the file, so it
+		needn't be read back. A file that already holds the same template (as
+		when expanding an unchanged dictionary again) isn't written.
+		"""
+		buf = io.StringIO (newline='')
+		self.write_template (db_schema, buf, inc_tags=inc_tags,
+			exc_tags=exc_tags)
+		tmpl_str = buf.getvalue()
+		if not _file_holds (out_pth, tmpl_str):
+			with open (out_pth, 'w', newline='') as out_hndl:
+				out_hndl.write (tmpl_str)
+
+		## Return:
+		# with newlines translated, as in reading the file
+		return io.StringIO (tmpl_str, newline=None).getvalue()
+
+	def expand_to_str (self, db_schema, inc_tags=False, exc_tags=False):
+		"""
+		Return the structure as a template, without writing it to disk.
+
+		Newlines are translated as they would be by writing the template to a
+		file and reading it back.
+		"""
+		buf = io.StringIO (newline=None)
+		self.write_template (db_schema, buf, inc_tags=inc_tags,
+			exc_tags=exc_tags)
+		return buf.getvalue()
+
+	def write_template (self, db_schema, out_hndl, inc_tags=False,
+			exc_tags=False):
 		self.db_schema = db_schema
 		self.inc_tags, self.exc_tags = inc_tags, exc_tags
 		assert not (inc_tags and exc_tags), "cannot have included and excluded tags"
-		with open (out_pth, 'w') as out_hndl:
-			self.out_hndl = out_hndl
-			self.csv_writer = csv.DictWriter (out_hndl,
-				fieldnames=[x.value for x in consts.OUTPUT_COLS],
-				extrasaction='ignore',
-				quoting=csv.QUOTE_ALL,
-			)
-			self.csv_writer.writeheader()
-
-			for f in self.db_schema:
-				self.expand_form (f)
+		self.out_hndl = out_hndl
+		self.csv_writer = csv.DictWriter (out_hndl,
+			fieldnames=[x.value for x in consts.OUTPUT_COLS],
+			extrasaction='ignore',
+			quoting=csv.QUOTE_ALL,
+		)
+		self.csv_writer.writeheader()
+
+		for f in self.db_schema:
+			self.expand_form (f)
 
 	def expand_form (self, f):
 		assert f['type'] == 'form', "expected form but got '%s'" % f['type']
@@ -60,7 +114,8 @@ class ExpandDbSchema (object):
 
 		self.start_tags (f)
 		if f['repeat']:
-			self.write ("{%% for f_iter in %s -%%}\n" % f['repeat'])
+			self.write ("{%% for f_iter in %s -%%}\n" %
+				repeat_expr (f['repeat']))
 
 		for x in f['contents']:
 			dtype = x.get ('type', None)
@@ -81,7 +136,8 @@ class ExpandDbSchema (object):
 
 		self.start_tags (s)
 		if s['repeat']:
-			self.write ("{%% for s_iter in %s -%%}\n" % s['repeat'])
+			self.write ("{%% for s_iter in %s -%%}\n" %
+				repeat_expr (s['repeat']))
 
 		for x in s['contents']:
 			assert x['type'] == 'row', "expected row but got '%s'" % x['type']
@@ -96,7 +152,8 @@ class ExpandDbSchema (object):
 
 		self.start_tags (itm)
 		if itm['repeat']:
-			self.write ("{%% for r_iter in %s -%%}\n" % itm['repeat'])
+			self.write ("{%% for r_iter in %s -%%}\n" %
+				repeat_expr (itm['repeat']))
 
 		self.csv_writer.writerow (itm)
 
@@ -118,6 +175,17 @@ class ExpandDbSchema (object):
 			self.write ("{% endif -%}\n")
 
 
+def _file_holds (pth, text):
+	# does the file hold exactly this text? (only read if it could)
+	try:
+		if os.path.getsize (pth) < len (text):
+			return False
+		with open (pth, 'r', newline='') as in_hndl:
+			return in_hndl.read() == text
+	except (OSError, UnicodeDecodeError):
+		return False
+
+
 from jinja2 import Undefined
 
 class AlertUndefined (Undefined):
@@ -126,23 +194,341 @@ class AlertUndefined (Undefined):
 	'''
 	def _fail_with_undefined_error (self, *args, **kwargs):
 		utils.warn ("undefined or error in template script '%s / %s / %s" % \
-			(self._undefined_name, self._undefined_hint, self._undefined_obj))
+			(self._undefined_name, self._undefined_hint, self._undefined_obj),
+			code='undefined')
 		return None
 
 
-def render_template (tmpl_str, render_vals={}):
-	# XXX" ih, why is there a try / except here?
-	env = Environment (undefined=AlertUndefined)
-	env.filters.update (jext.FILTER_DICT)
-	template = env.from_string (tmpl_str)
-	render_vals.update (jext.EXT_DICT)
-
-	try:
-		rendered_tmpl = template.render (**render_vals)
-		return rendered_tmpl
-	except jexcept.UndefinedError as err:
-		print ('variable used in schema is undefined')
-		raise
+def repeat_expr (rpt):
+	"""
+	Return the template expression for a repeat, a list or a range.
+
+	Ranges are written as a call, so they are only expanded during rendering.
+	"""
+	if isinstance (rpt, range):
+		return "range (%s, %s)" % (rpt.start, rpt.stop)
+	else:
+		return "%s" % rpt
+
+
+class Substitution (object):
+	"""
+	A template that only substitutes values into text, rendered without Jinja.
+
+	Most templated cells are like this (e.g. ``q_{{ r_iter }}`` or
+	``{{ choices.yes_no }}``), and rendering them by looking the values up
+	directly avoids compiling a template for each cell and making a new
+	context for each call. The values are looked up, converted and reported
+	when undefined just as the compiled template would.
+
+	Params:
+		env (jinja2.Environment): the environment the template belongs to
+		parts (list): the text, and the values to substitute as a name and the
+			attributes or items to get from it in turn
+
+	"""
+	__slots__ = ('env', 'parts')
+
+	def __init__ (self, env, parts):
+		self.env = env
+		self.parts = parts
+
+	@classmethod
+	def from_source (cls, env, tmpl_str):
+		"""
+		Return the substitution for a template, or None if it does more.
+		"""
+		try:
+			tree = env.parse (tmpl_str)
+		except jexcept.TemplateSyntaxError:
+			# leave it to be reported when compiled
+			return None
+		parts = []
+		for out in tree.body:
+			if type (out) is not jnodes.Output:
+				return None
+			for n in out.nodes:
+				if type (n) is jnodes.TemplateData:
+					parts.append (n.data)
+				elif type (n) is jnodes.Const:
+					parts.append (str (n.value))
+				else:
+					path = _lookup_path (n)
+					if path is None:
+						return None
+					parts.append (path)
+		return cls (env, parts)
+
+	def render (self, *args, **kwargs):
+		"""
+		Render with the values given, as for `jinja2.Template.render`.
+		"""
+		env = self.env
+		vals = args[0] if args else {}
+		out = []
+		for p in self.parts:
+			if p.__class__ is str:
+				out.append (p)
+				continue
+			name, steps = p
+			if name in kwargs:
+				val = kwargs[name]
+			elif name in vals:
+				val = vals[name]
+			elif name in env.globals:
+				val = env.globals[name]
+			else:
+				val = env.undefined (name=name)
+			for is_attr, key in steps:
+				if is_attr:
+					val = env.getattr (val, key)
+				else:
+					val = env.getitem (val, key)
+			out.append (str (val))
+		return ''.join (out)
+
+
+def _lookup_path (node):
+	# a name followed by constant attributes and items, as (name, steps)
+	steps = []
+	while True:
+		if type (node) is jnodes.Getattr:
+			steps.append ((True, node.attr))
+		elif (type (node) is jnodes.Getitem) and \
+				(type (node.arg) is jnodes.Const):
+			steps.append ((False, node.arg.value))
+		else:
+			break
+		node = node.node
+	if (type (node) is not jnodes.Name) or (node.name in _SPECIAL_NAMES):
+		return None
+	steps.reverse()
+	return (node.name, tuple (steps))
+
+
+class Renderer (object):
+	"""
+	A configured Jinja environment, for rendering many templates and cells.
+
+	The filters, globals and undefined handling are set up once, and compiled
+	templates are kept (keyed by their source), so a long-lived renderer can
+	render expansions repeatedly with little per-call cost. It may be used
+	from several threads at once and doesn't alter the values passed to it.
+
+	Whole templates, which are large and few, are kept apart from the many
+	small templates of cells and rows, the least recently used being dropped
+	when there are too many. Templates are compiled outside of any lock that
+	others need, so one thread compiling a large template doesn't hold up the
+	rest; a thread wanting a template that another is compiling waits for it.
+
+	Params:
+		bytecode_cache (jinja2.BytecodeCache): where to store compiled
+			templates between runs
+		max_templates (int): the number of compiled cells and rows to keep
+		max_whole_templates (int): the number of whole templates to keep
+
+	"""
+	def __init__ (self, bytecode_cache=None, max_templates=10000,
+			max_whole_templates=DEFAULT_MAX_WHOLE_TEMPLATES):
+		self.bytecode_cache = bytecode_cache
+		self.max_templates = max_templates
+		self.max_whole_templates = max_whole_templates
+
+		# templates are loaded from the source being compiled (which is kept
+		# for each thread, as several may be compiling at once), and "named" by
+		# that source unless given a name, so that they can be found in a
+		# bytecode cache
+		self._loading = threading.local()
+		self.env = Environment (undefined=AlertUndefined,
+			loader=FunctionLoader (lambda name: self._loading.source),
+			bytecode_cache=bytecode_cache,
+			cache_size=0,
+		)
+		self.env.filters.update (jext.FILTER_DICT)
+		self.env.globals.update (jext.EXT_DICT)
+
+		# compiled cells and rows, and whole templates (oldest used first), keyed
+		# by their source, those being compiled held as a future
+		self._tmpls = {}
+		self._cells = {}
+		self._whole = OrderedDict()
+		self._lock = threading.Lock()
+
+	def compile (self, tmpl_str, name=None):
+		"""
+		Return the compiled template for this source.
+
+		A whole template should be given a name, to be identified by in errors,
+		and is kept with the other whole templates.
+		"""
+		if name is None:
+			return self._cached (self._tmpls, tmpl_str,
+				lambda: self._load (tmpl_str, tmpl_str))
+		return self._cached (self._whole, tmpl_str,
+			lambda: self._load (tmpl_str, name))
+
+	def compile_cell (self, tmpl_str):
+		"""
+		Return something to render a cell with, which may not be a template.
+
+		Cells that only substitute values are rendered as a `Substitution`,
+		and any others compiled as usual. Either has the `render` method of a
+		compiled template.
+		"""
+		return self._cached (self._cells, tmpl_str, lambda:
+			Substitution.from_source (self.env, tmpl_str) or
+			self.compile (tmpl_str))
+
+	def _load (self, tmpl_str, name):
+		# compile a template through the loader, so the bytecode cache is used
+		self._loading.source = tmpl_str
+		try:
+			return self.env.get_template (name)
+		finally:
+			self._loading.source = None
+
+	def _cached (self, cache, key, make):
+		"""
+		Return the entry for a key from a cache, making it if need be.
+
+		Only one thread makes an entry, outside the lock, any others wanting it
+		waiting for it. Whole templates are kept in least recently used order,
+		and other caches are emptied when full.
+		"""
+		is_lru = cache is self._whole
+		entry = None if is_lru else cache.get (key, None)
+		if entry is None:
+			with self._lock:
+				entry = cache.get (key, None)
+				if entry is None:
+					fut = Future()
+					if is_lru:
+						while self.max_whole_templates <= len (cache):
+							cache.popitem (last=False)
+					elif self.max_templates <= len (cache):
+						cache.clear()
+					cache[key] = fut
+				elif is_lru:
+					cache.move_to_end (key)
+			if entry is None:
+				try:
+					entry = make()
+				except BaseException as err:
+					with self._lock:
+						if cache.get (key, None) is fut:
+							del cache[key]
+					fut.set_exception (err)
+					raise
+				fut.set_result (entry)
+				with self._lock:
+					if cache.get (key, None) is fut:
+						cache[key] = entry
+				return entry
+		if isinstance (entry, Future):
+			entry = entry.result()
+		return entry
+
+	def render_template (self, tmpl_str, render_vals={}):
+		"""
+		Render a template, passed as a string or already compiled.
+		"""
+		if isinstance (tmpl_str, Template):
+			template = tmpl_str
+		else:
+			template = self.compile (tmpl_str, name=template_name (tmpl_str))
+
+		try:
+			return template.render (render_vals)
+		except jexcept.UndefinedError as err:
+			utils.error ("variable used in schema is undefined: %s" % err,
+				code='undefined')
+			raise
+
+	def render (self, db_schema, render_vals={}, inc_tags=None, exc_tags=None):
+		"""
+		Expand a parsed structure and render it as a REDCap data dictionary.
+
+		Params:
+			db_schema (list): the parsed structure, a list of forms
+			render_vals (dict): external variables for use in the templates
+			inc_tags (seq): only include untagged items or those with these tags
+			exc_tags (seq): exclude items with these tags
+
+		Returns:
+			the expanded data dictionary, as CSV text
+
+		"""
+		tmpl_str = ExpandDbSchema().expand_to_str (db_schema,
+			inc_tags=bool (inc_tags), exc_tags=bool (exc_tags))
+		vals = dict (render_vals)
+		vals['tags'] = inc_tags or exc_tags
+		return self.render_template (tmpl_str, vals)
+
+
+def compile_template (tmpl_str, bytecode_cache=None):
+	"""
+	Compile the expanded template, ready for rendering.
+
+	If a Jinja bytecode cache is passed, the compiled template is looked up
+	there and stored for later runs.
+	"""
+	return Renderer (bytecode_cache).compile (tmpl_str,
+		name=template_name (tmpl_str))
+
+
+def template_name (tmpl_str):
+	"""
+	Return the name a whole template is compiled under, made from its source.
+
+	Templates are stored in a bytecode cache by name, so each different
+	template (e.g. for including and for excluding tags) needs its own.
+	"""
+	return 'schema-%s' % hashlib.sha1 (tmpl_str.encode ('utf-8')).hexdigest()
+
+
+def render_template (tmpl_str, render_vals={}, bytecode_cache=None):
+	"""
+	Render the expanded template with the given values.
+
+	The template may be passed as a string or already compiled, so the same
+	template can be rendered many times (e.g. for several tag selections).
+	"""
+	return Renderer (bytecode_cache).render_template (tmpl_str, render_vals)
+
+
+def render_template_to_file (tmpl_str, render_vals, out_pth,
+		bytecode_cache=None):
+	"""
+	Render the expanded template with the given values and save the result.
+
+	This is the unit of work when rendering several variants in parallel, so
+	only passes small, picklable values in and out.
+	"""
+	exp_tmpl = render_template (tmpl_str, render_vals,
+		bytecode_cache=bytecode_cache)
+	with open (out_pth, 'w') as out_hndl:
+		out_hndl.write (exp_tmpl)
+	return out_pth
+
+
+def render_template_job (tmpl_str, render_vals, out_pth, bytecode_cache=None):
+	"""
+	Render a template to a file in another process.
+
+	The problems found can't be reported from the other process, and the
+	compiled template can't be saved from there, so both are passed back to
+	the caller.
+
+	Returns:
+		the problems found and any newly compiled templates, to be merged into
+		the caller's bytecode cache
+
+	"""
+	from .cache import take_new_bytecode
+	with collecting() as diags:
+		render_template_to_file (tmpl_str, render_vals, out_pth,
+			bytecode_cache=bytecode_cache)
+	return list (diags), take_new_bytecode (bytecode_cache)
 
 
 
@@ -0,0 +1,248 @@
+"""
+A registry of validation rules, compiled into a single pass over each row.
+
+Each rule is a function of one row, registered with `rule` under a name and
+the stages ('pre' for the compact input, 'post' for the expanded output) it
+applies to. A rule declares the columns it reads, which of them it wants with
+whitespace stripped or lowercased, and whether it depends on the rows before
+(``ordered``) or only on its own row's values (``source``, which allows it to
+be run once on an input row rather than on every row expanded from it).
+
+A `RuleSet` compiles the selected rules of a stage into one pass: the
+stripped and lowercased values wanted by any rule are made once for each row
+and shared between them, as a `RowView`. Each rule set can also time the
+rules it runs, for reporting with the other timings.
+
+The standard rules are those in `validation`, which are registered when it is
+imported.
+
+"""
+
+### IMPORTS
+
+import time
+
+__all__ = [
+	'Rule',
+	'RowView',
+	'RuleSet',
+	'rule',
+	'select_rules',
+	'merge_rule_times',
+	'RULES',
+	'STAGES',
+]
+
+
+### CONSTANTS & DEFINES
+
+STAGES = ['pre', 'post']
+
+# the registered rules by name, in the order they are run
+RULES = {}
+
+
+### CODE ###
+
+class Rule (object):
+	"""
+	A check of a row, with what it needs to be run.
+
+	Attributes:
+		name (str): what the rule is known as, e.g. in enabling it
+		check (callable): the check, called with a `RowView`
+		stages (tuple): the stages the rule is run in
+		columns (tuple): the columns the rule reads
+		stripped (tuple): those columns it wants with whitespace stripped
+		lowered (tuple): those columns it wants lowercased
+		source (bool): the rule only reads the values of its own row
+		ordered (bool): the rule depends on the rows before it
+		default (bool): the rule is run unless disabled
+		description (str): what the rule checks
+
+	"""
+	__slots__ = ('name', 'check', 'stages', 'columns', 'stripped', 'lowered',
+		'source', 'ordered', 'default', 'description')
+
+	def __init__ (self, name, check, stages, columns=(), stripped=(),
+			lowered=(), source=False, ordered=False, default=True,
+			description=None):
+		## Preconditions:
+		for s in stages:
+			assert s in STAGES, "unknown validation stage '%s'" % s
+
+		## Main:
+		self.name = name
+		self.check = check
+		self.stages = tuple (stages)
+		self.stripped = tuple (stripped)
+		self.lowered = tuple (lowered)
+		self.columns = _merge (columns, stripped, lowered)
+		self.source = source
+		self.ordered = ordered
+		self.default = default
+		if description is None:
+			description = (check.__doc__ or '').strip().split ('\n')[0]
+		self.description = description
+
+	def __repr__ (self):
+		return 'Rule (%r)' % self.name
+
+
+def rule (name, stages=('post',), **kwargs):
+	"""
+	Register a function as a rule, returning it unchanged.
+
+	Params:
+		name (str): the name of the rule, which must be unique
+		stages (tuple): the stages the rule is run in
+
+	Other keyword arguments are passed to `Rule`.
+
+	"""
+	def register (check):
+		assert name not in RULES, "rule '%s' is already registered" % name
+		RULES[name] = Rule (name, check, stages, **kwargs)
+		return check
+	return register
+
+
+def select_rules (stage, enable=(), disable=()):
+	"""
+	Return the rules run in a stage, in order.
+
+	Params:
+		stage (str): 'pre' or 'post'
+		enable (list): names of rules to run that are otherwise not run
+		disable (list): names of rules not to run
+
+	Names that aren't rules of any stage are an error, but those of rules of
+	another stage are ignored, so the same names can be given for both stages.
+
+	"""
+	## Preconditions:
+	assert stage in STAGES, "unknown validation stage '%s'" % stage
+	for n in list (enable) + list (disable):
+		assert n in RULES, "unknown validation rule '%s'" % n
+
+	## Main:
+	enable = frozenset (enable)
+	disable = frozenset (disable)
+	return [r for r in RULES.values() if (stage in r.stages) and
+		(r.default or (r.name in enable)) and (r.name not in disable)]
+
+
+class RowView (object):
+	"""
+	A row being checked, with the values shared between rules.
+
+	Attributes:
+		rec (Record or dict): the row
+		row (int): the row number to report problems at, if not that of the
+			record
+		row_kind (str): whether that row is of the input or the output (see
+			`diagnostics`)
+		validator (object): the validator checking the row, which holds the
+			state of ordered rules
+		stripped (dict): values with whitespace stripped, by column
+		lowered (dict): values lowercased, by column
+
+	"""
+	__slots__ = ('rec', 'row', 'row_kind', 'validator', 'stripped', 'lowered')
+
+	def __init__ (self, rec, row, row_kind, validator, stripped, lowered):
+		self.rec = rec
+		self.row = row
+		self.row_kind = row_kind
+		self.validator = validator
+		self.stripped = stripped
+		self.lowered = lowered
+
+
+class RuleSet (object):
+	"""
+	A selection of rules, compiled to be run together on each row.
+
+	Params:
+		rules (list): the rules, in the order they are run
+		timed (bool): keep the time taken by each rule
+		row_kind (str): whether the rows given to report problems at are of the
+			input or the output (see `diagnostics`)
+
+	"""
+	def __init__ (self, rules, timed=False, row_kind=None):
+		self.rules = list (rules)
+		self.row_kind = row_kind
+		self.checks = [r.check for r in self.rules]
+		self.columns = _merge (*[r.columns for r in self.rules])
+		self.stripped = _merge (*[r.stripped for r in self.rules])
+		self.lowered = _merge (*[r.lowered for r in self.rules])
+		self.timed = timed
+		self.times = [0.0] * len (self.rules)
+		self.calls = 0
+
+	def __len__ (self):
+		return len (self.rules)
+
+	def check (self, rec, row=None, validator=None):
+		"""
+		Run every rule on a row.
+
+		Params:
+			rec (Record or dict): the row
+			row (int): the row number to report problems at, if not that of
+				the record
+			validator (object): the validator checking the row
+
+		"""
+		view = RowView (rec, row, self.row_kind, validator,
+			{c: rec[c].strip() for c in self.stripped},
+			{c: rec[c].lower() for c in self.lowered})
+		self.calls += 1
+		if self.timed:
+			clock = time.perf_counter
+			times = self.times
+			start = clock()
+			for i, chk in enumerate (self.checks):
+				chk (view)
+				now = clock()
+				times[i] += now - start
+				start = now
+		else:
+			for chk in self.checks:
+				chk (view)
+
+	def rule_times (self):
+		"""
+		Return the time taken by each rule and the rows it was run on, if timed.
+		"""
+		if not self.timed:
+			return {}
+		return dict ((r.name, {'seconds': t, 'calls': self.calls}) for r, t in
+			zip (self.rules, self.times))
+
+
+def merge_rule_times (*all_times):
+	"""
+	Add up the times of rules, as returned by `RuleSet.rule_times`.
+	"""
+	totals = {}
+	for times in all_times:
+		for name, t in times.items():
+			tot = totals.setdefault (name, {'seconds': 0.0, 'calls': 0})
+			tot['seconds'] += t['seconds']
+			tot['calls'] += t['calls']
+	return totals
+
+
+def _merge (*col_lists):
+	# join lists of columns, keeping the first occurrence of each
+	cols = []
+	for cl in col_lists:
+		for c in cl:
+			if c not in cols:
+				cols.append (c)
+	return tuple (cols)
+
+
+### END ###
@@ -5,27 +5,21 @@ Convert a compact REDCap data dictionary to the full and proper form.
 
 ### IMPORTS
 
-### CONSTANTS & DEFINES
-
-from __future__ import unicode_literals
-from __future__ import print_function
-from __future__ import division
-from __future__ import absolute_import
-from builtins import open
-from future import standard_library
-standard_library.install_aliases()
-
-import csv
+# only what is needed to start is imported here, the rest (in particular,
+# Jinja and everything that renders) being imported by the stage that uses it
 import os
+import time
 
-from simpleredcapbuilder import __version__ as version
-from simpleredcapbuilder import ExpDataDictReader
-from simpleredcapbuilder import ExpandDbSchema, render_template
 from simpleredcapbuilder import consts
-from simpleredcapbuilder import PostValidator
-from simpleredcapbuilder import ext_from_path, ext_to_format, parse_ext_vars
-from simpleredcapbuilder import ext_from_path, ext_to_format, parse_ext_vars
-from simpleredcapbuilder.utils import pprint, progress
+from simpleredcapbuilder.diagnostics import Diagnostics, REPORT_FORMATS, \
+	collecting, get_diagnostics
+from simpleredcapbuilder.profiling import Profiler, NULL_PROFILER
+from simpleredcapbuilder.variants import Variant, read_variants
+from simpleredcapbuilder.extvars import ext_from_path, ext_to_format, \
+	parse_ext_vars
+from simpleredcapbuilder.utils import pprint, progress, error
+
+### CONSTANTS & DEFINES
 
 ### CODE ###
 
@@ -57,6 +51,20 @@ def parse_clargs ():
 		help='exclude items with this tag',
 	)
 
+	# batches of tag selections
+	aparser.add_argument ('-I', '--include-tag-set', action='append',
+		dest='include_tag_sets',
+		help='also expand a variant including this comma-separated set of tags',
+	)
+	aparser.add_argument ('-X', '--exclude-tag-set', action='append',
+		dest='exclude_tag_sets',
+		help='also expand a variant excluding this comma-separated set of tags',
+	)
+	aparser.add_argument ('--variants',
+		help='expand each of the variants listed in this file',
+		default=None,
+	)
+
 	# include external vars
 	aparser.add_argument ('-v', "--include-vars",
 		help='include external file of variables',
@@ -77,38 +85,178 @@ def parse_clargs ():
 		dest='extra_cols', action='store_false')
 	aparser.set_defaults (extra_cols=True)
 
+	# the parsed structure
+	aparser.add_argument ('--dump-structure',
+		choices=['none', 'pretty', 'compact'],
+		help='save the parsed structure as indented JSON, as JSON lines or '
+			'not at all',
+		default='pretty',
+	)
+	aparser.add_argument ('--from-structure', action='store_true',
+		help='the input is a structure saved with --dump-structure, to be '
+			'expanded without reading and validating the dictionary again',
+		default=False,
+	)
+
+	aparser.add_argument ('--validate-only', action='store_true',
+		help='only read and validate the input, without expanding it',
+		default=False,
+	)
+
+	# choosing validation rules
+	class ListRulesAction (argparse.Action):
+		def __call__ (self, parser, namespace, values, option_string=None):
+			print (describe_rules())
+			parser.exit()
+
+	aparser.add_argument ('--list-rules', action=ListRulesAction, nargs=0,
+		help='list the validation rules and exit',
+	)
+	aparser.add_argument ('--enable-rule', action='append',
+		dest='enable_rules', default=[],
+		help='also run this validation rule, which is otherwise not run',
+	)
+	aparser.add_argument ('--disable-rule', action='append',
+		dest='disable_rules', default=[],
+		help="don't run this validation rule",
+	)
+	aparser.add_argument ('--prevalidate-jobs', type=int,
+		help='check the rows of the input in this many processes',
+		default=1,
+	)
+
+	# how to expand
+	aparser.add_argument ('--direct', action='store_true',
+		help='expand the structure directly, without an intermediate template',
+		default=False,
+	)
+
+	aparser.add_argument ('-j', '--jobs', type=int,
+		help='render forms (or, with templates, variants) in this many processes',
+		default=1,
+	)
+
+	aparser.add_argument ('--timings',
+		help='save the time and rows of each stage to this JSON file',
+		default=None,
+	)
+	aparser.add_argument ('--trace-memory', action='store_true',
+		help='with --timings, also save the peak memory of each stage (which '
+			'slows every stage)',
+		default=False,
+	)
+
+	# caching between runs
+	aparser.add_argument ('--cache-dir',
+		help='cache parsed structures and compiled templates in this directory',
+		default=None,
+	)
+
+	aparser.add_argument ('--incremental', action='store_true',
+		help='only re-render forms that have changed since the last run '
+			'(implies --direct and keeps expanded forms in the cache directory)',
+		default=False,
+	)
+
+	# reporting problems
+	aparser.add_argument ('--report',
+		help='save the warnings and errors found to this file',
+		default=None,
+	)
+	aparser.add_argument ('--report-format', choices=REPORT_FORMATS,
+		help='format of the report of warnings and errors',
+		default='text',
+	)
+
+	aparser.add_argument ('--watch', action='store_true',
+		help='after expanding, watch the input and included variables and '
+			're-expand when they change (implies --direct)',
+		default=False,
+	)
+
 	# Parsing
 	args = aparser.parse_args()
 
+	if args.enable_rules or args.disable_rules:
+		# the standard rules are registered by importing the validators, which
+		# is only done when needed, rather than to give choices to the parser
+		from simpleredcapbuilder import validation
+		from simpleredcapbuilder.rules import RULES
+		for r in args.enable_rules + args.disable_rules:
+			if r not in RULES:
+				aparser.error ("unknown validation rule '%s' (see --list-rules)" %
+					r)
+
 	# find the root file name, for naming intermediate files
 	filename, file_ext = os.path.splitext (args.infile)
 	args.fileroot = args.infile.replace (file_ext, '')
 
-	# workout what the output schema should be called
-	if args.outfile == None:
-		if args.name and (args.include_tags or args.exclude_tags):
-			if args.include_tags:
-				stb = 'inc'
-				tag_vars = args.include_tags
-			else:
-				stb = 'exc'
-				tag_vars = args.exclude_tags
-			ext = '.%s-%s.expanded.csv' % (stb, '-'.join (tag_vars))
-		else:
-			ext = '.expanded.csv'
-		args.outfile = args.fileroot + ext
+	# incremental expansion works on forms and needs somewhere to keep them
+	if args.incremental:
+		args.direct = True
+		if not args.cache_dir:
+			args.cache_dir = args.fileroot + '.cache'
+
+	# watching only re-renders changed forms, keeping them in memory
+	if args.watch:
+		args.direct = True
+
+	# a loaded structure isn't saved again, as that would overwrite it
+	if args.from_structure:
+		args.dump_structure = 'none'
+
+	# there's nothing to watch for if nothing is expanded
+	if args.validate_only:
+		args.watch = False
+
+	# workout what is to be expanded and what the output should be called
+	if args.include_tag_sets or args.exclude_tag_sets or args.variants:
+		assert not (args.include_tags or args.exclude_tags), \
+			"can't select single tags when expanding several variants"
+		assert args.outfile is None, \
+			"can't give one output file when expanding several variants"
+		args.variants = read_variants (args.variants) if args.variants else []
+		args.variants.extend ([Variant (inc_tags=t) for t in
+			(args.include_tag_sets or [])])
+		args.variants.extend ([Variant (exc_tags=t) for t in
+			(args.exclude_tag_sets or [])])
+		for v in args.variants:
+			v.outfile = v.outfile_for (args.fileroot)
+	else:
+		v = Variant (inc_tags=args.include_tags, exc_tags=args.exclude_tags,
+			outfile=args.outfile)
+		if v.outfile is None:
+			v.outfile = v.default_outfile (args.fileroot, name=args.name)
+		args.variants = [v]
 
 	# just a dummy check on the above logic
-	assert (args.infile != args.outfile), "can't overwrite the input file"
+	outfiles = [v.outfile for v in args.variants]
+	assert (args.infile not in outfiles), "can't overwrite the input file"
+	assert len (set (outfiles)) == len (outfiles), \
+		"variants would overwrite each other's output"
 
 	## Return:
 	return args
 
 
+def describe_rules ():
+	"""
+	Return a table of the validation rules, their stages and descriptions.
+	"""
+	from simpleredcapbuilder import validation
+	from simpleredcapbuilder.rules import RULES
+
+	lines = []
+	for r in RULES.values():
+		lines.append ("%-20s %-9s %s%s" % (r.name, ','.join (r.stages),
+			r.description, '' if r.default else ' (off by default)'))
+	return '\n'.join (lines)
+
+
 def parse_included_vars (inc_var_pth, dump_included_vars):
 	ext = ext_from_path (inc_var_pth)
 	fmt = ext_to_format (ext)
-	data = open (inc_var_pth, 'rU').read()
+	data = open (inc_var_pth, 'r').read()
 	parsed_data = parse_ext_vars (data, fmt)
 	if dump_included_vars:
 		progress ('Dumping included variables')
@@ -117,58 +265,431 @@ def parse_included_vars (inc_var_pth, dump_included_vars):
 
 
 
-def main ():
-	args = parse_clargs()
+def make_direct_expander (inc_vars, bytecode_cache=None, form_store=None,
+		count_rows=False):
+	"""
+	Make an expander for the direct path, incremental if given a store of forms.
+	"""
+	from simpleredcapbuilder.direct import DirectExpander
+	from simpleredcapbuilder.incremental import IncrementalExpander
+
+	xpndr = DirectExpander (inc_vars, bytecode_cache=bytecode_cache,
+		count_rows=count_rows)
+	if form_store is not None:
+		xpndr = IncrementalExpander (xpndr, form_store)
+	return xpndr
+
+
+def expand_direct (exp_dd_struct, variants, base_xpndr, jobs=1,
+		profiler=NULL_PROFILER, rules=None):
+	"""
+	Expand each variant straight into records, writing and validating each as
+	it is produced.
+
+	If the expander is incremental, only forms that have changed since they
+	were stored are rendered, and forms no longer used are forgotten. Rules
+	is a dict of the rules to enable and disable in post-validation.
+	"""
+	from simpleredcapbuilder.direct import make_row_writer
+	from simpleredcapbuilder.incremental import IncrementalExpander
+	from simpleredcapbuilder.validation import PostValidator
+
+	# a stream of forms can only be expanded once
+	streamed = not isinstance (exp_dd_struct, list)
+	assert not (streamed and (1 < len (variants))), \
+		"can't expand several variants from a stream of forms"
+	incremental = isinstance (base_xpndr, IncrementalExpander)
+	if incremental:
+		base_xpndr.fingerprints.clear()
+	for v in variants:
+		progress ("Expanding, saving & post-validating '%s'" % v.outfile)
+		with profiler.stage ('expand_write_postvalidate',
+				variant=v.outfile) as stats:
+			xpndr = base_xpndr.for_tags (inc_tags=v.inc_tags, exc_tags=v.exc_tags)
+			pvalidator = PostValidator (timed=(profiler is not NULL_PROFILER),
+				**(rules or {}))
+			# the validator is given each form as it is expanded
+			forms = pvalidator.iter_adding_sources (exp_dd_struct)
+			if not streamed:
+				stats['forms_in'] = len (exp_dd_struct)
+			cnt = 0
+			with open (v.outfile, 'w') as out_hndl:
+				wrtr = make_row_writer (out_hndl)
+				for r in xpndr.expand (forms, jobs=jobs):
+					wrtr.writerow (r)
+					pvalidator.check_rec (r)
+					cnt += 1
+			stats['rows_out'] = cnt
+			profiler.add_rule_times (pvalidator.rule_times())
+			if incremental:
+				progress ("Rendered %s forms, reused %s" % (xpndr.rendered,
+					xpndr.reused))
+				stats['forms_rendered'] = xpndr.rendered
+				stats['forms_reused'] = xpndr.reused
+		profiler.add_counts (xpndr.form_counts, xpndr.loop_counts)
+
+	# forget forms that are no longer used
+	if incremental:
+		base_xpndr.store.prune (base_xpndr.fingerprints)
+
+
+def expand_by_template (exp_dd_struct, variants, inc_vars, fileroot,
+		bytecode_cache=None, jobs=1, profiler=NULL_PROFILER, rules=None):
+	"""
+	Expand the structure to a template and render that for each variant.
+
+	Variants that include (or exclude) tags all share the one template, so at
+	most two templates are written and compiled however many variants. With
+	more than one job, the variants are rendered in parallel.
+	"""
+	from collections import Counter
+	from concurrent.futures import ProcessPoolExecutor
+	import csv
+	from simpleredcapbuilder.render import ExpandDbSchema, compile_template, \
+		render_template_to_file, render_template_job
+	from simpleredcapbuilder.validation import PostValidator
+
+	modes = []
+	for v in variants:
+		if v.mode not in modes:
+			modes.append (v.mode)
+
+	render_jobs = []
+	for m in modes:
+		# expand structure to templ
+		if len (modes) == 1:
+			tmpl_pth = fileroot + '.jinja'
+		else:
+			tmpl_pth = '%s.%s.jinja' % (fileroot, m or 'all')
+		progress ("Expanding structure to template '%s'" % tmpl_pth)
+		with profiler.stage ('expand', forms_in=len (exp_dd_struct),
+				template=tmpl_pth):
+			xpndr = ExpandDbSchema()
+			tmpl_data = xpndr.expand (exp_dd_struct, inc_tags=(m == 'inc'),
+				exc_tags=(m == 'exc'), out_pth=tmpl_pth)
+
+		# compile once here, unless it's going to be done in the workers
+		if jobs <= 1:
+			with profiler.stage ('compile', template=tmpl_pth):
+				tmpl_data = compile_template (tmpl_data,
+					bytecode_cache=bytecode_cache)
+
+		for v in [v for v in variants if v.mode == m]:
+			# XXX: need a better way to handle this
+			render_vals = dict (inc_vars)
+			render_vals['tags'] = v.tags
+			render_jobs.append ((tmpl_data, render_vals, v.outfile,
+				bytecode_cache))
+
+	# now render the templates
+	if 1 < jobs:
+		progress ("Rendering %s templates in %s processes" % (len (render_jobs),
+			jobs))
+		with profiler.stage ('render_write', jobs=jobs):
+			with ProcessPoolExecutor (max_workers=jobs) as executor:
+				futures = [executor.submit (render_template_job, *rj) for rj
+					in render_jobs]
+				for f in futures:
+					diags, bytecode = f.result()
+					get_diagnostics().extend (diags)
+					if bytecode:
+						bytecode_cache.merge (bytecode)
+	else:
+		for rj in render_jobs:
+			progress ("Rendering template as '%s'" % rj[2])
+			with profiler.stage ('render_write', variant=rj[2]):
+				render_template_to_file (*rj)
+
+	# do the postvalidation
+	for v in variants:
+		progress ("Post-validating '%s'" % v.outfile)
+		with profiler.stage ('postvalidate', variant=v.outfile) as stats:
+			form_counts = Counter()
+			with open (v.outfile, 'r') as in_hndl:
+				rdr = csv.DictReader (in_hndl)
+				pvalidator = PostValidator (timed=(profiler is not NULL_PROFILER),
+					**(rules or {}))
+				for r in rdr:
+					pvalidator.check_rec (r)
+					form_counts[r[consts.Column.form_name.value]] += 1
+			stats['rows_in'] = sum (form_counts.values())
+			profiler.add_rule_times (pvalidator.rule_times())
+		if profiler is not NULL_PROFILER:
+			# the loops aren't seen in rendering a template, so are counted
+			# from the structure, as the direct expansion would count them
+			from simpleredcapbuilder.direct import DirectExpander
+			counter = DirectExpander (inc_tags=v.inc_tags, exc_tags=v.exc_tags,
+				count_rows=True)
+			for f in exp_dd_struct:
+				counter.count_form (f)
+			profiler.add_counts (form_counts, counter.loop_counts)
+
+
+def read_structure (args, cache=None, profiler=NULL_PROFILER):
+	"""
+	Read in the compact dd and parse out its structure, unless already cached.
+
+	If the input is a saved structure, it is loaded instead.
+	"""
+	from simpleredcapbuilder.structure import dump_structure, load_structure, \
+		DUMP_EXTS
+
+	exp_dd_struct = None
+	if cache:
+		# the problems found depend on the rules run, so they are in the key
+		cache_key = cache.key (args.infile, extra_cols=args.extra_cols,
+			enable_rules=sorted (args.enable_rules),
+			disable_rules=sorted (args.disable_rules))
+		with profiler.stage ('load_cache'):
+			cached = cache.load_structure (cache_key)
+		if cached is not None:
+			exp_dd_struct, cached_diags = cached
+
+	if exp_dd_struct is not None:
+		progress ("Using cached structure of input file")
+		# report the problems found when it was read, as they would be again
+		get_diagnostics().extend (cached_diags)
+	elif args.from_structure:
+		progress ("Loading structure from '%s'" % args.infile)
+		with profiler.stage ('load_structure') as stats:
+			with open (args.infile, 'r') as in_hndl:
+				exp_dd_struct = load_structure (in_hndl)
+			stats['rows_out'] = len (exp_dd_struct)
+	else:
+		progress ("Parsing & validating input file")
+		rdr = make_reader (args)
+		if cache:
+			# collect the problems found, to keep them with the structure
+			read_diags = Diagnostics()
+			try:
+				with collecting (read_diags):
+					exp_dd_struct = rdr.parse (args.infile,
+						extra_cols=args.extra_cols, profiler=profiler)
+				cache.save_structure (cache_key, exp_dd_struct, read_diags)
+			finally:
+				get_diagnostics().extend (read_diags)
+		else:
+			exp_dd_struct = rdr.parse (args.infile, extra_cols=args.extra_cols,
+				profiler=profiler)
+
+	# dump structure as json
+	if args.dump_structure != 'none':
+		json_pth = args.fileroot + DUMP_EXTS[args.dump_structure]
+		progress ("Dumping structure as '%s'" % json_pth)
+		with profiler.stage ('json_dump', forms_in=len (exp_dd_struct),
+				format=args.dump_structure):
+			with open (json_pth, 'w') as out_hndl:
+				dump_structure (exp_dd_struct, out_hndl, fmt=args.dump_structure)
+
+	## Return:
+	return exp_dd_struct
+
 
-	# read in compact dd and parse out structure
+def make_reader (args):
+	from simpleredcapbuilder.expddreader import ExpDataDictReader
+	return ExpDataDictReader (enable_rules=args.enable_rules,
+		disable_rules=args.disable_rules,
+		prevalidate_jobs=args.prevalidate_jobs)
+
+
+def validate_input (args, profiler=NULL_PROFILER):
+	"""
+	Read and validate the compact dd, without keeping its structure.
+	"""
+	progress ("Parsing & validating input file")
+	rdr = make_reader (args)
+	with profiler.stage ('read_parse') as stats:
+		cnt = 0
+		for f in rdr.iter_forms (args.infile, extra_cols=args.extra_cols,
+				time_rules=(profiler is not NULL_PROFILER)):
+			cnt += 1
+		stats['rows_in'] = rdr.rows_read
+		stats['rows_out'] = cnt
+	profiler.add_rule_times (rdr.pvalidator.rule_times())
+
+
+def stream_structure (args, profiler=NULL_PROFILER):
+	"""
+	Yield the forms of the compact dd as they are read, validating them.
+
+	The reading is done as the forms are asked for, and so is timed as part of
+	whatever stage uses them.
+	"""
 	progress ("Parsing & validating input file")
-	rdr = ExpDataDictReader()
-	exp_dd_struct = rdr.parse (args.infile, extra_cols=args.extra_cols)
+	rdr = make_reader (args)
+	for f in rdr.iter_forms (args.infile, extra_cols=args.extra_cols,
+			time_rules=(profiler is not NULL_PROFILER)):
+		yield f
+	profiler.add_rule_times (rdr.pvalidator.rule_times())
+
+
+def can_stream (args, cache=None):
+	"""
+	Can the forms be expanded as they are read, without keeping them all?
+
+	Only a direct expansion of a single variant can be. Otherwise the whole
+	structure is needed: for writing a template, walking it for each variant,
+	dumping it, caching it or keeping it to re-expand when watching.
+	"""
+	return (args.direct and (len (args.variants) == 1) and
+		(args.dump_structure == 'none') and not args.from_structure and
+		(cache is None) and not args.watch)
 
-	# read xternal file of included variables
+
+def post_rules (args):
+	"""
+	Return the rules to enable and disable in post-validation.
+	"""
+	return {'enable': args.enable_rules, 'disable': args.disable_rules}
+
+
+def read_vars (args, profiler=NULL_PROFILER):
+	"""
+	Read the external file of included variables, if there is one.
+	"""
 	if args.include_vars:
 		progress ("Parsing file of included variables")
-		inc_vars = parse_included_vars (args.include_vars,
-			args.dump_included_vars)
+		with profiler.stage ('load_vars'):
+			return parse_included_vars (args.include_vars,
+				args.dump_included_vars)
 	else:
-		inc_vars = {}
+		return {}
+
+
+def make_watcher (args):
+	"""
+	Make the watcher of the input and included variables.
+
+	This should be made before they are first read, so that changes made
+	while they are being read and expanded are noticed.
+	"""
+	from simpleredcapbuilder.watch import FileWatcher
+	return FileWatcher ([args.infile, args.include_vars])
+
+
+def watch_and_expand (args, exp_dd_struct, inc_vars, cache=None,
+		bytecode_cache=None, form_store=None, watcher=None):
+	"""
+	Re-expand the input whenever it or the included variables change.
+
+	The structure, variables and compiled cells are held between expansions
+	and only the forms that have changed are rendered again. Errors in the
+	input are reported and the watching carries on. Any report of problems is
+	saved again after each expansion, with the problems found in it.
+	"""
+	if watcher is None:
+		watcher = make_watcher (args)
+	xpndr = make_direct_expander (inc_vars, bytecode_cache, form_store)
+	progress ("Watching '%s' for changes (Ctrl-C to stop)" % args.infile)
+	while True:
+		try:
+			changed = watcher.wait()
+		except KeyboardInterrupt:
+			break
+		# problems are reported afresh each time round
+		with collecting (Diagnostics (echo=True)) as diags:
+			try:
+				start = time.time()
+				if args.infile in changed:
+					exp_dd_struct = read_structure (args, cache)
+				if args.include_vars in changed:
+					inc_vars = read_vars (args)
+					xpndr = make_direct_expander (inc_vars, bytecode_cache,
+						form_store)
+				expand_direct (exp_dd_struct, args.variants, xpndr,
+					jobs=args.jobs, rules=post_rules (args))
+				if bytecode_cache:
+					bytecode_cache.flush()
+				progress ("Re-expanded in %.2f seconds" % (time.time() - start))
+			except Exception as err:
+				error ("expansion failed: %s" % err)
+		save_report (args, diags)
+
+
+def save_report (args, diags):
+	"""
+	Save the problems found, if a report was asked for.
+	"""
+	if args.report:
+		progress ("Saving report of problems as '%s'" % args.report)
+		diags.write (args.report, fmt=args.report_format)
 
-	# dump structure as json
-	progress ("Dumping structure as JSON")
-	import json
-	json_pth = args.fileroot + '.json'
-	with open (json_pth, 'w') as out_hndl:
-		json.dump (exp_dd_struct, out_hndl, indent=3, ensure_ascii=False)
-
-	# expand structure to templ
-	progress ("Expanding structure to template")
-	tmpl_pth = args.fileroot + '.jinja'
-	xpndr = ExpandDbSchema()
-	xpndr.expand (exp_dd_struct, inc_tags=args.include_tags,
-		exc_tags=args.exclude_tags, out_pth=tmpl_pth)
-
-	# now render the template
-	progress ("Rendering template")
-	with open (tmpl_pth, 'rU') as in_hndl:
-		tmpl_data = in_hndl.read()
-	# XXX: need a better way to handle this
-	inc_vars['tags'] = args.include_tags or args.exclude_tags
-	exp_tmpl = render_template (tmpl_data, inc_vars)
-	progress ("Saving template as data dictionary")
-	with open (args.outfile, 'w') as out_hndl:
-		out_hndl.write (exp_tmpl)
 
-	# do the postvalidation
-	progress ("Post-validating output data dictionary")
-	with open (args.outfile, 'rU') as in_hndl:
-		rdr = csv.DictReader (in_hndl)
-		recs = [r for r in rdr]
-		pvalidator = PostValidator()
-		pvalidator.check (recs)
+def main ():
+	args = parse_clargs()
+	diags = Diagnostics (echo=True)
+	with collecting (diags):
+		expand (args)
+	# when watching, the report is of the last expansion and already saved
+	if not args.watch:
+		save_report (args, diags)
 
 	print ("Done.")
 
 
+def expand (args):
+	if args.timings:
+		profiler = Profiler (trace_memory=args.trace_memory)
+	else:
+		profiler = NULL_PROFILER
+
+	# look in the cache for previously parsed structures and templates
+	cache = bytecode_cache = form_store = None
+	if args.cache_dir and not args.validate_only:
+		from simpleredcapbuilder.cache import ExpansionCache
+		cache = ExpansionCache (args.cache_dir)
+		bytecode_cache = cache.bytecode_cache (cache.key (args.infile,
+			extra_cols=args.extra_cols))
+		if args.incremental:
+			form_store = cache.form_store (args.infile)
+	watcher = None
+	if args.watch:
+		if form_store is None:
+			from simpleredcapbuilder.incremental import FormStore
+			form_store = FormStore()
+		# look for changes from before the input is read, so as not to miss
+		# any made while it is
+		watcher = make_watcher (args)
+
+	if args.validate_only:
+		if args.from_structure:
+			exp_dd_struct = read_structure (args, profiler=profiler)
+		else:
+			validate_input (args, profiler)
+	elif can_stream (args, cache):
+		exp_dd_struct = stream_structure (args, profiler)
+	else:
+		exp_dd_struct = read_structure (args, cache, profiler)
+
+	if not args.validate_only:
+		# read xternal file of included variables
+		inc_vars = read_vars (args, profiler)
+
+		if args.direct:
+			xpndr = make_direct_expander (inc_vars, bytecode_cache, form_store,
+				count_rows=(profiler is not NULL_PROFILER))
+			expand_direct (exp_dd_struct, args.variants, xpndr, jobs=args.jobs,
+				profiler=profiler, rules=post_rules (args))
+		else:
+			expand_by_template (exp_dd_struct, args.variants, inc_vars,
+				args.fileroot, bytecode_cache=bytecode_cache, jobs=args.jobs,
+				profiler=profiler, rules=post_rules (args))
+
+	if bytecode_cache:
+		bytecode_cache.flush()
+
+	if args.timings:
+		progress ("Saving timings as '%s'" % args.timings)
+		profiler.stop()
+		profiler.write (args.timings)
+
+	if args.watch:
+		save_report (args, get_diagnostics())
+		watch_and_expand (args, exp_dd_struct, inc_vars, cache=cache,
+			bytecode_cache=bytecode_cache, form_store=form_store,
+			watcher=watcher)
+
+
 
 if __name__ == '__main__':
 	import sys
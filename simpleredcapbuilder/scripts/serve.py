@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Serve expansions of compact REDCap data dictionaries over HTTP.
+"""
+
+### IMPORTS
+
+from simpleredcapbuilder import server
+from simpleredcapbuilder.utils import progress
+
+### CONSTANTS & DEFINES
+
+### CODE ###
+
+### MAIN
+
+def parse_clargs ():
+	import argparse
+	aparser = argparse.ArgumentParser()
+
+	aparser.add_argument ('--host',
+		help='address to listen on',
+		default=server.DEFAULT_HOST,
+	)
+
+	aparser.add_argument ('-p', '--port', type=int,
+		help='port to listen on',
+		default=server.DEFAULT_PORT,
+	)
+
+	aparser.add_argument ('-w', '--workers', type=int,
+		help='expand at most this many dictionaries at once',
+		default=server.DEFAULT_WORKERS,
+	)
+
+	aparser.add_argument ('--max-requests', type=int,
+		help='accept at most this many requests at once, working or waiting '
+			'(by default twice the workers), refusing others as busy',
+		default=None,
+	)
+
+	aparser.add_argument ('--max-structures', type=int,
+		help='keep this many parsed dictionaries in memory',
+		default=server.DEFAULT_MAX_STRUCTURES,
+	)
+
+	## Return:
+	return aparser.parse_args()
+
+
+def main ():
+	args = parse_clargs()
+	srvr = server.make_server (host=args.host, port=args.port,
+		workers=args.workers, max_structures=args.max_structures,
+		max_requests=args.max_requests)
+	progress ("Serving expansions on http://%s:%s (Ctrl-C to stop)" %
+		srvr.server_address[:2])
+	try:
+		srvr.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		srvr.server_close()
+	print ("Done.")
+
+
+
+if __name__ == '__main__':
+	import sys
+	main()
+	sys.exit (0)
+
+
+### END ###
@@ -0,0 +1,394 @@
+"""
+Serve expansions over HTTP, keeping parsed dictionaries and templates warm.
+
+Rather than starting a fresh process for every expansion, a long-running
+server holds a `Renderer` (and so its compiled templates) and the structures
+of recently parsed dictionaries. A request posts a JSON object to
+``/expand``::
+
+	{
+		"dictionary": "<the compact dictionary as CSV text>",
+		"include_tags": ["foo"],
+		"vars": {"quux": 1}
+	}
+
+Excel dictionaries can be sent base64 encoded as ``dictionary_base64``, with a
+``filename`` whose extension (.csv, .xls or .xlsx) gives the type. Tags may be
+given as ``include_tags`` or ``exclude_tags``, as a list or comma-delimited
+string. External variables are given as ``vars``, or as the text of a file in
+``vars_text`` with its ``vars_format`` ('json', 'yaml' or 'ini').
+``extra_cols`` may be set false to disallow extra columns.
+
+The response is a JSON object with the expanded dictionary as CSV (``csv``),
+the number of rows (``rows``) and the warnings and errors found in reading,
+rendering and validating (``report``), each with its code, variable, column
+and row. A problem with the request (including a filename of an unknown
+type) gives a 400 response and a dictionary that can't be read or rendered
+(e.g. with broken template code) a 422, each with an ``error`` message, which
+never gives where the upload was saved.
+
+Expansions are run by a fixed pool of worker threads, so however many
+requests arrive, only that many are worked on at once. Only a few more are
+let in to wait for a worker (by default as many again), so the bodies of
+requests held at once are bounded too; any others are refused with a 503
+before their body is read.
+
+"""
+
+### IMPORTS
+
+import base64
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from jinja2 import exceptions as jexcept
+
+from . import __version__
+from .consts import FileType
+from .expddreader import ExpDataDictReader
+from .extvars import ext_to_format, parse_ext_vars
+from .render import Renderer
+from .diagnostics import collecting
+from .validation import PostValidator
+from .variants import Variant
+
+__all__ = [
+	'ExpansionService',
+	'ExpansionServer',
+	'make_server',
+]
+
+
+### CONSTANTS & DEFINES
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_STRUCTURES = 32
+
+# the largest request body accepted
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+# how long a client refused for being busy is told to wait, in seconds
+_RETRY_AFTER = 1
+
+_EXPAND_PATH = '/expand'
+_HEALTH_PATH = '/health'
+
+
+### CODE ###
+
+class RequestError (ValueError):
+	"""
+	A request that is missing or has bad parameters.
+	"""
+	pass
+
+
+class InvalidDictionaryError (ValueError):
+	"""
+	An uploaded dictionary that couldn't be read.
+	"""
+	def __init__ (self, msg, diags=()):
+		ValueError.__init__ (self, msg)
+		self.diags = list (diags)
+
+
+class ExpansionService (object):
+	"""
+	Expand uploaded dictionaries, keeping recent structures and templates.
+
+	Params:
+		max_structures (int): how many parsed dictionaries (and whole
+			templates) to keep
+		bytecode_cache (jinja2.BytecodeCache): where to store compiled
+			templates
+
+	This has no dependence on HTTP, so can be called directly. It is safe to
+	call from several threads at once.
+
+	"""
+	def __init__ (self, max_structures=DEFAULT_MAX_STRUCTURES,
+			bytecode_cache=None):
+		# a structure is rendered with one template for each mode of tags, but
+		# most often with the same one
+		self.renderer = Renderer (bytecode_cache=bytecode_cache,
+			max_whole_templates=max_structures)
+		self.max_structures = max_structures
+		self.structures = OrderedDict()
+		self._lock = threading.Lock()
+
+	def expand (self, req):
+		"""
+		Expand a dictionary as described by a request, returning the response.
+
+		Params:
+			req (dict): the decoded request (see the module documentation)
+
+		Returns:
+			a dict of the expanded CSV, the number of rows and the report
+
+		"""
+		## Preconditions:
+		if not isinstance (req, dict):
+			raise RequestError ("request must be a JSON object")
+		data, filename = self.read_dictionary (req)
+		render_vals = self.read_vars (req)
+		try:
+			variant = Variant (inc_tags=req.get ('include_tags', None),
+				exc_tags=req.get ('exclude_tags', None))
+		except AssertionError as err:
+			raise RequestError (str (err))
+		extra_cols = bool (req.get ('extra_cols', True))
+
+		## Main:
+		db_schema, parse_diags = self.get_structure (data, filename, extra_cols)
+		with collecting() as diags:
+			try:
+				csv_str = self.renderer.render (db_schema, render_vals,
+					inc_tags=variant.inc_tags, exc_tags=variant.exc_tags)
+			except jexcept.TemplateError as err:
+				# the template code came with the upload, so is the client's
+				raise InvalidDictionaryError ("can't render the dictionary: %s" %
+					err, list (parse_diags) + list (diags))
+			pvalidator = PostValidator()
+			cnt = 0
+			for r in csv.DictReader (io.StringIO (csv_str)):
+				pvalidator.check_rec (r)
+				cnt += 1
+
+		## Return:
+		return {
+			'csv': csv_str,
+			'rows': cnt,
+			'report': _make_report (list (parse_diags) + list (diags)),
+		}
+
+	def read_dictionary (self, req):
+		"""
+		Return the uploaded dictionary as bytes, with a filename for its type.
+
+		Only the extension of a given filename is used, the file being saved
+		under a name of its own.
+		"""
+		filename = req.get ('filename', None) or 'upload.csv'
+		if not isinstance (filename, str):
+			raise RequestError ("'filename' must be a string")
+		ext = os.path.splitext (os.path.basename (filename))[1]
+		try:
+			FileType.from_path (ext)
+		except ValueError:
+			raise RequestError ("can't recognise the type of '%s', which "
+				"should end in .csv, .xls or .xlsx" % filename)
+		if 'dictionary_base64' in req:
+			try:
+				data = base64.b64decode (req['dictionary_base64'])
+			except Exception:
+				raise RequestError ("can't decode 'dictionary_base64'")
+		elif 'dictionary' in req:
+			data = req['dictionary'].encode ('utf-8')
+		else:
+			raise RequestError ("no 'dictionary' given")
+		return data, 'upload' + ext.lower()
+
+	def read_vars (self, req):
+		"""
+		Return the external variables given in a request.
+		"""
+		if 'vars_text' in req:
+			try:
+				fmt = ext_to_format (req.get ('vars_format', 'json'))
+				render_vals = parse_ext_vars (req['vars_text'], fmt)
+			except ValueError as err:
+				raise RequestError (str (err))
+		else:
+			render_vals = req.get ('vars', None) or {}
+		if not isinstance (render_vals, dict):
+			raise RequestError ("variables must be a mapping")
+		return render_vals
+
+	def get_structure (self, data, filename, extra_cols=True):
+		"""
+		Return the parsed structure of a dictionary, and the problems found.
+
+		Recently parsed dictionaries are kept, so resubmitting the same one
+		(e.g. with different tags) doesn't mean parsing it again.
+		"""
+		hasher = hashlib.sha1()
+		hdr = "%s|%s|%s|" % (__version__, os.path.splitext (filename)[1],
+			extra_cols)
+		hasher.update (hdr.encode ('utf-8'))
+		hasher.update (data)
+		key = hasher.hexdigest()
+
+		with self._lock:
+			entry = self.structures.get (key, None)
+			if entry is not None:
+				self.structures.move_to_end (key)
+				return entry
+
+		# the reader wants a file, so put the upload in one
+		tmp_dir = tempfile.mkdtemp()
+		try:
+			in_pth = os.path.join (tmp_dir, filename)
+			with open (in_pth, 'wb') as out_hndl:
+				out_hndl.write (data)
+			with collecting() as diags:
+				rdr = ExpDataDictReader()
+				db_schema = rdr.parse (in_pth, extra_cols=extra_cols)
+		except Exception as err:
+			# anything that goes wrong in reading is down to the upload, but
+			# where it was put is no business of the client
+			msg = re.sub (re.escape (tmp_dir) + r'[\\/]?', '', str (err),
+				flags=re.IGNORECASE)
+			raise InvalidDictionaryError (msg or type (err).__name__, diags)
+		finally:
+			shutil.rmtree (tmp_dir, ignore_errors=True)
+
+		entry = (db_schema, diags)
+		with self._lock:
+			self.structures[key] = entry
+			while self.max_structures < len (self.structures):
+				self.structures.popitem (last=False)
+
+		## Return:
+		return entry
+
+
+class ExpansionHandler (BaseHTTPRequestHandler):
+	"""
+	Handle the requests to an `ExpansionServer`.
+	"""
+	server_version = 'simpleredcapbuilder/%s' % __version__
+
+	def do_GET (self):
+		if self.path.split ('?')[0] == _HEALTH_PATH:
+			self.send_json (200, {'status': 'ok', 'version': __version__})
+		else:
+			self.send_json (404, {'error': "unknown path '%s'" % self.path})
+
+	def do_POST (self):
+		if self.path.split ('?')[0] != _EXPAND_PATH:
+			self.send_json (404, {'error': "unknown path '%s'" % self.path})
+			return
+
+		try:
+			body_len = int (self.headers.get ('Content-Length', 0))
+		except ValueError:
+			body_len = -1
+		if not (0 < body_len <= MAX_BODY_SIZE):
+			self.send_json (413 if MAX_BODY_SIZE < body_len else 400,
+				{'error': "bad or missing request length"})
+			return
+
+		# the body isn't read unless there is room for the request
+		if not self.server.admit():
+			self.close_connection = True
+			self.send_json (503, {'error': "too many requests, try again later"},
+				headers={'Retry-After': str (_RETRY_AFTER)})
+			return
+		try:
+			self.expand (body_len)
+		finally:
+			self.server.release()
+
+	def expand (self, body_len):
+		try:
+			req = json.loads (self.rfile.read (body_len).decode ('utf-8'))
+			resp = self.server.pool.submit (self.server.service.expand,
+				req).result()
+			self.send_json (200, resp)
+		except InvalidDictionaryError as err:
+			self.send_json (422, {'error': str (err),
+				'report': _make_report (err.diags)})
+		except (RequestError, ValueError) as err:
+			self.send_json (400, {'error': str (err)})
+		except Exception as err:
+			# the details are logged, as they may say more than should be sent
+			self.log_error ("expansion failed: %r", err)
+			self.send_json (500, {'error': "expansion failed"})
+
+	def send_json (self, status, obj, headers={}):
+		body = json.dumps (obj, ensure_ascii=False).encode ('utf-8')
+		self.send_response (status)
+		self.send_header ('Content-Type', 'application/json; charset=utf-8')
+		self.send_header ('Content-Length', str (len (body)))
+		for k, v in headers.items():
+			self.send_header (k, v)
+		self.end_headers()
+		self.wfile.write (body)
+
+
+class ExpansionServer (ThreadingMixIn, HTTPServer):
+	"""
+	An HTTP server for expansions, with a bounded pool of workers.
+
+	Each connection is handled in its own thread, but the expansion itself is
+	passed to a fixed pool of workers, which bounds the work done at once.
+	Requests must be admitted before their body is read, at most
+	``max_requests`` (by default twice the workers) being worked on or waiting
+	at once, which bounds the memory they take.
+	"""
+	daemon_threads = True
+
+	def __init__ (self, server_address, service, workers=DEFAULT_WORKERS,
+			max_requests=None):
+		HTTPServer.__init__ (self, server_address, ExpansionHandler)
+		self.service = service
+		self.pool = ThreadPoolExecutor (max_workers=workers)
+		if max_requests is None:
+			max_requests = 2 * workers
+		assert workers <= max_requests, \
+			"must admit at least as many requests as there are workers"
+		self._admitted = threading.BoundedSemaphore (max_requests)
+
+	def admit (self):
+		"""
+		Take a place for a request, returning False if there are none left.
+		"""
+		return self._admitted.acquire (blocking=False)
+
+	def release (self):
+		"""
+		Give back the place taken by a request.
+		"""
+		self._admitted.release()
+
+	def server_close (self):
+		HTTPServer.server_close (self)
+		self.pool.shutdown (wait=True)
+
+
+def make_server (host=DEFAULT_HOST, port=DEFAULT_PORT,
+		workers=DEFAULT_WORKERS, max_structures=DEFAULT_MAX_STRUCTURES,
+		bytecode_cache=None, max_requests=None):
+	"""
+	Make a server ready to be run with ``serve_forever``.
+
+	A port of 0 picks a free port, which can be found from ``server_address``.
+	"""
+	service = ExpansionService (max_structures=max_structures,
+		bytecode_cache=bytecode_cache)
+	return ExpansionServer ((host, port), service, workers=workers,
+		max_requests=max_requests)
+
+
+def _make_report (diags):
+	return {
+		'warnings': [d.as_dict() for d in diags if d.severity == 'warning'],
+		'errors': [d.as_dict() for d in diags if d.severity == 'error'],
+	}
+
+
+### END ###
@@ -0,0 +1,169 @@
+"""
+Save and load the parsed structure of a compact data dictionary.
+
+The structure is a list of forms, each a dict of sections and rows, the rows
+being `Record` objects. Repeats over a span of numbers are held as `range`
+objects, which are written in JSON as ``{"range": [start, stop]}`` (``stop``
+being exclusive, as with Python) rather than being spelt out in full.
+
+A structure can be dumped as indented JSON ('pretty') or as JSON lines
+('compact'): a header line, then each form on a line of its own, written
+one at a time. Dumps keep the input row of each record and which of its
+columns are templated, so a loaded structure expands as the original did.
+
+"""
+
+### IMPORTS
+
+from .record import Record
+
+__all__ = [
+	'iter_source_rows',
+	'json_default',
+	'write_json',
+	'dump_structure',
+	'load_structure',
+	'DUMP_FORMATS',
+	'DUMP_EXTS',
+]
+
+
+### CONSTANTS & DEFINES
+
+DUMP_FORMATS = ['pretty', 'compact']
+
+# the extension of each format of dump
+DUMP_EXTS = {
+	'pretty': '.json',
+	'compact': '.jsonl',
+}
+
+# the key of the header line of a compact dump
+_HEADER_KEY = 'simpleredcapbuilder_structure'
+
+### CODE ###
+
+def iter_source_rows (item):
+	"""
+	Yield every row of a structure, form or section, in order.
+	"""
+	if isinstance (item, list):
+		for f in item:
+			for r in iter_source_rows (f):
+				yield r
+	elif item['type'] == 'row':
+		yield item
+	else:
+		for x in item['contents']:
+			for r in iter_source_rows (x):
+				yield r
+
+
+def json_default (obj):
+	"""
+	Convert the parts of a structure that JSON doesn't know about.
+
+	For use as the ``default`` of `json.dump`.
+	"""
+	if isinstance (obj, Record):
+		return obj.as_dict()
+	elif isinstance (obj, range):
+		return {'range': [obj.start, obj.stop]}
+	else:
+		raise TypeError ("can't convert '%r' to JSON" % obj)
+
+
+def write_json (db_schema, out_hndl, **kwargs):
+	"""
+	Write a structure as JSON.
+
+	Any keyword arguments are passed to `json.dump`.
+	"""
+	opts = {'indent': 3, 'ensure_ascii': False}
+	opts.update (kwargs)
+	import json
+	json.dump (db_schema, out_hndl, default=json_default, **opts)
+
+
+def dump_default (obj):
+	"""
+	As `json_default`, but keeping the input row and templated columns of records.
+	"""
+	if isinstance (obj, Record):
+		d = obj.as_dict()
+		if obj.row_num is not None:
+			d['row_num'] = obj.row_num
+		if obj.templated is not None:
+			d['templated'] = list (obj.templated)
+		return d
+	else:
+		return json_default (obj)
+
+
+def dump_structure (db_schema, out_hndl, fmt='pretty'):
+	"""
+	Write a structure as JSON, so that it can be loaded again.
+
+	Params:
+		db_schema (list): the parsed structure, a list of forms
+		out_hndl (file): where to write it
+		fmt (str): 'pretty' for indented JSON or 'compact' for JSON lines
+
+	"""
+	## Preconditions:
+	assert fmt in DUMP_FORMATS, "unrecognised structure format '%s'" % fmt
+
+	## Main:
+	import json
+	if fmt == 'pretty':
+		json.dump (db_schema, out_hndl, default=dump_default, indent=3,
+			ensure_ascii=False)
+	else:
+		from . import __version__
+		out_hndl.write (json.dumps ({_HEADER_KEY: __version__}) + '\n')
+		encoder = json.JSONEncoder (default=dump_default, ensure_ascii=False,
+			separators=(',', ':'))
+		for f in db_schema:
+			out_hndl.write (encoder.encode (f) + '\n')
+
+
+def load_structure (in_hndl):
+	"""
+	Read a structure dumped by `dump_structure`, in either format.
+
+	Rows are made into records again and spans of numbers into ranges.
+	"""
+	import json
+	first = in_hndl.readline()
+	if first.lstrip().startswith ('['):
+		# indented, so one document
+		return json.loads (first + in_hndl.read(), object_hook=_from_json)
+	else:
+		try:
+			hdr = json.loads (first)
+		except ValueError:
+			hdr = None
+		assert isinstance (hdr, dict) and (_HEADER_KEY in hdr), \
+			"not a dump of a structure"
+		return [json.loads (l, object_hook=_from_json) for l in in_hndl if
+			l.strip()]
+
+
+def _from_json (obj):
+	# convert the objects of a dump back to records and ranges
+	if obj.get ('type', None) == 'row':
+		row_num = obj.pop ('row_num', None)
+		templated = obj.pop ('templated', None)
+		rec = Record (obj, row_num=row_num)
+		if templated is None:
+			rec.classify()
+		else:
+			rec.templated = tuple (templated)
+		return rec
+	elif (len (obj) == 1) and ('range' in obj):
+		return range (*obj['range'])
+	else:
+		return obj
+
+
+### END ###
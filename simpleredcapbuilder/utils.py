@@ -5,7 +5,8 @@ Module-wide utility functions
 ### IMPORTS
 
 import os
-import pprint
+
+from . import diagnostics
 
 __all__ = [
 	'pprint',
@@ -17,25 +18,32 @@ __all__ = [
 
 ### CONSTANTS & DEFINES
 
-_PP = pprint.PrettyPrinter (indent=2)
-
 
 ### CODE ###
 
 def pprint (x):
-	_PP.pprint (x)
+	from pprint import PrettyPrinter
+	PrettyPrinter (indent=2).pprint (x)
 
 
 def progress (msg):
+	# write any problems found so far first, so they appear in order
+	diagnostics.get_diagnostics().flush()
 	print ("%s ..." % msg)
 
 
-def warn (msg):
-	print ("WARNING: %s" % msg)
+def warn (msg, **kwargs):
+	"""
+	Report a possible problem, with any of the fields of a `Diagnostic`.
+	"""
+	diagnostics.report (diagnostics.WARNING, msg, **kwargs)
 
 
-def error (msg):
-	print ("ERROR: %s" % msg)
+def error (msg, **kwargs):
+	"""
+	Report a definite problem, with any of the fields of a `Diagnostic`.
+	"""
+	diagnostics.report (diagnostics.ERROR, msg, **kwargs)
 
 
 ### END ###
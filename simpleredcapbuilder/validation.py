@@ -1,19 +1,21 @@
 """
 Some validation and checking functions for REDCap data dictionaries.
+
+The checks of single rows are rules (see `rules`), which are registered here
+and can be enabled or disabled by name. The validators run the rules of their
+stage in one pass over each row, keeping the state of the rules that depend
+on the rows before.
 """
 
 ### IMPORTS
 
-from __future__ import print_function
-from __future__ import unicode_literals
-from __future__ import division
-from __future__ import absolute_import
-from future import standard_library
-standard_library.install_aliases()
-
 import re
 
 from .consts import Column as COL
+from .diagnostics import collecting, get_diagnostics, INPUT_ROW, OUTPUT_ROW
+from .record import has_template_code
+from .rules import RuleSet, rule, select_rules, merge_rule_times
+from .structure import iter_source_rows
 from . import utils
 from . import consts
 
@@ -40,8 +42,21 @@ CHAR_PAIRS = (
 
 CHAR_DBLS = ('\'', '"')
 
+# lookups for scanning the above in a single pass
+_BRACKET_CLOSE = dict ((p[1], p[0]) for p in CHAR_PAIRS if len (p[0]) == 1)
+_DELIM_OPEN = frozenset (p[0] for p in CHAR_PAIRS if len (p[0]) == 2)
+_DELIM_CLOSE = dict ((p[1], p[0]) for p in CHAR_PAIRS if len (p[0]) == 2)
+_DELIM_CHARS = frozenset ('{}%#')
+
+# results of scanning cells, which are often repeated
+_SCAN_CACHE = {}
+_SCAN_CACHE_MAX = 10000
+
 TMPL_CHECK_COLS = [c for c in consts.ALL_NAMES if c not in ['tags', 'repeat']]
 
+# how many records are pre-validated at once in each process
+PREVALIDATE_CHUNK_SIZE = 500
+
 
 
 ### CODE ###
@@ -50,118 +65,426 @@ TMPL_CHECK_COLS = [c for c in consts.ALL_NAMES if c not in ['tags', 'repeat']]
 
 ## Messaging
 
-def warn_rec (rec, msg):
+def warn_rec (rec, msg, code=None, column=None, row=None, row_kind=None,
+		view=None):
 	"""
 	Warn that a record may have problems.
 
+	Params:
+		rec (Record or dict): the record with the problem
+		msg (str): a description of the problem
+		code (str): the kind of problem
+		column (str): the column the problem is in, if any
+		row (int): the row of the record, if not recorded in it
+		row_kind (str): whether that row is of the input or the output
+		view (RowView): the row being checked by a rule, giving the row and
+			its kind
+
 	"""
 	# TODO: update some warns to errors as appropriate
-	msg = "Record %s is possibly invalid: %s" % (rec[COL.variable.value], msg)
-	utils.warn (msg)
+	row, row_kind = _row_of (rec, row, row_kind, view)
+	utils.warn (msg, code=code, variable=rec[COL.variable.value],
+		column=column, row=row, row_kind=row_kind)
 
 
-def error_rec (rec, msg):
+def error_rec (rec, msg, code=None, column=None, row=None, row_kind=None,
+		view=None):
 	"""
 	Complain that a record definitely has problems.
 
+	Params:
+		See `warn_rec`
+
 	"""
-	msg = "Record %s is invalid: %s" % (rec[COL.variable.value], msg)
-	utils.error (msg)
+	row, row_kind = _row_of (rec, row, row_kind, view)
+	utils.error (msg, code=code, variable=rec[COL.variable.value],
+		column=column, row=row, row_kind=row_kind)
 
 
-## Error checking
+def _row_of (rec, row, row_kind, view):
+	# the row to report at and its kind, a record read in giving its own
+	if view is not None:
+		row, row_kind = view.row, view.row_kind
+	if row is None:
+		row = getattr (rec, 'row_num', None)
+		row_kind = None if (row is None) else INPUT_ROW
+	return row, row_kind
 
-def check_id_length (rec):
-	variable = rec[COL.variable.value]
-	if 26 < len (variable):
-		error_rec (rec, "variable identifier is too long")
 
+## Rules
+# the rules are registered in the order they are run
 
-def check_required_fields (rec):
-	for col in consts.MANDATORY_COLS:
-		col_name = col.value
-		if not rec[col_name].strip():
-			error_rec (rec, "missing required field '%s'" % col_name)
+_VAR = COL.variable.value
+_FORM = COL.form_name.value
+_FTYPE = COL.field_type.value
+_LABEL = COL.field_label.value
+_CHOICES = COL.choices_calculations.value
+_VTYPE = COL.text_validation_type.value
+_VMIN = COL.text_validation_min.value
+_VMAX = COL.text_validation_max.value
+_BL = COL.branching_logic.value
 
+_MANDATORY = [c.value for c in consts.MANDATORY_COLS]
 
-def check_needs_choices (rec, check_comp=False):
+# field types that need choices (or a calculation)
+_CHOICE_FTYPES = frozenset (['radio', 'checkbox', 'dropdown', 'calc'])
+_MULTI_CHOICE_FTYPES = frozenset (['radio', 'checkbox', 'dropdown'])
+
+
+@rule ('id-maybe-too-long', stages=('pre',), columns=(_VAR,))
+def check_id_maybe_too_long (view):
 	"""
-	If this is a field that needs choices, see that it has them.
+	Warn of variable identifiers that may be too long when expanded.
+	"""
+	if 26 < len (view.rec[_VAR]):
+		warn_rec (view.rec, "final variable identifier maybe too long",
+			code='id-maybe-too-long', column=_VAR, view=view)
 
-	Arguments:
-		rec: the record to be checked.
-		check_comp (bool): check that non-choice items don't have choices
 
+@rule ('dates-and-times', stages=('pre',), columns=(_VTYPE,),
+	lowered=(_LABEL, _VAR))
+def check_dates_and_times (view):
+	"""
+	Check that fields that look like dates or times have the right validator.
 	"""
-	if rec[COL.field_type.value] in ('radio', 'checkbox', 'dropdown', 'calc'):
-		if not rec[COL.choices_calculations.value].strip():
-			warn_rec (rec, "choice / calculated field has no choices")
-		if rec[COL.text_validation_type.value].strip():
-			warn_rec (rec, "choice / calculated field has text validation")
-		if rec[COL.text_validation_min.value].strip():
-			warn_rec (rec, "choice / calculated field has text min")
-		if rec[COL.text_validation_max.value].strip():
-			warn_rec (rec, "choice / calculated field has text max")
-	elif check_comp:
-		# if rec[COL.text_validation_type.value] not in ('number', 'integer'):
-			if rec[COL.choices_calculations.value]:
-				warn_rec (rec, "non-choice / calculated field has choices or calculation")
+	# TODO: allow for other date and time format validators
+	label, variable = view.lowered[_LABEL], view.lowered[_VAR]
+	if ('date' in label) or ('date' in variable):
+		if 'date' not in view.rec[_VTYPE]:
+			warn_rec (view.rec, "looks like date but has no date validator",
+				code='date-validation', column=_VTYPE, view=view)
+
+	if ('time' in label) or ('time' in variable):
+		if 'time' not in view.rec[_VTYPE]:
+			warn_rec (view.rec, "looks like time but has no time validator",
+				code='time-validation', column=_VTYPE, view=view)
 
 
-def check_dates_and_times (rec):
+@rule ('required-fields', stages=('post',), stripped=_MANDATORY)
+def check_required_fields (view):
+	"""
+	Check that the required fields are filled in.
 	"""
-	If a record looks like a date or time, check it has right validator.
+	for col_name in _MANDATORY:
+		if not view.stripped[col_name]:
+			error_rec (view.rec, "missing required field '%s'" % col_name,
+				code='missing-field', column=col_name, view=view)
 
+
+@rule ('id-too-long', stages=('post',), columns=(_VAR,))
+def check_id_length (view):
 	"""
-	# TODO: allow for other date and time format validators
-	if ('date' in rec[COL.field_label.value].lower()) or ('date' in rec[COL.variable.value].lower()):
-		if 'date' not in rec[COL.text_validation_type.value]:
-			warn_rec (rec, "looks like date but has no date validator")
+	Check that variable identifiers aren't too long.
+	"""
+	if 26 < len (view.rec[_VAR]):
+		error_rec (view.rec, "variable identifier is too long",
+			code='id-too-long', column=_VAR, view=view)
 
-	if ('time' in rec[COL.field_label.value].lower()) or ('time' in rec[COL.variable.value].lower()):
-		if 'time' not in rec[COL.text_validation_type.value]:
-			warn_rec (rec, "looks like time but has no time validator")
+
+@rule ('duplicate-id', stages=('post',), columns=(_VAR,), ordered=True)
+def check_unique_id (view):
+	"""
+	Check that variable identifiers aren't used twice.
+	"""
+	variable = view.rec[_VAR]
+	first_row = view.validator.ids.get (variable, None)
+	if first_row != view.row:
+		error_rec (view.rec, "variable '%s' on row %s duplicates row %s" % (
+			variable, view.row, first_row), code='duplicate-id', column=_VAR,
+			view=view)
 
 
-def check_choices (rec):
+@rule ('form-order', stages=('post',), columns=(_FORM,), ordered=True)
+def check_form_name (view):
+	"""
+	Check that forms aren't repeated or interrupted by other forms.
 	"""
-	If this field requires a choices, does choices look valid?
+	# NOTE: we actually can't tell the difference between duplicated form
+	# names and non-consecutive forms - it's all in the eye of the beholder -
+	# so it creates the same error
+	# NOTE: check for required form_name elsewhere
+	vldtr = view.validator
+	form_name = view.rec[_FORM]
+	if form_name != vldtr.curr_form:
+		if form_name in vldtr.form_names:
+			error_rec (view.rec, "form '%s' occurs non-consecutively (row %s)" % (
+				form_name, view.row), code='non-consecutive-form', column=_FORM,
+				view=view)
+		else:
+			vldtr.form_names.add (form_name)
+		vldtr.curr_form = form_name
+
 
+@rule ('choice-id-too-long', stages=('post',), columns=(_FTYPE, _VAR,
+	_CHOICES))
+def check_choices_len (view):
+	"""
+	Check that the identifiers made from checkbox choices aren't too long.
+	"""
+	# XXX: do we need a try-except here?
+	rec = view.rec
+	if rec[_FTYPE] == 'checkbox':
+		id_str = rec[_VAR]
+		# parse choices string
+		choice_pairs = rec[_CHOICES].split ('|')
+		choice_values = [s.split(',', 1)[0].strip() for s in choice_pairs]
+
+		# check length
+		for cv in choice_values:
+			cv_str = "%s__%s" % (id_str, cv)
+			if 26 < len (cv_str):
+				msg = "checkbox choice '%s' is too long" % cv_str
+				error_rec (rec, msg, code='choice-id-too-long', column=_CHOICES,
+					view=view)
+
+
+@rule ('branching-logic', stages=('post',), columns=(_BL,), ordered=True)
+def check_branching_logic (view):
+	"""
+	Check that branching logic only refers to variables already seen.
+	"""
+	ids = view.validator.ids
+	for m in BL_STR_VAR_REGEX.finditer (view.rec[_BL]):
+		curr_var = m.groups()[0]
+		if curr_var not in ids:
+			warn_rec (view.rec, "unrecognised variable '%s' in branching logic" %
+				curr_var, code='unknown-bl-variable', column=_BL, view=view)
+
+
+def value_rule (name, col, allowed_vals):
+	"""
+	Register a rule that the values of a column fall in a set of legal values.
+	"""
+	allowed_vals = frozenset (allowed_vals)
+
+	@rule (name, stages=('post',), columns=(col,), source=True,
+		description="Check that '%s' has a recognised value." % col)
+	def check_field_val (view):
+		val = view.rec[col]
+		if val not in allowed_vals:
+			warn_rec (view.rec, "unrecognised value '%s' for field '%s'" % (val,
+				col), code='unrecognised-value', column=col, view=view)
+
+	## Return:
+	return check_field_val
+
+
+value_rule ('field-type', _FTYPE, consts.ALLOWED_FTYPE_VALS)
+value_rule ('validation-type', _VTYPE, consts.ALLOWED_VALIDATION_VALS)
+value_rule ('identifier', COL.identifier.value,
+	consts.ALLOWED_IDENTIFIER_VALS)
+value_rule ('required', COL.required_field.value,
+	consts.ALLOWED_REQUIRED_VALS)
+
+
+@rule ('needs-choices', stages=('pre', 'post'), columns=(_FTYPE,),
+	stripped=(_CHOICES, _VTYPE, _VMIN, _VMAX), source=True)
+def check_needs_choices (view):
+	"""
+	Check that choice and calculated fields have choices and no validation.
+	"""
+	if view.rec[_FTYPE] in _CHOICE_FTYPES:
+		if not view.stripped[_CHOICES]:
+			warn_rec (view.rec, "choice / calculated field has no choices",
+				code='missing-choices', column=_CHOICES, view=view)
+		if view.stripped[_VTYPE]:
+			warn_rec (view.rec, "choice / calculated field has text validation",
+				code='choices-with-validation', column=_VTYPE, view=view)
+		if view.stripped[_VMIN]:
+			warn_rec (view.rec, "choice / calculated field has text min",
+				code='choices-with-validation', column=_VMIN, view=view)
+		if view.stripped[_VMAX]:
+			warn_rec (view.rec, "choice / calculated field has text max",
+				code='choices-with-validation', column=_VMAX, view=view)
+
+
+@rule ('unexpected-choices', stages=('pre', 'post'), columns=(_FTYPE,
+	_CHOICES), source=True, default=False)
+def check_unexpected_choices (view):
+	"""
+	Check that other fields don't have choices or a calculation.
+	"""
+	if (view.rec[_FTYPE] not in _CHOICE_FTYPES) and view.rec[_CHOICES]:
+		warn_rec (view.rec,
+			"non-choice / calculated field has choices or calculation",
+			code='unexpected-choices', column=_CHOICES, view=view)
+
+
+@rule ('choices-format', stages=('post',), columns=(_FTYPE,),
+	stripped=(_CHOICES,), source=True)
+def check_choices (view):
+	"""
+	Check that the choices of a choice field look well-formed.
 	"""
 	# TODO: needs honing
-	choices = rec[COL.choices_calculations.value].strip()
+	choices = view.stripped[_CHOICES]
 	if choices and '|' in choices and ',' in choices:
-		if rec[COL.field_type.value] in ('radio', 'checkbox', 'dropdown'):
+		field_type = view.rec[_FTYPE]
+		if field_type in _MULTI_CHOICE_FTYPES:
 			choice_pairs = [x.strip() for x in choices.split('|')]
-			if (8 < len (choice_pairs)) and (rec[COL.field_type.value] == 'radio'):
-				warn_rec (rec, 'radio with many choice should probably be dropdown')
+			if (8 < len (choice_pairs)) and (field_type == 'radio'):
+				warn_rec (view.rec,
+					'radio with many choice should probably be dropdown',
+					code='many-radio-choices', column=_FTYPE, view=view)
 			for cp in choice_pairs:
 				if ',' not in cp:
-					warn_rec (rec, "malformed choice string '%s'" % cp)
+					warn_rec (view.rec, "malformed choice string '%s'" % cp,
+						code='malformed-choice', column=_CHOICES, view=view)
+
+
+@rule ('template-syntax', stages=('pre',), columns=TMPL_CHECK_COLS)
+def check_template_errors (view):
+	"""
+	Check for imbalanced brackets, template delimiters and quotes.
+	"""
+	rec = view.rec
+	for c in TMPL_CHECK_COLS:
+		v = rec[c]
+		if v:
+			for tok, offset in scan_template_text (v):
+				if tok in CHAR_DBLS:
+					msg = "column '%s' may have unclosed quotes (see offset %s)" % (
+						c, offset)
+					code = 'unclosed-quote'
+				else:
+					msg = "column '%s' may be malformed (see '%s' at offset %s)" % (
+						c, tok, offset)
+					code = 'unbalanced-template'
+				warn_rec (rec, msg, code=code, column=c, view=view)
+
+
+@rule ('subsections', stages=('pre',), columns=(COL.subsection.value, _FORM,
+	COL.section_header.value), ordered=True)
+def check_subsection (view):
+	"""
+	Check that subsections fall entirely within forms and sections.
+	"""
+	view.validator.check_subsection (view.rec)
+
+
+## Other checks
 
+def is_static (rec, cols):
+	"""
+	Are these columns of a record free of template code?
 
-def check_field_val (rec, col, allowed_vals):
+	If so, they will be the same in every expansion of the record.
 	"""
-	Check that a record's val in a given column falls in a set of legal values.
+	for c in cols:
+		if has_template_code (rec[c]):
+			return False
+	return True
+
 
+def scan_template_text (v):
 	"""
-	val = rec[col.value]
-	if val not in allowed_vals:
-		warn_rec (rec, "unrecognised value '%s' for field '%s'" % (val,
-			col.value))
+	Look for imbalanced brackets, template delimiters and quotes in a string.
+
+	Returns:
+		a tuple of (token, offset) pairs, where the token is the opening
+		bracket or delimiter (or quote) that is imbalanced and the offset is
+		where in the string the first problem with it lies
+
+	The string is scanned once for everything in `CHAR_PAIRS` and `CHAR_DBLS`.
+	The offset is that of the first close without an open, or failing that the
+	first open that is never closed. For quotes, it is that of the last quote
+	that is never closed. As rows are repeated, the same strings turn up time
+	and again, so results are cached.
+
+	"""
+	res = _SCAN_CACHE.get (v, None)
+	if res is not None:
+		return res
+
+	opened = dict ((p[0], []) for p in CHAR_PAIRS)
+	unmatched = {}
+	quote_at = dict ((q, None) for q in CHAR_DBLS)
+	# two-character delimiters don't overlap, so note where the next can start
+	delim_from = 0
+
+	for i, ch in enumerate (v):
+		if ch in opened:
+			opened[ch].append (i)
+		elif ch in _BRACKET_CLOSE:
+			op = _BRACKET_CLOSE[ch]
+			if opened[op]:
+				opened[op].pop()
+			elif op not in unmatched:
+				unmatched[op] = i
+		elif ch in quote_at:
+			quote_at[ch] = i if (quote_at[ch] is None) else None
+
+		if (ch in _DELIM_CHARS) and (delim_from <= i):
+			tok = v[i:i+2]
+			if tok in _DELIM_OPEN:
+				opened[tok].append (i)
+				delim_from = i + 2
+			elif tok in _DELIM_CLOSE:
+				op = _DELIM_CLOSE[tok]
+				if opened[op]:
+					opened[op].pop()
+				elif op not in unmatched:
+					unmatched[op] = i
+				delim_from = i + 2
+
+	probs = []
+	for op, cl in CHAR_PAIRS:
+		if op in unmatched:
+			probs.append ((op, unmatched[op]))
+		elif opened[op]:
+			probs.append ((op, opened[op][0]))
+	for q in CHAR_DBLS:
+		if quote_at[q] is not None:
+			probs.append ((q, quote_at[q]))
+	res = tuple (probs)
+
+	if _SCAN_CACHE_MAX <= len (_SCAN_CACHE):
+		_SCAN_CACHE.clear()
+	_SCAN_CACHE[v] = res
+
+	## Return:
+	return res
 
 
 ### CLASSES
 
 class PreValidator (object):
-	def __init__ (self):
-		pass
+	"""
+	Check the records of a compact data dictionary as they are read.
 
+	Params:
+		enable (list): names of rules to run that are otherwise not run
+		disable (list): names of rules not to run
+		timed (bool): keep the time taken by each rule
 
-	def check (self, recs):
-		for r in recs:
-			self.check_rec (r)
-		self.check_subsections (recs)
+	Most checks look at one record at a time. Those of subsections depend on
+	the records before, so the validator keeps track of the subsection it is
+	in and records should be checked in order.
+
+	On big dictionaries, the checks of single records can be run in a pool of
+	processes with `iter_checked`, a chunk of records at a time. The rules
+	that depend on the records before are still run here, in order, and the
+	problems found are reported in the order of the records.
+
+	"""
+	def __init__ (self, enable=(), disable=(), timed=False):
+		self.curr_form = self.curr_subsection = None
+		self.enable, self.disable, self.timed = enable, disable, timed
+		rules = select_rules ('pre', enable, disable)
+		self.rules = RuleSet (rules, timed=timed)
+		# for when the checks of single records are made elsewhere
+		self.ordered_rules = RuleSet ([r for r in rules if r.ordered],
+			timed=timed)
+		self.worker_times = {}
+
+
+	def check (self, recs, jobs=1):
+		if 1 < jobs:
+			for r in self.iter_checked (recs, jobs=jobs):
+				pass
+		else:
+			for r in recs:
+				self.check_rec (r)
 
 
 	def check_rec (self, rec):
@@ -173,19 +496,94 @@ class PreValidator (object):
 		source.
 
 		"""
-		self.check_id_length (rec)
-		check_dates_and_times (rec)
-		check_needs_choices (rec, check_comp=False)
-		self.check_template_errors (rec)
+		self.rules.check (rec, validator=self)
 
 
-	def check_id_length (self, rec):
-		variable = rec[COL.variable.value]
-		if 26 < len (variable):
-			warn_rec (rec, "final variable identifier maybe too long")
+	def iter_checked (self, recs, jobs=2, chunk_size=PREVALIDATE_CHUNK_SIZE):
+		"""
+		Check records in a pool of processes, yielding them as they are sent.
+
+		Params:
+			recs (iterable): the records to check, in order
+			jobs (int): the number of processes to check them in
+			chunk_size (int): how many records to send to a process at once
+
+		Records are gathered into chunks, the ordered rules run on them here
+		and the rest in a process. As each chunk is sent, its records are
+		yielded. The problems found in a chunk are reported once it is done,
+		those of each record together and in the order of the records, so
+		they are as if the records were checked one after another. Only a few
+		chunks are waited on at once, so records can be read as they are
+		checked.
+
+		"""
+		from collections import deque
+		from concurrent.futures import ProcessPoolExecutor
+
+		pending = deque()
+		with ProcessPoolExecutor (max_workers=jobs) as executor:
+			chunk = []
+			for r in recs:
+				chunk.append (r)
+				if chunk_size <= len (chunk):
+					pending.append (self.submit_chunk (executor, chunk))
+					for c in chunk:
+						yield c
+					chunk = []
+					while (2 * jobs) < len (pending):
+						self.merge_chunk (*pending.popleft())
+			if chunk:
+				pending.append (self.submit_chunk (executor, chunk))
+				for c in chunk:
+					yield c
+			while pending:
+				self.merge_chunk (*pending.popleft())
+
+
+	def submit_chunk (self, executor, chunk):
+		"""
+		Run the ordered rules on a chunk and send it to be checked by the rest.
+
+		Returns:
+			the future of the check and the problems found by the ordered
+			rules in each record
+
+		"""
+		ordered_diags = []
+		for r in chunk:
+			with collecting() as diags:
+				self.ordered_rules.check (r, validator=self)
+			ordered_diags.append (list (diags))
+		future = executor.submit (_check_chunk_job, chunk, self.enable,
+			self.disable, self.timed)
+		return future, ordered_diags
+
+
+	def merge_chunk (self, future, ordered_diags):
+		"""
+		Report the problems found in a chunk, record by record.
+		"""
+		chunk_diags, times = future.result()
+		out = get_diagnostics()
+		for rec_diags, rec_ordered_diags in zip (chunk_diags, ordered_diags):
+			out.extend (rec_diags + rec_ordered_diags)
+		self.worker_times = merge_rule_times (self.worker_times, times)
+
+
+	def rule_times (self):
+		return merge_rule_times (self.rules.rule_times(),
+			self.ordered_rules.rule_times(), self.worker_times)
 
 
 	def check_subsections (self, recs):
+		"""
+		Check that the subsections of a run of records are well-formed.
+		"""
+		for r in recs:
+			self.check_subsection (r)
+
+
+	def check_subsection (self, rec):
 		"""
 		Check that the subsections fall entirely within forms and sections.
 
@@ -193,163 +591,185 @@ class PreValidator (object):
 		or belong to two or more forms or sections. (The way sections are written
 		- automatically terminating at the end of a form - avoids this issue.) So
 		it seems prudent to check that the subsections are written correctly.
+		Records are checked one at a time, in order.
 
 		"""
-		curr_form = curr_subsection = None
+		new_subsection = rec[COL.subsection.value]
+
+		if self.curr_subsection:
+			# currently in subsection
+
+			if self.curr_subsection == new_subsection:
+				# still in same section
+				new_form = rec[COL.form_name.value]
+				new_section = rec[COL.section_header.value]
+				# ... form should be the same
+				if self.curr_form != new_form:
+					msg = "subsection '%s' crosses form boundaries" % \
+						self.curr_subsection
+					error_rec (rec, msg, code='subsection-crosses-form',
+						column=COL.subsection.value)
+				# ... section should be blank
+				if new_section:
+					msg = "subsection '%s' crosses section boundaries" % \
+						self.curr_subsection
+					error_rec (rec, msg, code='subsection-crosses-section',
+						column=COL.subsection.value)
+
+			elif new_subsection:
+				# starting new subsection
+				self.curr_subsection = new_subsection
+				self.curr_form = rec[COL.form_name.value]
 
-		# for every record
-		for r in recs:
-			new_subsection = r[COL.subsection.value]
-
-			if curr_subsection:
-				# currently in subsection
-
-				if curr_subsection == new_subsection:
-					# still in same section
-					new_form = r[COL.subsection.value]
-					new_section = r[COL.section_header.value]
-					# ... form should be the same
-					if curr_form != new_form:
-						msg = "subsection '%s' crosses form boundaries" % \
-							curr_subsection
-						error_rec (r, msg)
-					# ... section should be blank
-					if new_section:
-						msg = "subsection '%s' crosses section boundaries" % \
-							curr_subsection
-						error_rec (r, msg)
-
-				elif new_subsection:
-					# starting new subsection
-					curr_subsection = new_subsection
-					curr_form = rec[i][COL.form_name.value]
+			else:
+				# finished subsection and moving to non-subsection
+				self.curr_form = self.curr_subsection = None
 
-				else:
-					# finished subsection and moving to non-subsection
-					curr_form = curr_subsection = None
+		else:
+			# currently _not_ in subsection
 
+			if new_subsection:
+				# started a subsection
+				self.curr_subsection = new_subsection
+				self.curr_form = rec[COL.form_name.value]
 			else:
-				# currently _not_ in subsection
+				# still not in subsection
+				pass
 
-				if new_subsection:
-					# started a subsection
-					curr_subsection = new_subsection
-					curr_form = r[COL.form_name.value]
-				else:
-					# still not in subsection
-					pass
 
+class PostValidator (object):
+	"""
+	Check the records of an expanded data dictionary.
+
+	Params:
+		db_schema (list): the structure the records were expanded from, if
+			known
+		enable (list): names of rules to run that are otherwise not run
+		disable (list): names of rules not to run
+		timed (bool): keep the time taken by each rule
+
+	Variables and forms are indexed as they are seen, so that checking for
+	duplicates and references takes the same time however many records there
+	are. Row numbers are those of the output file, the header being row 1.
+
+	Given the structure and records that give the input row they came from
+	(as the direct expander does, as their ``source_row``), the checks of
+	values that don't depend on the expansion are made once for each input
+	row, not for every record made from it. Problems found this way give the
+	input row (marked as such, see `diagnostics.INPUT_ROW`) and the record as
+	written there, and are counted once for each record made from it. The
+	rules that aren't of single values (those of identifiers, their length
+	and references to them) are still run for every record.
 
-	def check_template_errors (self, rec):
+	"""
+	def __init__ (self, db_schema=None, enable=(), disable=(), timed=False):
+		rules = select_rules ('post', enable, disable)
+		self.rules = RuleSet (rules, timed=timed, row_kind=OUTPUT_ROW)
+		# for records checked at their input row, as the rules are split
+		self.row_rules = RuleSet ([r for r in rules if not r.source],
+			timed=timed, row_kind=OUTPUT_ROW)
+		self.source_rules = RuleSet ([r for r in rules if r.source],
+			timed=timed, row_kind=INPUT_ROW)
+
+		# the row each variable was first seen on
+		self.ids = {}
+		self.form_names = set()
+		self.curr_form = None
+		self.row_num = 1
+
+		# input rows by number (until checked) and the problems found in each
+		self.sources = {}
+		if db_schema:
+			for f in db_schema:
+				self.add_sources (f)
+		self.source_diags = {}
+
+	def add_sources (self, form):
 		"""
-		Ad hoc check to see that template language code looks right.
+		Note the input rows of a form, so its records can be checked at them.
 
-		Also captures imbalanced braces and brackets.
+		Forms can be added as they are read, before their records are checked.
 		"""
-		for c in TMPL_CHECK_COLS:
-			v = rec[c]
-			if v:
-				for c_pr in CHAR_PAIRS:
-					cnts = [v.count (x) for x in c_pr]
-					if cnts[0] != cnts[1]:
-						msg = "column '%s' may be malformed (see '%s')" % (
-							c, c_pr[0])
-						warn_rec (rec, msg)
-				for ch in CHAR_DBLS:
-					if v.count (ch) % 2:
-						msg = "column '%s' may have unclosed quotes" % c
-						warn_rec (rec, msg)
+		for r in iter_source_rows (form):
+			if getattr (r, 'row_num', None) is not None:
+				self.sources[r.row_num] = r
 
-
-class PostValidator (object):
-	# TODO: am I checking for unique ids twice?
-	def __init__ (self):
-		self.field_ids = []
-		self.form_names = []
-		self.ids = []
+	def iter_adding_sources (self, forms):
+		"""
+		Yield forms as they come, adding the input rows of each.
+		"""
+		for f in forms:
+			self.add_sources (f)
+			yield f
 
 	def check (self, recs):
 		for r in recs:
 			self.check_rec (r)
 
-	def check_unique_id (self, rec):
-		variable = rec[COL.variable.value]
-		if variable in self.ids:
-			warn_rec (rec, "duplicate id '%s'" % (variable))
-		else:
-			self.ids.append (variable)
+	def rule_times (self):
+		return merge_rule_times (self.rules.rule_times(),
+			self.row_rules.rule_times(), self.source_rules.rule_times())
 
-	def check_form_name (self, rec):
+	def index_id (self, rec):
+		"""
+		Note the row a variable is first seen on.
 		"""
-		Ensure form names are not duplicated and run consecutively.
+		self.ids.setdefault (rec[_VAR], self.row_num)
 
+	def check_values (self, rec, row=None):
 		"""
-		# NOTE: we actually can't tell the difference between duplicated form
-		# names and non-consecutive forms - it's all in the eye of the beholder -
-		# so it creates the same error
-		# NOTE: check for required form_name elsewhere
-		form_name = rec[COL.form_name.value]
-		if form_name in self.form_names:
-			if form_name != self.form_names[-1]:
-				error_rec (rec, "form '%s' occurs non-consecutively")
-		else:
-			self.form_names.append (form_name)
+		Check the values of a record that don't depend on the others.
+		"""
+		self.source_rules.check (rec, row=row, validator=self)
 
-	def check_choices_len (self, rec):
+	def check_source_values (self, rec):
 		"""
-		For multichoice, checks that combined identifiers lengths is valid.
+		Check the values of a record at its input row, if they can be.
+
+		Returns:
+			False if the record didn't come from a known input row, or its
+			values there are templated, otherwise True
 
 		"""
-		# XXX: do we need a try-except here?
-		if rec[COL.field_type.value] == 'checkbox':
-			id_str = rec[COL.field_type.variable.value]
-			# parse choices string
-			choices_str = rec[COL.choices_calculations.value]
-			choice_pairs = choices_str.split ('|')
-			choice_values = [s.split(',', 1)[0].strip() for s in choice_pairs]
-
-			# check length
-			for cv in choice_values:
-				cv_str = "%s__%s" % (id_str, cv)
-				if 26 < len (cv_str):
-					msg = "checkbox choice '%s' is too long" % cv_str
-					error_rec (rec, msg)
+		src_row = getattr (rec, 'source_row', None)
+		if src_row is None:
+			return False
+		diags = self.source_diags.get (src_row, None)
+		if diags is None:
+			# the row is no longer needed, as its problems are kept
+			src = self.sources.pop (src_row, None)
+			if (src is None) or not is_static (src, self.source_rules.columns):
+				diags = False
+			else:
+				with collecting() as src_diags:
+					self.check_values (src, row=src_row)
+				diags = get_diagnostics().extend (src_diags)
+			self.source_diags[src_row] = diags
+		elif diags:
+			get_diagnostics().recount (diags)
+		return diags is not False
 
 	def check_rec (self, rec):
-		check_required_fields (rec)
-		check_id_length (rec)
-		self.check_unique_id (rec)
-		self.check_form_name (rec)
-
-		# check various fields have correct values
-		check_field_val (rec, consts.Column.field_type,
-			consts.ALLOWED_FTYPE_VALS)
-		check_field_val (rec, consts.Column.text_validation_type,
-			consts.ALLOWED_VALIDATION_VALS)
-		check_field_val (rec, consts.Column.identifier,
-			consts.ALLOWED_IDENTIFIER_VALS)
-		check_field_val (rec, consts.Column.required_field,
-			consts.ALLOWED_REQUIRED_VALS)
-
-		check_needs_choices (rec, check_comp=False)
-		check_choices (rec)
-		self.check_choices_len (rec)
-
-		# check bl vars are proper
-		var_name = rec[COL.variable.value]
-		if var_name in self.field_ids:
-			error_rec (rec, "variable '%s' duplicated" % var_name)
-		else:
-			self.field_ids.append (rec[COL.variable.value])
-
-		# check bl vars are proper
-		bl_str = rec[COL.branching_logic.value]
-		var_names = [m for m in BL_STR_VAR_REGEX.finditer (bl_str)]
-		for m in var_names:
-			curr_var = m.groups()[0]
-			if curr_var not in self.field_ids:
-				warn_rec (rec, "unrecognised variable '%s' in branching logic" % curr_var)
+		self.row_num += 1
+		self.index_id (rec)
 
+		if self.check_source_values (rec):
+			self.row_rules.check (rec, row=self.row_num, validator=self)
+		else:
+			self.rules.check (rec, row=self.row_num, validator=self)
+
+
+def _check_chunk_job (recs, enable, disable, timed):
+	# run the rules that don't depend on the records before, returning the
+	# problems found in each record and the time the rules took
+	rules = RuleSet ([r for r in select_rules ('pre', enable, disable) if
+		not r.ordered], timed=timed)
+	all_diags = []
+	for r in recs:
+		with collecting() as diags:
+			rules.check (r)
+		all_diags.append (list (diags))
+	return all_diags, rules.rule_times()
 
 
 ### END ###
@@ -0,0 +1,125 @@
+"""
+Variants: several tag selections expanded from the one compact dictionary.
+
+A study with several arms might keep them all in one tagged compact data
+dictionary, producing one expanded dictionary per arm. Rather than re-reading
+and re-validating the input for each, the variants can be listed and expanded
+together from the one parsed structure.
+
+"""
+
+### IMPORTS
+
+from .extvars import ext_from_path, ext_to_format, parse_ext_vars
+
+__all__ = [
+	'Variant',
+	'read_variants',
+]
+
+
+### CONSTANTS & DEFINES
+
+_EXPANDED_EXT = '.expanded.csv'
+
+
+### CODE ###
+
+class Variant (object):
+	"""
+	A selection of tags to be expanded, and where to write the result.
+	"""
+	def __init__ (self, inc_tags=None, exc_tags=None, outfile=None):
+		assert not (inc_tags and exc_tags), "cannot have included and excluded tags"
+		self.inc_tags = _parse_tag_list (inc_tags)
+		self.exc_tags = _parse_tag_list (exc_tags)
+		self.outfile = outfile
+
+	def __repr__ (self):
+		return 'Variant (inc_tags=%r, exc_tags=%r, outfile=%r)' % (
+			self.inc_tags, self.exc_tags, self.outfile)
+
+	@property
+	def tags (self):
+		"""
+		The tags selected for this variant, whether included or excluded.
+		"""
+		return self.inc_tags or self.exc_tags
+
+	@property
+	def mode (self):
+		"""
+		Whether tags are included ('inc') or excluded ('exc'), if either.
+
+		Variants with the same mode can share the one expanded template.
+		"""
+		if self.inc_tags:
+			return 'inc'
+		elif self.exc_tags:
+			return 'exc'
+		else:
+			return None
+
+	def default_outfile (self, fileroot, name=True):
+		"""
+		Work out what the expanded dictionary should be called.
+
+		Params:
+			fileroot (str): the input path, without its extension
+			name (bool): label the output with the tags used
+
+		"""
+		if name and self.mode:
+			return '%s.%s-%s%s' % (fileroot, self.mode, '-'.join (self.tags),
+				_EXPANDED_EXT)
+		else:
+			return fileroot + _EXPANDED_EXT
+
+	def outfile_for (self, fileroot):
+		return self.outfile or self.default_outfile (fileroot)
+
+
+def read_variants (pth):
+	"""
+	Read a manifest of variants from a JSON, YAML or INI file.
+
+	The manifest is either a list of variants, or a mapping of variant names
+	to variants (as with the sections of an INI file). Each variant may give
+	``include_tags`` or ``exclude_tags``, as a list or a comma-delimited
+	string, and an ``outfile``.
+
+	"""
+	fmt = ext_to_format (ext_from_path (pth))
+	with open (pth, 'r') as in_hndl:
+		data = parse_ext_vars (in_hndl.read(), fmt)
+
+	if isinstance (data, dict):
+		entries = list (data.values())
+	else:
+		entries = data
+	assert isinstance (entries, list), "can't interpret variants in '%s'" % pth
+
+	variants = []
+	for e in entries:
+		unknown = set (e.keys()) - set (['include_tags', 'exclude_tags',
+			'outfile'])
+		assert not unknown, "unrecognised variant fields %s" % sorted (unknown)
+		variants.append (Variant (
+			inc_tags=e.get ('include_tags', None),
+			exc_tags=e.get ('exclude_tags', None),
+			outfile=e.get ('outfile', None),
+		))
+
+	## Return:
+	return variants
+
+
+def _parse_tag_list (tags):
+	if not tags:
+		return None
+	if isinstance (tags, str):
+		tags = tags.split (',')
+	return [t.strip() for t in tags if t.strip()]
+
+
+### END ###
@@ -0,0 +1,80 @@
+"""
+Watch files for changes, so expansion can be re-run as a dictionary is edited.
+
+This polls the modification time and size of each file, which is crude but
+needs nothing beyond the standard library and works wherever the files are
+kept.
+
+"""
+
+### IMPORTS
+
+import os
+import time
+
+__all__ = [
+	'FileWatcher',
+]
+
+
+### CONSTANTS & DEFINES
+
+DEFAULT_INTERVAL = 0.5
+
+
+### CODE ###
+
+class FileWatcher (object):
+	"""
+	Report which of a set of files have changed since last looked at.
+
+	Params:
+		paths (seq): the files to watch
+		interval (float): seconds to wait between looking at the files
+
+	"""
+	def __init__ (self, paths, interval=DEFAULT_INTERVAL):
+		self.paths = [p for p in paths if p]
+		self.interval = interval
+		self.stamps = self.snapshot()
+
+	def snapshot (self):
+		"""
+		Return the modification time and size of each file, or None if missing.
+		"""
+		stamps = {}
+		for p in self.paths:
+			try:
+				st = os.stat (p)
+				stamps[p] = (st.st_mtime, st.st_size)
+			except OSError:
+				stamps[p] = None
+		return stamps
+
+	def changed (self):
+		"""
+		Return the files that have changed since the last call.
+
+		A file that has gone missing (e.g. while being saved) is not counted
+		as changed until it reappears.
+		"""
+		new_stamps = self.snapshot()
+		changed = [p for p in self.paths if new_stamps[p] is not None and
+			new_stamps[p] != self.stamps[p]]
+		for p in self.paths:
+			if new_stamps[p] is not None:
+				self.stamps[p] = new_stamps[p]
+		return changed
+
+	def wait (self):
+		"""
+		Block until some files change, returning them.
+		"""
+		while True:
+			time.sleep (self.interval)
+			changed = self.changed()
+			if changed:
+				return changed
+
+
+### END ###